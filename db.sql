@@ -23,11 +23,37 @@ CREATE TABLE User_chats (
 
 CREATE TABLE Chat_data (
     ChatID VARCHAR(50) PRIMARY KEY,
-    Chat_history JSON,
+    Chat_history JSON,  -- legacy, messages are stored in Chat_messages
     Chat_summary TEXT
 );
 
 
+-- One row per chat message. Each turn appends its messages instead of rewriting the whole history.
+CREATE TABLE Chat_messages (
+    ChatID VARCHAR(50),
+    Seq INT,
+    Type ENUM('HumanMessage', 'AIMessage'),
+    Content MEDIUMTEXT,
+    Metadata JSON,
+    Created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (ChatID, Seq)
+);
+
+-- Migration of chat histories stored in Chat_data.Chat_history (MySQL 8.0+).
+-- Chats that are not migrated here are moved over the first time they are loaded.
+-- INSERT INTO Chat_messages (ChatID, Seq, Type, Content, Metadata)
+-- SELECT d.ChatID, m.Seq - 1, m.Type, m.Content, JSON_REMOVE(m.Message, '$.type', '$.content')
+-- FROM Chat_data d,
+--     JSON_TABLE(d.Chat_history, '$[*]' COLUMNS (
+--         Seq FOR ORDINALITY,
+--         Type VARCHAR(20) PATH '$.type',
+--         Content MEDIUMTEXT PATH '$.content',
+--         Message JSON PATH '$'
+--     )) AS m
+-- WHERE d.Chat_history IS NOT NULL;
+-- UPDATE Chat_data SET Chat_history = NULL;
+
+
 CREATE TABLE Chat_info (
     ChatID VARCHAR(50) PRIMARY KEY,
     Chat_title VARCHAR(50),
@@ -143,6 +169,7 @@ CREATE TABLE feedback_log (
 select * from User_data;
 select * from User_chats;
 select * from Chat_data;
+select * from Chat_messages;
 select * from Chat_info;
 select * from Curriculum;
 select * from Personalization_instructions;
@@ -3,6 +3,7 @@ from sqlalchemy import Table, Column, String, DateTime, LargeBinary
 from sqlalchemy.sql.sqltypes import Integer
 from datetime import datetime, timezone
 import os
+import threading
 
 # Load environment variables
 MYSQL_HOST = os.getenv("MYSQL_HOST")
@@ -16,9 +17,6 @@ engine = create_engine(f"mysql+pymysql://{MYSQL_USER}:{MYSQL_PASSWORD}@{MYSQL_HO
 # Define metadata
 meta = MetaData()
 
-# Connect to the database
-conn = engine.connect()
-
 # Define tables
 lecture_materials = Table(
     'lecture_materials', meta,
@@ -29,5 +27,23 @@ lecture_materials = Table(
     Column('uploaded_at', DateTime, default=lambda: datetime.now(timezone.utc))
 )
 
-# Create all tables in the database
-meta.create_all(engine)
\ No newline at end of file
+_tables_created = False
+_tables_lock = threading.Lock()
+
+
+# The tables are created on first use so importing this module doesn't touch the database
+def create_tables():
+    global _tables_created
+    if not _tables_created:
+        with _tables_lock:
+            if not _tables_created:
+                # Create all tables in the database
+                meta.create_all(engine)
+                _tables_created = True
+
+
+# A connection from the engine's pool inside a transaction, committed (or rolled back) when the with block exits.
+# Endpoints run concurrently in the threadpool and a Connection isn't thread safe, so each request checks out its own.
+def get_connection():
+    create_tables()
+    return engine.begin()
@@ -0,0 +1,172 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+
+CAPTION_CACHE_DB = os.getenv("CAPTION_CACHE_DB", "caption_cache.db")
+# Maximum number of differing bits (out of 64) between the perceptual hashes of near-duplicate images.
+# Must be below DHASH_BANDS, see CaptionCache._candidates.
+CAPTION_CACHE_MAX_DISTANCE = int(os.getenv("CAPTION_CACHE_MAX_DISTANCE", "3"))
+# Minimum similarity (Jaccard index of their words) between the OCR texts of near-duplicate images.
+# Slides made from the same template have close perceptual hashes, only their text tells them apart.
+CAPTION_CACHE_MIN_TEXT_SIMILARITY = float(os.getenv("CAPTION_CACHE_MIN_TEXT_SIMILARITY", "0.8"))
+
+# The 64-bit hash is indexed in 4 bands of 16 bits
+DHASH_BANDS = 4
+DHASH_BAND_BITS = 64 // DHASH_BANDS
+
+
+def content_hash(img):
+    # Hash of the decoded pixels, so the same image gets the same key whether it was read from a
+    # file or rendered in memory
+    digest = hashlib.sha256(f"{img.mode} {img.size}".encode())
+    digest.update(img.tobytes())
+    return digest.hexdigest()
+
+
+def image_dhash(img):
+    """64-bit difference hash: whether each pixel of a 9x8 grayscale thumbnail is brighter than its right neighbour.
+
+    Re-encoding, resizing and small edits barely change it, so re-exported slides and consecutive
+    video frames of the same slide have hashes a few bits apart.
+    """
+    import PIL.Image
+    pixels = list(img.convert("L").resize((9, 8), PIL.Image.LANCZOS).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+
+def text_similarity(text, other):
+    """Jaccard index of the lowercased words of two OCR texts, 1.0 if neither has any."""
+    words = set(re.findall(r"\w+", text.lower()))
+    other_words = set(re.findall(r"\w+", other.lower()))
+    if not words and not other_words:
+        return 1.0
+    return len(words & other_words) / len(words | other_words)
+
+
+def bands(dhash):
+    mask = (1 << DHASH_BAND_BITS) - 1
+    return [(band, (dhash >> (band * DHASH_BAND_BITS)) & mask) for band in range(DHASH_BANDS)]
+
+
+class CaptionCache:
+    """OCR text and vision model captions of images, stored in SQLite by content hash.
+
+    Lookups go by the SHA-256 of the image's pixels first. Failing that, an image whose perceptual
+    hash is within `max_distance` bits and whose OCR text is at least `min_text_similarity` similar
+    is a near duplicate (the same slide in a revised deck or a re-encoded video) and its model
+    caption can be reused, though the OCR text is redone since it may differ in details. Entries
+    record the provider and model that wrote the caption, and only captions by the models in use
+    are returned, so switching models re-captions images.
+    """
+
+    def __init__(self, path, max_distance, min_text_similarity):
+        self.path = path
+        self.max_distance = max_distance
+        self.min_text_similarity = min_text_similarity
+        self._connection = None
+        self._hashes = None  # key -> perceptual hash
+        self._postings = None  # (band, value) -> keys
+        self._lock = threading.Lock()
+        self._stats = {"exact_hits": 0, "similar_hits": 0, "misses": 0, "stores": 0}
+
+    def _connect(self):
+        # Opened on first use. All access goes through self._lock, so one connection is shared by every thread.
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.row_factory = sqlite3.Row
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS captions (
+                    sha256 TEXT PRIMARY KEY,
+                    dhash TEXT NOT NULL,
+                    ocr_text TEXT NOT NULL,
+                    ocr_version TEXT,
+                    caption TEXT NOT NULL,
+                    provider TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            self._connection.commit()
+
+            self._hashes = {}
+            self._postings = {}
+            for row in self._connection.execute("SELECT sha256, dhash FROM captions"):
+                self._index(row["sha256"], int(row["dhash"], 16))
+        return self._connection
+
+    def _index(self, key, dhash):
+        self._hashes[key] = dhash
+        for band in bands(dhash):
+            self._postings.setdefault(band, set()).add(key)
+
+    def _candidates(self, dhash):
+        # Two hashes at most DHASH_BANDS - 1 bits apart are identical in at least one band
+        candidates = set()
+        for band in bands(dhash):
+            candidates.update(self._postings.get(band, ()))
+        return candidates
+
+    def _hit(self, connection, row, stat):
+        connection.execute("UPDATE captions SET hits = hits + 1 WHERE sha256 = ?", (row["sha256"],))
+        connection.commit()
+        self._stats[stat] += 1
+        return dict(row)
+
+    def get(self, key, models):
+        """The entry for an image with content hash `key`, if it was captioned by one of `models`."""
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute("SELECT * FROM captions WHERE sha256 = ?", (key,)).fetchone()
+            if row is not None and row["model"] in models:
+                return self._hit(connection, row, "exact_hits")
+        return None
+
+    def similar(self, dhash, ocr_text, models):
+        """The closest near-duplicate entry with OCR text like `ocr_text` captioned by one of `models`, or None (counted as a miss)."""
+        with self._lock:
+            connection = self._connect()
+            matches = sorted((bin(dhash ^ self._hashes[key]).count("1"), key) for key in self._candidates(dhash))
+            for distance, key in matches:
+                if distance > self.max_distance:
+                    break
+                row = connection.execute("SELECT * FROM captions WHERE sha256 = ?", (key,)).fetchone()
+                if row["model"] in models and text_similarity(ocr_text, row["ocr_text"]) >= self.min_text_similarity:
+                    return self._hit(connection, row, "similar_hits")
+            self._stats["misses"] += 1
+        return None
+
+    def store(self, key, dhash, ocr_text, ocr_version, caption, provider, model):
+        with self._lock:
+            connection = self._connect()
+            connection.execute("""
+                INSERT INTO captions (sha256, dhash, ocr_text, ocr_version, caption, provider, model, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (sha256) DO UPDATE SET ocr_text = excluded.ocr_text, ocr_version = excluded.ocr_version, caption = excluded.caption,
+                    provider = excluded.provider, model = excluded.model, created = excluded.created
+            """, (key, f"{dhash:016x}", ocr_text, ocr_version, caption, provider, model, time.time()))
+            connection.commit()
+            if key not in self._hashes:
+                self._index(key, dhash)
+            self._stats["stores"] += 1
+
+    def stats(self):
+        with self._lock:
+            hits = self._stats["exact_hits"] + self._stats["similar_hits"]
+            lookups = hits + self._stats["misses"]
+            return dict(self._stats, entries=len(self._hashes) if self._hashes is not None else 0,
+                        hit_rate=hits / lookups if lookups else 0.0)
+
+
+# Shared cache used by Captioning.captioner, for uploads and chat attachments alike
+caption_cache = CaptionCache(
+    path=CAPTION_CACHE_DB,
+    max_distance=CAPTION_CACHE_MAX_DISTANCE,
+    min_text_similarity=CAPTION_CACHE_MIN_TEXT_SIMILARITY
+)
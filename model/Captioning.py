@@ -0,0 +1,293 @@
+import base64
+import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import PIL.Image
+import pytesseract # type: ignore
+
+from CaptionCache import caption_cache, content_hash, image_dhash
+
+# Providers used for image captions, in order of preference. A provider is skipped if its API key isn't set.
+CAPTION_PROVIDERS = os.getenv("CAPTION_PROVIDERS", "gemini,openai,groq").split(",")
+# Images captioned at the same time (OCR and the caption request)
+CAPTION_CONCURRENCY = int(os.getenv("CAPTION_CONCURRENCY", "8"))
+# Estimated tokens per caption request (image, prompt and answer), counted against the providers' TPM limits
+CAPTION_TOKENS_PER_IMAGE = int(os.getenv("CAPTION_TOKENS_PER_IMAGE", "1000"))
+# Attempts per image. A failed request is retried with the provider that has capacity first.
+CAPTION_MAX_ATTEMPTS = int(os.getenv("CAPTION_MAX_ATTEMPTS", "3"))
+# JPEG quality of the images sent to the OpenAI and Groq APIs
+CAPTION_JPEG_QUALITY = int(os.getenv("CAPTION_JPEG_QUALITY", "85"))
+
+CAPTION_PROMPT = "What is in this image?"
+
+# Model and rate limits (requests and tokens per minute) of each provider, set them to your account's limits
+PROVIDER_SETTINGS = {
+    "gemini": {
+        "api_key": "GOOGLE_API_KEY",
+        "model": os.getenv("CAPTION_GEMINI_MODEL", "gemini-1.5-flash"),
+        "rpm": int(os.getenv("CAPTION_GEMINI_RPM", "15")),
+        "tpm": int(os.getenv("CAPTION_GEMINI_TPM", "1000000")),
+    },
+    "openai": {
+        "api_key": "OPENAI_API_KEY",
+        "model": os.getenv("CAPTION_OPENAI_MODEL", "gpt-4o-mini"),
+        "rpm": int(os.getenv("CAPTION_OPENAI_RPM", "500")),
+        "tpm": int(os.getenv("CAPTION_OPENAI_TPM", "200000")),
+    },
+    "groq": {
+        "api_key": "GROQ_API_KEY",
+        "model": os.getenv("CAPTION_GROQ_MODEL", "llama-3.2-11b-vision-preview"),
+        "rpm": int(os.getenv("CAPTION_GROQ_RPM", "30")),
+        "tpm": int(os.getenv("CAPTION_GROQ_TPM", "15000")),
+    },
+}
+
+
+def combine_captions(ocr_text, model_caption):
+    return (f"Caption by pytesseract:\n{ocr_text}\n\n"
+            f"Caption by model:\n{model_caption}")
+
+
+def is_rate_limit(error):
+    # OpenAI and Groq raise RateLimitError (status code 429), Gemini ResourceExhausted (429 in the message)
+    message = str(error).lower()
+    return getattr(error, "status_code", None) == 429 or "429" in message or "rate limit" in message or "quota" in message
+
+
+class TokenBucket:
+    """Allows `per_minute` units per minute, in bursts of up to a minute's worth.
+
+    Units are taken before a request is sent. When the bucket doesn't hold enough, it goes negative
+    and wait_time() tells the caller how long to wait, so concurrent callers queue up behind each
+    other instead of all waking up at once. Not thread safe, the Captioner locks around it.
+    """
+
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        self._refill()
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+    def take(self, amount):
+        self._refill()
+        self.tokens -= amount
+
+    def drain(self):
+        # After a rate limit error, wait for a full refill of what was left
+        self._refill()
+        self.tokens = min(self.tokens, 0)
+
+
+class Provider:
+    def __init__(self, name, api_key, model, rpm, tpm):
+        self.name = name
+        self.api_key = api_key
+        self.model = model
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self._client = None
+
+    def wait_time(self, tokens):
+        return max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+
+    def take(self, tokens):
+        self.requests.take(1)
+        self.tokens.take(tokens)
+
+    def caption(self, img):
+        if self.name == "gemini":
+            if self._client is None:
+                import google.generativeai as genai # type: ignore
+                genai.configure(api_key=self.api_key)
+                self._client = genai.GenerativeModel(self.model)
+            return self._client.generate_content(img).text.strip()
+
+        if self._client is None:
+            if self.name == "openai":
+                from openai import OpenAI
+                self._client = OpenAI(api_key=self.api_key)
+            else:
+                from groq import Groq
+                self._client = Groq(api_key=self.api_key)
+
+        # Encoded once, in memory
+        buffer = io.BytesIO()
+        img.convert("RGB").save(buffer, format="JPEG", quality=CAPTION_JPEG_QUALITY)
+        img_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
+        chat_completion = self._client.chat.completions.create(
+            messages=[
+                {
+                    "role": "user",
+                    "content": [
+                        {"type": "text", "text": CAPTION_PROMPT},
+                        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{img_base64}"}},
+                    ],
+                }
+            ],
+            model=self.model,
+        )
+        return chat_completion.choices[0].message.content
+
+
+class Captioner:
+    """Captions images concurrently within the rate limits of every vision provider.
+
+    Each image gets its Tesseract OCR text and a caption from a vision model. The providers are
+    shared by every caller (ingestion jobs and chat attachments), each with a requests-per-minute
+    and a tokens-per-minute bucket. A request goes to the first provider, in order of preference,
+    that has capacity right now. When none has, it waits for whichever frees up first, so
+    captioning runs at the combined rate of all providers. Results are returned in input order.
+    Images seen before, exactly or as near duplicates, reuse their caption from `cache`.
+
+    Images are PIL images, so pages and frames can go from the decoder to OCR and the caption
+    request without being written to disk.
+    """
+
+    def __init__(self, providers, concurrency, tokens_per_image, max_attempts, cache):
+        self.providers = providers
+        self.concurrency = concurrency
+        self.tokens_per_image = tokens_per_image
+        self.max_attempts = max_attempts
+        self.cache = cache
+        self.models = {provider.model for provider in providers}
+        self._ocr_version = None
+        self._lock = threading.Lock()
+        self._stats = {provider.name: {"requests": 0, "failures": 0} for provider in providers}
+
+    def _reserve(self, exclude):
+        # The first provider with capacity, or the one that has capacity soonest
+        with self._lock:
+            candidates = [provider for provider in self.providers if provider.name not in exclude] or self.providers
+            wait, _, provider = min((provider.wait_time(self.tokens_per_image), i, provider) for i, provider in enumerate(candidates))
+            provider.take(self.tokens_per_image)
+            self._stats[provider.name]["requests"] += 1
+        return wait, provider
+
+    def _model_caption(self, img):
+        failed = set()
+        for attempt in range(1, self.max_attempts + 1):
+            wait, provider = self._reserve(failed)
+            if wait:
+                time.sleep(wait)
+            try:
+                return provider.caption(img), provider
+            except Exception as e:
+                with self._lock:
+                    if is_rate_limit(e):
+                        # Something else is using the same quota, give the provider a rest
+                        provider.requests.drain()
+                    self._stats[provider.name]["failures"] += 1
+                failed.add(provider.name)
+                if attempt == self.max_attempts:
+                    raise
+                print(f"Caption by {provider.name} failed (attempt {attempt}): {e}")
+
+    def ocr_version(self):
+        if self._ocr_version is None:
+            try:
+                self._ocr_version = str(pytesseract.get_tesseract_version())
+            except Exception:
+                self._ocr_version = ""
+        return self._ocr_version
+
+    def caption_image(self, image_path):
+        return self._caption(PIL.Image.open(image_path))[0]
+
+    def _caption(self, img):
+        # The combined caption and where the model caption came from, a provider or the cache
+        if not self.providers:
+            raise RuntimeError("No caption provider configured, set GOOGLE_API_KEY, OPENAI_API_KEY or GROQ_API_KEY")
+        key = content_hash(img)
+        cached = self.cache.get(key, self.models)
+        if cached is not None:
+            return combine_captions(cached["ocr_text"], cached["caption"]), "cache"
+
+        dhash = image_dhash(img)
+        initial_caption = pytesseract.image_to_string(img).strip()
+
+        similar = self.cache.similar(dhash, initial_caption, self.models)
+        if similar is not None:
+            # Near duplicate: same picture and mostly the same text, but the text may differ in details, so only the caption is reused
+            model_caption, provider_name, model = similar["caption"], similar["provider"], similar["model"]
+            source = "cache"
+        else:
+            model_caption, provider = self._model_caption(img)
+            provider_name, model = provider.name, provider.model
+            source = provider.name
+        self.cache.store(key, dhash, initial_caption, self.ocr_version(), model_caption, provider_name, model)
+        return combine_captions(initial_caption, model_caption), source
+
+    def caption_images(self, images, on_caption=None):
+        """Captions of `images`, an iterable of PIL images, in the same order. `on_caption` is called after every image.
+
+        `images` is consumed lazily, at most two images per worker ahead of the captioning, so a
+        generator decoding pages or frames never holds more than that in memory.
+        """
+        start = time.time()
+        captions = []
+        sources = {}
+        pending = {}
+        images = iter(images)
+        exhausted = False
+        executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="caption")
+        try:
+            while True:
+                while not exhausted and len(pending) < 2 * self.concurrency:
+                    img = next(images, None)
+                    if img is None:
+                        exhausted = True
+                        break
+                    pending[executor.submit(self._caption, img)] = len(captions)
+                    captions.append(None)
+                if not pending:
+                    break
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    captions[pending.pop(future)], source = future.result()
+                    sources[source] = sources.get(source, 0) + 1
+                    if on_caption:
+                        on_caption()
+        finally:
+            # Don't start the remaining images if one failed or the caller stopped (e.g. a cancelled job)
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        if captions:
+            used = ", ".join(f"{source} {count}" for source, count in sorted(sources.items()))
+            print(f"Captioned {len(captions)} images in {time.time() - start:.1f}s ({used})")
+        return captions
+
+    def stats(self):
+        with self._lock:
+            return {name: dict(stats) for name, stats in self._stats.items()}
+
+
+def configured_providers():
+    providers = []
+    for name in CAPTION_PROVIDERS:
+        settings = PROVIDER_SETTINGS[name.strip()]
+        api_key = os.getenv(settings["api_key"])
+        if api_key:
+            providers.append(Provider(name.strip(), api_key, settings["model"], settings["rpm"], settings["tpm"]))
+    return providers
+
+
+# Shared by every caller, so the rate limits hold across concurrent uploads and chats
+captioner = Captioner(
+    providers=configured_providers(),
+    concurrency=CAPTION_CONCURRENCY,
+    tokens_per_image=CAPTION_TOKENS_PER_IMAGE,
+    max_attempts=CAPTION_MAX_ATTEMPTS,
+    cache=caption_cache
+)
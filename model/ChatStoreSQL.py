@@ -5,10 +5,7 @@ import mysql.connector
 #import pymysql
 from langchain_core.messages import HumanMessage, AIMessage
 
-MYSQL_HOST = os.getenv("MYSQL_HOST")
-MYSQL_USER = os.getenv("MYSQL_USER")
-MYSQL_PASSWORD = os.getenv("MYSQL_PASSWORD")
-MYSQL_DB = os.getenv("MYSQL_DB")
+from MySQLPool import mysql_pool
 
 # Function to establish MySQL connection
 def get_mysql_connection():
@@ -26,111 +23,253 @@ def get_mysql_connection():
     #     write_timeout=timeout,
     # )
 
-    connection = mysql.connector.connect(
-        host=MYSQL_HOST,
-        user=MYSQL_USER,
-        password=MYSQL_PASSWORD,
-        database=MYSQL_DB
-    )
+    # Connections come from a shared, bounded pool. Calling close() returns them to the pool.
+    connection = mysql_pool.get_connection()
     return connection
 
-def serialize_chat_history(chat_history):
-    serialized_history = []
-    for message in chat_history:
-        if isinstance(message, HumanMessage):
-            serialized_message = {
-                "type": "HumanMessage",
-                "content": message.content,
-                # Serialize the specific response_metadata fields for HumanMessage
-                "mediaType": message.response_metadata.get("mediaType"),
-                "fileName": message.response_metadata.get("fileName")
+def message_to_dict(message):
+    if isinstance(message, HumanMessage):
+        return {
+            "type": "HumanMessage",
+            "content": message.content,
+            # Serialize the specific response_metadata fields for HumanMessage
+            "mediaType": message.response_metadata.get("mediaType"),
+            "fileName": message.response_metadata.get("fileName")
+        }
+    elif isinstance(message, AIMessage):
+        return {
+            "type": "AIMessage",
+            "content": message.content,
+            # Serialize the specific response_metadata fields for AIMessage
+            "context": message.response_metadata.get("context"),
+            "files": message.response_metadata.get("files")
+        }
+    else:
+        raise ValueError(f"Unknown message type: {message.__class__.__name__}")
+
+def message_from_dict(serialized_message):
+    if serialized_message["type"] == "HumanMessage":
+        # Deserialize HumanMessage with mediaType and fileName metadata
+        return HumanMessage(
+            content=serialized_message["content"],
+            response_metadata={
+                "mediaType": serialized_message.get("mediaType"),
+                "fileName": serialized_message.get("fileName")
             }
-        elif isinstance(message, AIMessage):
-            serialized_message = {
-                "type": "AIMessage",
-                "content": message.content,
-                # Serialize the specific response_metadata fields for AIMessage
-                "context": message.response_metadata.get("context"),
-                "files": message.response_metadata.get("files")
+        )
+    elif serialized_message["type"] == "AIMessage":
+        # Deserialize AIMessage with context metadata
+        return AIMessage(
+            content=serialized_message["content"],
+            response_metadata={
+                "context": serialized_message.get("context"),
+                "files": serialized_message.get("files")
             }
-        else:
-            raise ValueError(f"Unknown message type: {message.__class__.__name__}")
-        
-        serialized_history.append(serialized_message)
-    
-    return json.dumps(serialized_history)
+        )
+    else:
+        raise ValueError(f"Unknown message type: {serialized_message['type']}")
 
+# Chats saved before messages moved to the chat_messages table keep their history as a JSON
+# list in chat_data.chat_history. It is only read to migrate those chats.
 def deserialize_chat_history(serialized_history):
-    chat_history = []
-    for serialized_message in json.loads(serialized_history):
-        if serialized_message["type"] == "HumanMessage":
-            # Deserialize HumanMessage with mediaType and fileName metadata
-            message = HumanMessage(
-                content=serialized_message["content"],
-                response_metadata={
-                    "mediaType": serialized_message.get("mediaType"),
-                    "fileName": serialized_message.get("fileName")
-                }
-            )
-        elif serialized_message["type"] == "AIMessage":
-            # Deserialize AIMessage with context metadata
-            message = AIMessage(
-                content=serialized_message["content"],
-                response_metadata={
-                    "context": serialized_message.get("context"),
-                    "files": serialized_message.get("files")
-                }
-            )
-        else:
-            raise ValueError(f"Unknown message type: {serialized_message['type']}")
-        
-        chat_history.append(message)
-    
-    return chat_history
+    return [message_from_dict(serialized_message) for serialized_message in json.loads(serialized_history)]
+
+# A chat_messages row is (Type, Content, Metadata) where Metadata holds the remaining fields as JSON
+def message_to_row(message):
+    serialized_message = message_to_dict(message)
+    message_type = serialized_message.pop("type")
+    content = serialized_message.pop("content")
+    return message_type, content, json.dumps(serialized_message)
+
+def message_from_row(message_type, content, metadata):
+    serialized_message = json.loads(metadata) if metadata else {}
+    serialized_message.update(type=message_type, content=content)
+    return message_from_dict(serialized_message)
+
+def insert_chat_messages(cursor, ChatID, messages, first_seq):
+    rows = [(ChatID, first_seq + i, *message_to_row(message)) for i, message in enumerate(messages)]
+    if rows:
+        cursor.executemany("""
+            INSERT INTO chat_messages (ChatID, Seq, Type, Content, Metadata)
+            VALUES (%s, %s, %s, %s, %s)
+        """, rows)
+
+class ChatVersionConflict(Exception):
+    """Raised when another writer has already stored messages at the sequence numbers being saved."""
+
 
-# Function to save chat history to MySQL
-def save_chat_history(ChatID, UserID, chat_history, chat_summary):
+# Function to save new chat messages to MySQL.
+# Messages are appended to chat_messages starting at sequence number first_seq (the number of
+# messages already stored), so a turn only writes its own messages instead of the whole history.
+# If another writer (e.g. another worker process) already used those sequence numbers the insert
+# hits the primary key and ChatVersionConflict is raised.
+# The summary is saved separately by save_chat_summary, after it has been generated.
+def append_chat_messages(ChatID, UserID, messages, first_seq):
     connection = get_mysql_connection()
     cursor = connection.cursor()
     
-    serialized_history = serialize_chat_history(chat_history)
-    
-    cursor.execute("""
-        INSERT INTO chat_data (ChatID, chat_history, chat_summary)
-        VALUES (%s, %s, %s)
-        ON DUPLICATE KEY UPDATE chat_history = %s, chat_summary = %s
-    """, (ChatID, serialized_history, chat_summary, serialized_history, chat_summary))
+    try:
+        try:
+            insert_chat_messages(cursor, ChatID, messages, first_seq)
+        except mysql.connector.IntegrityError:
+            raise ChatVersionConflict(f"ChatID {ChatID} already has messages from sequence number {first_seq}")
 
-    # Insert or update `User_chats` table
-    cursor.execute("""
-        INSERT INTO user_chats (ChatID, UserID, Timestamp)
-        VALUES (%s, %s, NOW())
-        ON DUPLICATE KEY UPDATE Timestamp = NOW()
-    """, (ChatID, UserID))
-    
-    connection.commit()
-    cursor.close()
-    connection.close()
+        # The chat's row holds its summary, see save_chat_summary
+        cursor.execute("""
+            INSERT INTO chat_data (ChatID)
+            VALUES (%s)
+            ON DUPLICATE KEY UPDATE ChatID = ChatID
+        """, (ChatID,))
 
-# Function to load chat history from MySQL
-def load_chat_history(ChatID):
+        # Insert or update `User_chats` table
+        cursor.execute("""
+            INSERT INTO user_chats (ChatID, UserID, Timestamp)
+            VALUES (%s, %s, NOW())
+            ON DUPLICATE KEY UPDATE Timestamp = NOW()
+        """, (ChatID, UserID))
+        
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+        connection.close()
+
+# Function to save the chat summary, once the chat's messages have been saved
+def save_chat_summary(ChatID, chat_summary):
     connection = get_mysql_connection()
     cursor = connection.cursor()
-    
-    cursor.execute("SELECT chat_history, chat_summary FROM chat_data WHERE ChatID = %s", (ChatID,))
-    result = cursor.fetchone()
-    
-    if result:
-        chat_history = deserialize_chat_history(result[0])
-        chat_summary = result[1]
+
+    try:
+        cursor.execute("UPDATE chat_data SET chat_summary = %s WHERE ChatID = %s", (chat_summary, ChatID))
+        connection.commit()
+    finally:
+        cursor.close()
+        connection.close()
+
+# Rewrites the metadata of a saved message, e.g. the recommended resources of an AI message that
+# was saved before they were fetched
+def update_chat_message(ChatID, seq, message):
+    connection = get_mysql_connection()
+    cursor = connection.cursor()
+
+    try:
+        cursor.execute("UPDATE chat_messages SET Metadata = %s WHERE ChatID = %s AND Seq = %s",
+                       (message_to_row(message)[2], ChatID, seq))
+        connection.commit()
+    finally:
+        cursor.close()
+        connection.close()
+
+# Reads a page of chat messages, oldest first. With before_seq only messages older than that
+# sequence number are read, and with limit only the newest `limit` of those.
+# Returns the messages and the sequence number of the first one.
+def select_chat_messages(cursor, ChatID, limit=None, before_seq=None):
+    query = "SELECT Seq, Type, Content, Metadata FROM chat_messages WHERE ChatID = %s"
+    params = [ChatID]
+    if before_seq is not None:
+        query += " AND Seq < %s"
+        params.append(before_seq)
+    query += " ORDER BY Seq DESC"
+    if limit is not None:
+        query += " LIMIT %s"
+        params.append(limit)
+
+    cursor.execute(query, tuple(params))
+    rows = cursor.fetchall()
+
+    if rows:
+        first_seq = rows[-1][0]
     else:
-        chat_history = []
-        chat_summary = ""
+        first_seq = before_seq if before_seq is not None else 0
+    return [message_from_row(*row[1:]) for row in reversed(rows)], first_seq
+
+# Number of messages in a chat, without loading them
+def count_chat_messages(ChatID):
+    connection = get_mysql_connection()
+    cursor = connection.cursor()
+
+    try:
+        cursor.execute("SELECT COUNT(*) FROM chat_messages WHERE ChatID = %s", (ChatID,))
+        return cursor.fetchone()[0]
+    finally:
+        cursor.close()
+        connection.close()
+
+# Moves a chat's history from the legacy chat_data.chat_history column into chat_messages.
+# db.sql has a statement that migrates every chat at once; this handles chats it hasn't reached.
+# Runs on the caller's connection, since taking a second one from the pool while holding the first
+# could leave every caller waiting for a connection when many legacy chats load at once.
+def migrate_chat_history(connection, ChatID):
+    cursor = connection.cursor()
+
+    try:
+        cursor.execute("SELECT chat_history FROM chat_data WHERE ChatID = %s FOR UPDATE", (ChatID,))
+        result = cursor.fetchone()
+        if result is None or result[0] is None:
+            connection.rollback()
+            return False
+
+        chat_history = deserialize_chat_history(result[0])
+        insert_chat_messages(cursor, ChatID, chat_history, 0)
+        cursor.execute("UPDATE chat_data SET chat_history = NULL WHERE ChatID = %s", (ChatID,))
+        connection.commit()
+    except mysql.connector.IntegrityError:
+        # Already migrated by another request
+        connection.rollback()
+        return False
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        cursor.close()
+
+    print(f"Migrated {len(chat_history)} messages of ChatID {ChatID} to chat_messages")
+    return True
+
+# Function to load chat history from MySQL, with the chat summary, the sequence number of the first
+# loaded message and the total number of messages in the chat. limit and before_seq select a page of
+# the history (see select_chat_messages).
+def load_chat_data(ChatID, limit=None, before_seq=None):
+    connection = get_mysql_connection()
+    cursor = connection.cursor()
     
-    cursor.close()
-    connection.close()
+    try:
+        query = """
+            SELECT chat_history IS NOT NULL, chat_summary,
+                (SELECT COUNT(*) FROM chat_messages WHERE ChatID = %s)
+            FROM chat_data WHERE ChatID = %s
+        """
+        cursor.execute(query, (ChatID, ChatID))
+        result = cursor.fetchone()
+
+        if result and result[0]:
+            # The migration commits (or rolls back), which also ends this connection's read snapshot
+            # so the migrated messages are visible
+            migrate_chat_history(connection, ChatID)
+            cursor.execute(query, (ChatID, ChatID))
+            result = cursor.fetchone()
+
+        if result:
+            chat_history, first_seq = select_chat_messages(cursor, ChatID, limit, before_seq)
+            chat_summary = result[1]
+            message_count = result[2]
+        else:
+            chat_history = []
+            first_seq = 0
+            chat_summary = ""
+            message_count = 0
+    finally:
+        cursor.close()
+        connection.close()
     
-    return chat_history, chat_summary
+    return {
+        "chat_history": chat_history,
+        "chat_summary": chat_summary,
+        "first_seq": first_seq,
+        "message_count": message_count
+    }
 
 
 def get_instruction(parameter):
@@ -154,6 +293,20 @@ def get_instruction(parameter):
     return result['instruction']
 
 
+# Returns every personalization instruction as {parameter: instruction}
+def get_all_instructions():
+    connection = get_mysql_connection()
+    cursor = connection.cursor(dictionary=True)
+
+    cursor.execute("SELECT parameter, instruction FROM Personalization_instructions")
+    result = cursor.fetchall()
+
+    cursor.close()
+    connection.close()
+
+    return {row['parameter']: row['instruction'] for row in result}
+
+
 def get_personalization_params(ChatID):
     # Connect to the MySQL database
     conn = get_mysql_connection()
@@ -319,6 +472,7 @@ def get_mentor_notes_by_course(studentid):
         cursor.execute(query_courses)
         courses = cursor.fetchall()
         cursor.close()
+        connection.close()
         
         for course in [row['course'] for row in courses]:
             notes_by_course[course] = "there are no available notes."
@@ -413,7 +567,7 @@ def update_user_role(userId, isAdmin):
         connection.close()
 
 
-# This function is to be used in chain.py to gt values for the course and subject attributes
+# Read once by Curriculum.py, which caches the courses and subjects for the chat chain
 def get_courses_and_subjects():
     # Establish a database connection
     connection = get_mysql_connection()
@@ -549,8 +703,9 @@ def delete_chat(chat_id):
         # Delete from `user_chats` table
         cursor.execute("DELETE FROM user_chats WHERE ChatID = %s", (chat_id,))
         
-        # Delete from `chat_data` table
+        # Delete from `chat_data` and `chat_messages` tables
         cursor.execute("DELETE FROM chat_data WHERE ChatID = %s", (chat_id,))
+        cursor.execute("DELETE FROM chat_messages WHERE ChatID = %s", (chat_id,))
         
         # Delete from `chat_info` table
         cursor.execute("DELETE FROM chat_info WHERE ChatID = %s", (chat_id,))
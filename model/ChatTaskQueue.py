@@ -0,0 +1,134 @@
+import asyncio
+import time
+from fastapi.concurrency import run_in_threadpool
+
+from Telemetry import current_trace, use_trace
+
+# Retry settings for post-response tasks
+MAX_RETRIES = 3
+RETRY_DELAY = 1.0  # seconds, doubled after every failed attempt
+
+
+class ChatTaskQueue:
+    """Runs work for a chat after its response has been sent.
+
+    Each chat gets its own FIFO queue and a long-lived worker task, so tasks for one chat always
+    run in the order they were submitted while different chats are processed concurrently.
+    Failed tasks are retried with exponential backoff, unless submitted with submit_once. Tasks
+    can be plain functions (run in the threadpool) or coroutine functions. Spans recorded by a
+    task are added to the trace of the chat turn that submitted it.
+
+    Tasks live in process memory and are best-effort: ones still queued when the process stops
+    are lost. Only work that can be lost is queued here (resources, title and summary), the turn's
+    messages are saved before the response is returned (see app.record_turn).
+    """
+
+    def __init__(self, max_retries=MAX_RETRIES, retry_delay=RETRY_DELAY):
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self._queues = {}
+        self._workers = {}
+        self._idle = {}
+        self._stats = {"submitted": 0, "completed": 0, "retried": 0, "failed": 0}
+
+    def submit(self, chat_id, func, *args, **kwargs):
+        """Queue a task for the chat. Returns a future that is done when the task has finished (or failed), see wait()."""
+        return self._put(chat_id, func, args, kwargs, self.max_retries)
+
+    def submit_once(self, chat_id, func, *args, **kwargs):
+        """Like submit, but the task isn't retried. For tasks with side effects that must not repeat, like sending a message."""
+        return self._put(chat_id, func, args, kwargs, 1)
+
+    def _put(self, chat_id, func, args, kwargs, attempts):
+        if chat_id not in self._queues:
+            self._queues[chat_id] = asyncio.Queue()
+            self._idle[chat_id] = asyncio.Event()
+
+        finished = asyncio.get_running_loop().create_future()
+        self._queues[chat_id].put_nowait((func, args, kwargs, attempts, current_trace(), finished))
+        self._stats["submitted"] += 1
+
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(self._worker(chat_id))
+        return finished
+
+    def pending(self, chat_id):
+        """Number of tasks queued for the chat that have not started yet."""
+        queue = self._queues.get(chat_id)
+        return queue.qsize() if queue else 0
+
+    def is_busy(self, chat_id):
+        return chat_id in self._workers
+
+    async def wait(self, task, timeout=None):
+        """Wait until `task`, as returned by submit, has finished, without waiting for the chat's other tasks."""
+        try:
+            await asyncio.wait_for(asyncio.shield(task), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def join(self, chat_id, timeout=None):
+        """Wait until every task submitted for the chat so far has finished."""
+        idle = self._idle.get(chat_id)
+        if idle is None or chat_id not in self._workers:
+            return True
+        try:
+            await asyncio.wait_for(idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def drain(self, timeout=None):
+        """Wait for all outstanding work. Used on shutdown so queued tasks aren't lost."""
+        workers = list(self._workers.values())
+        if workers:
+            print(f"Waiting for post-response tasks of {len(workers)} chats to finish")
+            await asyncio.wait(workers, timeout=timeout)
+
+    def stats(self):
+        return dict(self._stats, active_chats=len(self._workers),
+                    queued=sum(queue.qsize() for queue in self._queues.values()))
+
+    async def _worker(self, chat_id):
+        queue = self._queues[chat_id]
+        while True:
+            try:
+                func, args, kwargs, attempts, trace, finished = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                break
+            with use_trace(trace):
+                await self._run(chat_id, func, args, kwargs, attempts)
+            finished.set_result(None)
+
+        # Nothing is awaited between the empty check and the cleanup, so a task submitted
+        # concurrently will either be picked up above or start a new worker.
+        del self._workers[chat_id]
+        del self._queues[chat_id]
+        self._idle.pop(chat_id).set()
+
+    async def _run(self, chat_id, func, args, kwargs, attempts):
+        delay = self.retry_delay
+        for attempt in range(1, attempts + 1):
+            start = time.time()
+            try:
+                if asyncio.iscoroutinefunction(func):
+                    await func(*args, **kwargs)
+                else:
+                    await run_in_threadpool(func, *args, **kwargs)
+                self._stats["completed"] += 1
+                print(f"{func.__name__} for ChatID {chat_id} completed in {time.time() - start:.2f}s")
+                return
+            except Exception as e:
+                if attempt == attempts:
+                    self._stats["failed"] += 1
+                    print(f"Error: {func.__name__} for ChatID {chat_id} failed after {attempt} attempts: {e}")
+                    return
+                self._stats["retried"] += 1
+                print(f"{func.__name__} for ChatID {chat_id} failed (attempt {attempt}), retrying in {delay}s: {e}")
+                await asyncio.sleep(delay)
+                delay *= 2
+
+
+# Shared queue for post-response chat work (resources, title, summary)
+chat_tasks = ChatTaskQueue()
@@ -0,0 +1,74 @@
+import re
+import threading
+from fastapi.concurrency import run_in_threadpool
+
+from ChatStoreSQL import get_courses_and_subjects
+
+# Used when the Curriculum table can't be read
+DEFAULT_SUBJECTS = ["Programming", "Electronics", "Embedded Systems", "3D Design", "Manufacturing"]
+
+# Subjects outside the curriculum that documents and queries can also be tagged with. "Other" stays last.
+GENERAL_SUBJECTS = ["Miscellaneous", "Non-Technical", "Sports", "Business and Finance", "Other"]
+
+# Curriculum subjects whose documents are stored under a different subject in the knowledge base
+SUBJECT_ALIASES = {"Programming and Algorithms": "Programming"}
+
+
+# The curriculum lists each part of a subject ("Electronics - I", "Electronics - II") while the knowledge
+# base tags documents with the subject only ("Electronics"), the same values the upload page sends.
+def knowledge_base_subject(subject):
+    subject = re.sub(r"\s*-\s*[IVX]+$", "", " ".join(subject.split()))
+    return SUBJECT_ALIASES.get(subject, subject)
+
+
+class CurriculumCache:
+    """Courses and subjects from the Curriculum table, read once and kept until invalidated.
+
+    The knowledge base subjects drive the subject filter of the retrieval chain (see app.get_chain).
+    """
+
+    def __init__(self):
+        self._courses = None
+        self._subjects = None
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        data = get_courses_and_subjects()
+
+        # Remove duplicates and sort the lists for better readability
+        courses = sorted({entry["Course"] for entry in data})
+        subjects = sorted({knowledge_base_subject(entry["Subject"]) for entry in data})
+
+        with self._lock:
+            self._courses = courses
+            self._subjects = subjects
+
+        print("Courses:", ", ".join(courses))
+        print("Subjects:", ", ".join(subjects))
+
+    def invalidate(self):
+        with self._lock:
+            self._courses = None
+            self._subjects = None
+
+    async def get(self):
+        """Returns (courses, subjects). Loads the curriculum if it isn't cached."""
+        if self._subjects is None:
+            try:
+                await run_in_threadpool(self.refresh)
+            except Exception as e:
+                # Not cached, so the next call tries the database again
+                print(f"Error loading curriculum, using default subjects: {e}")
+                return [], DEFAULT_SUBJECTS
+
+        with self._lock:
+            return self._courses, self._subjects
+
+    async def filter_subjects(self):
+        """Every subject the retriever can filter on: the curriculum subjects followed by the general ones."""
+        _, subjects = await self.get()
+        return [subject for subject in subjects if subject not in GENERAL_SUBJECTS] + GENERAL_SUBJECTS
+
+
+# Shared curriculum used by the chat chain
+curriculum_cache = CurriculumCache()
@@ -0,0 +1,85 @@
+import os
+import time
+from langchain_core.embeddings import Embeddings
+
+# "torch" (sentence-transformers default), "onnx" (ONNX Runtime) or "onnx-int8" (int8 quantized ONNX model)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+# Texts per forward pass. Larger batches are faster on CPU up to the point where padding dominates.
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+# CPU threads used for inference, 0 for the library default (usually one per core)
+EMBEDDING_THREADS = int(os.getenv("EMBEDDING_THREADS", "0"))
+# Quantized model file used by the onnx-int8 backend. all-mpnet-base-v2 ships int8 exports for
+# several instruction sets, quint8_avx2 runs on any x86 CPU from the last decade.
+EMBEDDING_ONNX_INT8_FILE = os.getenv("EMBEDDING_ONNX_INT8_FILE", "onnx/model_quint8_avx2.onnx")
+
+BACKENDS = ["torch", "onnx", "onnx-int8"]
+
+# Log throughput for calls with at least this many texts (ingestion, not single queries)
+LOG_MIN_TEXTS = 100
+
+
+def load_model(model_name, backend, threads):
+    # Imported here because sentence-transformers pulls in torch and transformers
+    from sentence_transformers import SentenceTransformer
+
+    if backend == "torch":
+        if threads:
+            import torch
+            torch.set_num_threads(threads)
+        return SentenceTransformer(model_name, device="cpu")
+
+    if backend not in ("onnx", "onnx-int8"):
+        raise ValueError(f"Unknown embedding backend: {backend}")
+    try:
+        import onnxruntime
+    except ImportError:
+        raise ImportError(f'The {backend} embedding backend needs ONNX Runtime: pip install "optimum[onnxruntime]"')
+
+    session_options = onnxruntime.SessionOptions()
+    if threads:
+        session_options.intra_op_num_threads = threads
+    model_kwargs = {"provider": "CPUExecutionProvider", "session_options": session_options}
+    if backend == "onnx-int8":
+        model_kwargs["file_name"] = EMBEDDING_ONNX_INT8_FILE
+    return SentenceTransformer(model_name, device="cpu", backend="onnx", model_kwargs=model_kwargs)
+
+
+class EmbeddingService(Embeddings):
+    """Sentence-transformers embeddings tuned for CPU throughput.
+
+    Texts are sorted by length and embedded in batches of `batch_size`, so each batch holds texts of
+    similar length and little time goes into padding. The model can run on PyTorch or ONNX Runtime,
+    optionally int8 quantized, with a fixed number of threads. All backends run the same model, so
+    their vectors can be mixed in one index (the int8 ones differ slightly, see benchmarks/embeddings.py).
+    """
+
+    def __init__(self, model_name, backend=EMBEDDING_BACKEND, batch_size=EMBEDDING_BATCH_SIZE, threads=EMBEDDING_THREADS):
+        self.model_name = model_name
+        self.backend = backend
+        self.batch_size = batch_size
+        self.threads = threads
+        self.model = load_model(model_name, backend, threads)
+
+    def _encode(self, texts):
+        # Same preprocessing as langchain's HuggingFaceEmbeddings, which embedded the existing knowledge base
+        texts = [text.replace("\n", " ") for text in texts]
+        return self.model.encode(texts, batch_size=len(texts), show_progress_bar=False, convert_to_numpy=True)
+
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+        start = time.perf_counter()
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        embeddings = [None] * len(texts)
+        for offset in range(0, len(order), self.batch_size):
+            batch = order[offset:offset + self.batch_size]
+            for i, vector in zip(batch, self._encode([texts[i] for i in batch])):
+                embeddings[i] = vector.tolist()
+
+        if len(texts) >= LOG_MIN_TEXTS:
+            seconds = time.perf_counter() - start
+            print(f"Embedded {len(texts)} texts in {seconds:.2f}s ({len(texts) / seconds:.1f}/s, {self.backend})")
+        return embeddings
+
+    def embed_query(self, text):
+        return self._encode([text])[0].tolist()
@@ -1,16 +1,13 @@
 import os
-import shutil
+import io
 import mimetypes
-import time
 from pydub import AudioSegment
 from math import ceil
+import numpy as np
 import PIL.Image
-import pytesseract
 import fitz
 import cv2
-import base64
 from groq import Groq
-import google.generativeai as genai
 from dotenv import load_dotenv
 from langchain_community.document_loaders import (
     UnstructuredWordDocumentLoader,
@@ -28,43 +25,35 @@ from langchain_community.document_loaders import (
     UnstructuredXMLLoader
 )
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_chroma import Chroma
 from langchain.schema import Document
-from fastapi import BackgroundTasks
+
+from VectorStores import get_embeddings
+from Captioning import captioner
+from FrameSampler import sample_frames
 
 
 # Load environment variables from .env file
 load_dotenv()
 client = Groq(api_key=os.getenv('GROQ_API_KEY'))
-embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-mpnet-base-v2")
-chroma = Chroma(persist_directory="file_embeddings", embedding_function=embeddings)
 
-def clear_vector_db():
-    """Function to completely remove all embeddings from the vector database without deleting the collection."""
-    
-    # Get all documents and ensure they contain 'ids'
-    documents = chroma.get()
-    
-    # Ensure 'ids' exists and proceed with deletion
-    ids_to_delete = documents.get('ids', [])
-    
-    if ids_to_delete:
-        # Delete the documents based on the ids
-        chroma.delete(ids=ids_to_delete)
-        print(f"Cleared {len(ids_to_delete)} vectors from the database.")
-    else:
-        print("No documents found to delete.")
+# Chunks of an attached file passed to the model
+ATTACHMENT_TOP_K = 5
 
 
 def contents_reduce(contents, input_text):
-    if len(contents) <= 5:
+    """The ATTACHMENT_TOP_K chunks of `contents` most similar to `input_text`, most similar first.
+
+    Ranked in memory rather than through a shared vector store, so concurrent requests never see
+    each other's attachments.
+    """
+    if len(contents) <= ATTACHMENT_TOP_K:
         return contents
-    chroma.add_documents(contents)
-    query_embedding = embeddings.embed_query(input_text)
-    similar_vectors = chroma.similarity_search_by_vector(query_embedding, k=5)
-    
-    return similar_vectors
+    embeddings = get_embeddings()
+    vectors = np.asarray(embeddings.embed_documents([doc.page_content for doc in contents]), dtype=np.float32)
+    query_vector = np.asarray(embeddings.embed_query(input_text), dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(query_vector)
+    similarities = vectors @ query_vector / np.where(norms == 0, 1, norms)
+    return [contents[i] for i in np.argsort(-similarities)[:ATTACHMENT_TOP_K]]
 
 def create_documents(contents):
     documents = []
@@ -74,7 +63,7 @@ def create_documents(contents):
     
     return documents
 
-def process_file(file_path, input_text, background_tasks: BackgroundTasks):
+def process_file(file_path, input_text):
     # Get the file's MIME type to determine its format
     mime_type, _ = mimetypes.guess_type(file_path)
     filename = os.path.basename(file_path)
@@ -96,7 +85,6 @@ def process_file(file_path, input_text, background_tasks: BackgroundTasks):
         captions = contents_reduce(all_captions, input_text)
         all_documents = process_text_documents(file_path)
         documents = contents_reduce(all_documents, input_text)
-        background_tasks.add_task(clear_vector_db)
         return {"format": mime_type, "filename": filename, "documents": documents, "image-captions": captions}
     
     # Check for video files (e.g., mp4)
@@ -104,7 +92,6 @@ def process_file(file_path, input_text, background_tasks: BackgroundTasks):
         all_captions = process_video(file_path)
         captions = contents_reduce(all_captions, input_text)
         transcript = transcribe_audio(file_path)
-        background_tasks.add_task(clear_vector_db)
         return {"format": mime_type, "filename": filename, "transcription": transcript, "captions": captions}
     
     # Check for text files or documents
@@ -113,7 +100,6 @@ def process_file(file_path, input_text, background_tasks: BackgroundTasks):
                         'application/vnd.ms-powerpoint', 'application/vnd.openxmlformats-officedocument.presentationml.presentation', 'text/x-python', 'text/plain']:
         all_documents = process_text_documents(file_path)
         documents = contents_reduce(all_documents, input_text)
-        background_tasks.add_task(clear_vector_db)
         return {"format": mime_type, "filename": filename, "documents": documents}
 
     else:
@@ -192,293 +178,66 @@ def transcribe_large_audio(file_path, file_size):
 
 ######################### IMAGE PROCESSING ##########################
 def extract_info_from_image(image_path):
-    img = PIL.Image.open(image_path)
-
-    # Extract text from the image using pytesseract
-    initial_caption = pytesseract.image_to_string(img).strip()
-    
-    # with open(image_path, "rb") as image_file:
-    #     img1 = base64.b64encode(image_file.read()).decode('utf-8')
-    
-    # chat_completion = client.chat.completions.create(
-    #     messages=[
-    #         {
-    #             "role": "user",
-    #             "content": [
-    #                 {"type": "text", "text": "What is in this image?"},
-    #                 {
-    #                     "type": "image_url",
-    #                     "image_url": {
-    #                         "url": f"data:image/jpeg;base64,{img1}",
-    #                     },
-    #                 },
-    #             ],
-    #         }
-    #     ],
-    #     model="llama-3.2-11b-vision-preview",
-    # )
-    
-    # another_caption = chat_completion.choices[0].message.content
-    
-    genai.configure(api_key=os.getenv('GOOGLE_API_KEY'))
-    model = genai.GenerativeModel('gemini-1.5-flash')
-    response = model.generate_content(img)
-    model_caption = response.text.strip()
-    
-    combined_caption = (f"Caption by pytesseract:\n{initial_caption}\n\n"
-                        f"Caption by model:\n{model_caption}")
-    
-    return combined_caption
+    # OCR text and a vision model caption, sharing the rate limits with the ingestion jobs
+    return captioner.caption_image(image_path)
 
 ######################### PDF PROCESSING ############################
-def extract_images_from_pdf(pdf_path, output_dir):
+def extract_images_from_pdf(pdf_path):
+    """Yields (image name, PIL image) for every image embedded in the PDF, decoded in memory."""
     # Open the PDF file
     pdf_document = fitz.open(pdf_path)
 
-    # Ensure the output directory exists
-    os.makedirs(output_dir, exist_ok=True)
-
     # Extract the PDF's base name without the extension
     pdf_name = os.path.splitext(os.path.basename(pdf_path))[0]
 
-    # Iterate through each page in the PDF
-    for page_number in range(len(pdf_document)):
-        page = pdf_document.load_page(page_number)
-        images = page.get_images(full=True)
+    try:
+        # Iterate through each page in the PDF
+        for page_number in range(len(pdf_document)):
+            page = pdf_document.load_page(page_number)
+            images = page.get_images(full=True)
 
-        for img_index, img in enumerate(images):
-            xref = img[0]
-            base_image = pdf_document.extract_image(xref)
-            image_bytes = base_image["image"]
-            image_ext = base_image["ext"]
-            image_filename = f"{pdf_name}.pdf_{page_number+1}_img_{img_index+1}.{image_ext}"
+            for img_index, img in enumerate(images):
+                xref = img[0]
+                base_image = pdf_document.extract_image(xref)
+                image_filename = f"{pdf_name}.pdf_{page_number+1}_img_{img_index+1}.{base_image['ext']}"
+                yield image_filename, PIL.Image.open(io.BytesIO(base_image["image"]))
+    finally:
+        pdf_document.close()
 
-            # Save the extracted image to the output directory
-            with open(os.path.join(output_dir, image_filename), "wb") as img_file:
-                img_file.write(image_bytes)
 
-    pdf_document.close()
+def generate_captions_for_images(images):
+    # `images` yields (name, PIL image). Captioned concurrently within the vision providers' rate limits, in the same order.
+    names = []
 
+    def collect():
+        for name, img in images:
+            names.append(name)
+            yield img
 
-def generate_captions_for_images(output_dir):
-    genai.configure(api_key=os.getenv('GOOGLE_API_KEY'))
-    gemini_model = genai.GenerativeModel('gemini-1.5-flash')
-
-    captions = []
-    gemini_counter = 0
-    gemini_tpm_limit = 14  # Gemini model's 15 TPM limit
-    timer_duration = 60  # 1 minute
-    timer_start = time.time()
-    
-    def reset_gemini_counter():
-        nonlocal gemini_counter
-        gemini_counter = 0
-        print("Gemini counter reset. You can now process another 15 images with Gemini.")
-    
-    
-    # Iterate through each image file in the output directory
-    for image_filename in sorted(os.listdir(output_dir)):
-        image_path = os.path.join(output_dir, image_filename)
-
-        # Ensure it's a file (not a subdirectory) and an image
-        if os.path.isfile(image_path) and image_filename.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp')):
-            img = PIL.Image.open(image_path)
-            initial_caption = pytesseract.image_to_string(img).strip()
-            
-            if gemini_counter < gemini_tpm_limit:
-                # If the Gemini model can still process images
-                response = gemini_model.generate_content(img)
-                model_caption = response.text.strip()
-                gemini_counter += 1
-
-                combined_caption = (f"Caption by pytesseract:\n{initial_caption}\n\n"
-                                    f"Caption by model:\n{model_caption}")
-
-                print(f"Gemini processed {gemini_counter} images.")
-            else:
-                # If Gemini reaches the cap, switch to Llama
-                print("Gemini model limit reached. Switching to Llama model.")
-                
-                # Convert image to base64 to pass to Llama
-                with open(image_path, "rb") as image_file:
-                    img_base64 = base64.b64encode(image_file.read()).decode('utf-8')
-
-                chat_completion = client.chat.completions.create(
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": [
-                                {"type": "text", "text": "What is in this image?"},
-                                {
-                                    "type": "image_url",
-                                    "image_url": {
-                                        "url": f"data:image/jpeg;base64,{img_base64}",
-                                    },
-                                },
-                            ],
-                        }
-                    ],
-                    model="llama-3.2-11b-vision-preview",
-                )
-                
-                llama_caption = chat_completion.choices[0].message.content
-                combined_caption = (f"Caption by pytesseract:\n{initial_caption}\n\n"
-                                    f"Caption by model:\n{llama_caption}")
-
-            # Store the caption along with image reference
-            captions.append((image_filename, combined_caption))
-
-            # Check if the timer has reached one minute and reset the Gemini counter
-            if time.time() - timer_start >= timer_duration:
-                reset_gemini_counter()
-                timer_start = time.time()  # Reset the timer start
-                
-    return captions
+    captions = captioner.caption_images(collect())
+    return dict(zip(names, captions))
 
 
 def process_pdf(pdf_path):
-    output_dir = "extracted_images"
-    extract_images_from_pdf(pdf_path, output_dir)
-    captions = generate_captions_for_images(output_dir)
-    documents = create_documents(captions)
-
-    # Clean up the output directory. This directory was created to store the extracted images
-    if os.path.exists(output_dir):
-        shutil.rmtree(output_dir)
-    return documents
+    # The images go straight from the PDF to the captioner, nothing is written to disk
+    captions = generate_captions_for_images(extract_images_from_pdf(pdf_path))
+    return create_documents(captions)
 
 ######################### VIDEO PROCESSING ##########################
-def extract_frames_from_video(video_path, output_dir, desired_fps=None):
-    # Open the video file
-    video_capture = cv2.VideoCapture(video_path)
-
-    # Get the original FPS of the video
-    original_fps = video_capture.get(cv2.CAP_PROP_FPS)
-
-    # Calculate the exact number of frames to skip to match the desired FPS
-    frame_interval = original_fps / desired_fps if desired_fps else 1
-
-    # Ensure the output directory exists
-    os.makedirs(output_dir, exist_ok=True)
-
+def extract_frames_from_video(video_path, desired_fps=None):
+    """Yields (frame name, PIL image) for the frames where the scene or slide changes, decoded in memory."""
     # Extract the video filename without extension
     video_filename = os.path.splitext(os.path.basename(video_path))[0]
 
-    frame_count = 0
-    extracted_count = 0  
-    while True:
-        # Read the next frame
-        ret, frame = video_capture.read()
-        if not ret:
-            break
-
-        # Calculate timestamp for the current frame
-        timestamp = frame_count / original_fps  # in seconds
-
-        # Extract frame based on the interval
-        if frame_count >= extracted_count * frame_interval:
-            # Convert frame to RGB (PIL expects RGB images)
-            frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-
-            # Convert to PIL Image
-            img = PIL.Image.fromarray(frame_rgb)
-
-            # Save the frame as an image file with the desired format
-            frame_filename = f"{video_filename}_time_{timestamp:.2f}_frame_{extracted_count:04d}.png"
-            img.save(os.path.join(output_dir, frame_filename))
-            extracted_count += 1
-
-        frame_count += 1
-
-    video_capture.release()
-    print(f"Extracted {extracted_count} frames from {video_path} at {desired_fps or original_fps} FPS")
-
-
-def transcribe_frames(input_dir):
-    genai.configure(api_key=os.getenv('GOOGLE_API_KEY'))
-    gemini_model = genai.GenerativeModel('gemini-1.5-flash')
-
-    transcriptions = {}
-    gemini_counter = 0
-    gemini_tpm_limit = 14  # Gemini model's 15 TPM limit
-    timer_duration = 60  # 1 minute
-    timer_start = time.time()
-    
-    def reset_gemini_counter():
-        nonlocal gemini_counter
-        gemini_counter = 0
-        print("Gemini counter reset. You can now process another 15 images with Gemini.")
-
-    # Iterate over all image files in the directory
-    for filename in sorted(os.listdir(input_dir)):
-        if filename.endswith(".png"):
-            file_path = os.path.join(input_dir, filename)
-
-            # Open the image
-            img = PIL.Image.open(file_path)
-            initial_caption = pytesseract.image_to_string(img).strip()
-
-            if gemini_counter < gemini_tpm_limit:
-                # If the Gemini model can still process images
-                response = gemini_model.generate_content(img)
-                model_caption = response.text.strip()
-                gemini_counter += 1
-
-                combined_caption = (f"Caption by pytesseract:\n{initial_caption}\n\n"
-                                    f"Caption by model:\n{model_caption}")
-
-                print(f"Gemini processed {gemini_counter} images.")
-            else:
-                # If Gemini reaches the cap, switch to Llama
-                print("Gemini model limit reached. Switching to Llama model.")
-                
-                # Convert image to base64 to pass to Llama
-                with open(file_path, "rb") as image_file:
-                    img_base64 = base64.b64encode(image_file.read()).decode('utf-8')
-
-                chat_completion = client.chat.completions.create(
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": [
-                                {"type": "text", "text": "What is in this image?"},
-                                {
-                                    "type": "image_url",
-                                    "image_url": {
-                                        "url": f"data:image/jpeg;base64,{img_base64}",
-                                    },
-                                },
-                            ],
-                        }
-                    ],
-                    model="llama-3.2-11b-vision-preview",
-                )
-                
-                llama_caption = chat_completion.choices[0].message.content
-                combined_caption = (f"Caption by pytesseract:\n{initial_caption}\n\n"
-                                    f"Caption by model:\n{llama_caption}")
-
-            # Store the transcription
-            transcriptions[filename] = combined_caption
-            
-            # Check if the timer has reached one minute and reset the Gemini counter
-            if time.time() - timer_start >= timer_duration:
-                reset_gemini_counter()
-                timer_start = time.time()  # Reset the timer start
-    
-    return transcriptions
+    for extracted_count, (timestamp, frame) in enumerate(sample_frames(video_path, desired_fps)):
+        # Convert frame to RGB (PIL expects RGB images)
+        frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        yield f"{video_filename}_time_{timestamp:.2f}_frame_{extracted_count:04d}", PIL.Image.fromarray(frame_rgb)
 
 
 def process_video(video_path):
-    output_dir = "extracted_frames"
-    extract_frames_from_video(video_path, output_dir, desired_fps=1)
-    transcriptions = transcribe_frames(output_dir)
-    documents = create_documents(transcriptions)
-    
-    # Clean up the output directory. This directory was created to store the extracted frames/images
-    if os.path.exists(output_dir):
-        shutil.rmtree(output_dir)
-    return documents
+    transcriptions = generate_captions_for_images(extract_frames_from_video(video_path, desired_fps=1))
+    return create_documents(transcriptions)
 
 
 ######################### TEXT DOCUMENT PROCESSING ##################
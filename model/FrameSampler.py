@@ -0,0 +1,81 @@
+import os
+import cv2 # type: ignore
+import numpy as np
+
+# A candidate frame is kept when it differs from the last kept frame by more than either threshold:
+# the fraction of differing bits of their 256-bit difference hashes, or the Bhattacharyya distance
+# of their grayscale histograms. Lower values keep more frames.
+FRAME_CHANGE_THRESHOLD = float(os.getenv("FRAME_CHANGE_THRESHOLD", "0.08"))
+FRAME_HISTOGRAM_THRESHOLD = float(os.getenv("FRAME_HISTOGRAM_THRESHOLD", "0.2"))
+# Minimum seconds between kept frames
+FRAME_MIN_INTERVAL = float(os.getenv("FRAME_MIN_INTERVAL", "2"))
+# Maximum frames kept per video. Long videos get a longer minimum interval so the frames cover all of it.
+FRAME_MAX_PER_VIDEO = int(os.getenv("FRAME_MAX_PER_VIDEO", "150"))
+
+# Size of the thumbnail the signatures are computed on
+THUMBNAIL_SIZE = (160, 90)
+
+
+def frame_signature(frame):
+    """Difference hash (16x16 bits) and normalized 64-bin histogram of a BGR frame."""
+    gray = cv2.resize(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY), THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA)
+    small = cv2.resize(gray, (17, 16), interpolation=cv2.INTER_AREA)
+    dhash = small[:, 1:] > small[:, :-1]
+    histogram = cv2.calcHist([gray], [0], None, [64], [0, 256])
+    cv2.normalize(histogram, histogram)
+    return dhash, histogram
+
+
+def is_scene_change(signature, previous):
+    if previous is None:
+        return True
+    hash_distance = np.count_nonzero(signature[0] != previous[0]) / signature[0].size
+    histogram_distance = cv2.compareHist(signature[1], previous[1], cv2.HISTCMP_BHATTACHARYYA)
+    return hash_distance > FRAME_CHANGE_THRESHOLD or histogram_distance > FRAME_HISTOGRAM_THRESHOLD
+
+
+def sample_frames(video_path, desired_fps=None, min_interval=FRAME_MIN_INTERVAL, max_frames=FRAME_MAX_PER_VIDEO):
+    """Yields (timestamp in seconds, BGR frame) for every scene or slide change in the video.
+
+    Candidates are taken `desired_fps` times per second (every frame if None) and kept if they
+    differ enough from the last kept frame and at least `min_interval` seconds have passed since.
+    All other frames are only grabbed, never converted to images, which is where most of the
+    decoding time went.
+    """
+    video_capture = cv2.VideoCapture(video_path)
+    candidates = 0
+    kept = 0
+    try:
+        original_fps = video_capture.get(cv2.CAP_PROP_FPS)
+        # Exact number of frames between candidates
+        frame_interval = original_fps / desired_fps if desired_fps else 1
+
+        total_frames = video_capture.get(cv2.CAP_PROP_FRAME_COUNT)
+        if max_frames and total_frames > 0:
+            min_interval = max(min_interval, total_frames / original_fps / max_frames)
+
+        frame_count = 0
+        next_candidate = 0.0
+        last_kept = None
+        previous = None
+        while video_capture.grab():
+            timestamp = frame_count / original_fps  # in seconds
+            if frame_count >= next_candidate:
+                next_candidate += frame_interval
+                candidates += 1
+                if last_kept is None or timestamp - last_kept >= min_interval:
+                    ret, frame = video_capture.retrieve()
+                    if ret:
+                        signature = frame_signature(frame)
+                        if is_scene_change(signature, previous):
+                            yield timestamp, frame
+                            previous = signature
+                            last_kept = timestamp
+                            kept += 1
+                            if max_frames and kept >= max_frames:
+                                break
+            frame_count += 1
+    finally:
+        # Also runs when the caller stops iterating early
+        video_capture.release()
+        print(f"Kept {kept} of {candidates} candidate frames from {video_path} (at least {min_interval:.1f}s apart)")
@@ -0,0 +1,67 @@
+from pydantic import BaseModel, Field
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.runnables import RunnableLambda
+
+from Telemetry import span
+
+
+class RetrievalQuery(BaseModel):
+    """Search query and subject filter for the knowledge base."""
+
+    search_query: str = Field(description="Concise, specific search query of about 15-20 words that captures the core information need")
+    subject: str = Field(description="The single most relevant subject, exactly as written in the list of options")
+
+
+# options is the formatted list of subjects shown to the model
+def create_query_prompt(options):
+    return ChatPromptTemplate.from_messages([
+        MessagesPlaceholder(variable_name="chat_history", optional=True),
+        ("human", "{input}"),
+        ("human",
+            f"""Based on the conversation above and the user's latest query, generate a focused search query and the subject to filter on. Follow these steps:
+
+            1. Analyze the user's latest query and identify the main topic or concept.
+            2. Consider any relevant context from the chat history, but prioritize the latest query.
+            3. Formulate a concise, specific search query that captures the core information need. Keep it to about 15-20 words.
+            4. Determine the most relevant subject for filtering from the following options:
+            {options}
+
+            Ensure your search query is detailed enough to yield relevant results but not so specific that it might miss valuable information."""
+        )
+    ])
+
+
+def match_subject(subject, subjects):
+    # Models sometimes change the capitalization. Unknown subjects are kept, and match no documents.
+    subject = subject.strip().strip("'\"")
+    for option in subjects:
+        if option.lower() == subject.lower():
+            return option
+    return subject
+
+
+def create_fused_retriever(model, vectorStore, subjects, options, k=5):
+    """Retriever that rewrites the query and chooses the subject filter in a single LLM call.
+
+    Replaces the history aware retriever + SelfQueryRetriever pair, which makes one LLM call to
+    rewrite the query and another to turn the rewrite into a structured query. The structured
+    output is used to search the vector store directly. Takes the same {"input", "chat_history"}
+    input as the history aware retriever, so it can be passed to create_retrieval_chain.
+    """
+    # Tagged like the query rewrite of the self query retriever, which this call replaces
+    query_builder = create_query_prompt(options) | model.with_structured_output(RetrievalQuery).with_config(tags=["query_rewrite"])
+
+    def search_kwargs(query):
+        return {"k": k, "filter": {"subject": match_subject(query.subject, subjects)}}
+
+    def retrieve(inputs, config):
+        query = query_builder.invoke(inputs, config)
+        with span("vector_search"):
+            return vectorStore.similarity_search(query.search_query, **search_kwargs(query))
+
+    async def aretrieve(inputs, config):
+        query = await query_builder.ainvoke(inputs, config)
+        with span("vector_search"):
+            return await vectorStore.asimilarity_search(query.search_query, **search_kwargs(query))
+
+    return RunnableLambda(retrieve, afunc=aretrieve, name="fused_retriever")
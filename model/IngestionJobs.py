@@ -0,0 +1,448 @@
+import json
+import os
+import queue
+import shutil
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from langchain_core.documents import Document
+
+from ResponseCache import response_cache
+from SubjectClassifier import invalidate_query_constructors
+from VectorStores import get_vectorstore, KNOWLEDGE_BASE_DIR
+
+INGESTION_DB = os.getenv("INGESTION_DB", "ingestion_jobs.db")
+# Uploaded files and intermediate results, kept until their job has finished so it can resume after a restart
+INGESTION_DIR = os.getenv("INGESTION_DIR", "uploads/jobs")
+# Jobs processed at the same time. Workers are dedicated threads, not the threadpool serving chat requests.
+INGESTION_WORKERS = int(os.getenv("INGESTION_WORKERS", "1"))
+# Seconds a running job stays claimed by its worker without a heartbeat. After that another server
+# process (or this one after a restart) takes it over. Heartbeats are sent every third of this.
+INGESTION_LEASE_SECONDS = float(os.getenv("INGESTION_LEASE_SECONDS", "60"))
+# Added to the nice value of the worker threads, so the OS runs chat requests first when the CPU is busy (Linux only)
+INGESTION_NICE = int(os.getenv("INGESTION_NICE", "10"))
+
+# Same file types as the upload endpoint handled before, files in both audio and video lists are transcribed and their frames captioned
+AUDIO_EXTENSIONS = (".m4a", ".mp3", ".webm", ".wav", ".mpeg", ".ogg", ".opus", ".flac", ".mp4")
+VIDEO_EXTENSIONS = (".mp4", ".avi", ".mov", ".mkv", ".webm", ".mpeg", ".ogg")
+TEXT_EXTENSIONS = (".docx", ".txt", ".html", ".md", ".epub", ".pptx", ".csv", ".xlsx", ".ipynb", ".py", ".xml")
+
+# Frames extracted per second of video
+VIDEO_FRAME_RATE = 1
+
+ACTIVE = ("pending", "running")
+
+
+def file_stages(file_name):
+    """The stages a file goes through, in order. Files of unsupported types have none."""
+    stages = []
+    if file_name.endswith(AUDIO_EXTENSIONS):
+        stages.append("transcribe")
+    if file_name.endswith(".pdf"):
+        stages.append("caption_pages")
+    if file_name.endswith(VIDEO_EXTENSIONS):
+        stages.append("caption_frames")
+    if file_name.endswith(TEXT_EXTENSIONS):
+        stages.append("load_text")
+    return stages + ["embed"] if stages else []
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobLost(Exception):
+    """Raised when another worker took over a job whose lease had expired."""
+
+
+class IngestionJobs:
+    """Durable queue of upload jobs, processed by background worker threads.
+
+    A job is the set of files from one upload. Each file goes through its stages (transcription, PDF
+    page or video frame captioning, text loading and finally embedding into the knowledge base)
+    and every stage's status and item counts are stored in SQLite, along with the documents it
+    produced. Jobs interrupted by a restart are picked up again by start(), each file continuing with
+    its first unfinished stage. Cancelling a job stops it at the next stage or image, files that were
+    already embedded stay in the knowledge base.
+
+    Several server processes can share the database. A worker claims a job by recording itself as
+    its owner, and keeps a heartbeat while the job runs. A running job is only taken over by another
+    worker once its heartbeat is older than `lease` seconds, i.e. its worker has stopped.
+    """
+
+    def __init__(self, path, directory, workers, nice, lease, images_dir):
+        self.path = path
+        self.directory = directory
+        self.workers = workers
+        self.nice = nice
+        self.lease = lease
+        self.images_dir = images_dir
+        # Identifies this process's workers in the jobs table
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._connection = None
+        self._queue = queue.Queue()
+        self._queued = set()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._stats = {"submitted": 0, "resumed": 0, "completed": 0, "failed": 0, "cancelled": 0}
+
+    def _connect(self):
+        # Opened on first use. All access goes through self._lock, so one connection is shared by every thread.
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.row_factory = sqlite3.Row
+            self._connection.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    subject TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    started REAL,
+                    finished REAL,
+                    owner TEXT,
+                    heartbeat REAL
+                );
+                CREATE TABLE IF NOT EXISTS job_files (
+                    job_id TEXT NOT NULL,
+                    file_id INTEGER NOT NULL,
+                    file_name TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    error TEXT,
+                    PRIMARY KEY (job_id, file_id)
+                );
+                CREATE TABLE IF NOT EXISTS job_stages (
+                    job_id TEXT NOT NULL,
+                    file_id INTEGER NOT NULL,
+                    stage TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    status TEXT NOT NULL,
+                    done INTEGER NOT NULL DEFAULT 0,
+                    total INTEGER,
+                    seconds REAL,
+                    PRIMARY KEY (job_id, file_id, stage)
+                );
+                CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+            """)
+            # Databases created before jobs had owners
+            columns = [row["name"] for row in self._connection.execute("PRAGMA table_info(jobs)")]
+            for column, column_type in (("owner", "TEXT"), ("heartbeat", "REAL")):
+                if column not in columns:
+                    self._connection.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+            self._connection.commit()
+        return self._connection
+
+    def _execute(self, sql, params=()):
+        # Returns the number of rows changed
+        with self._lock:
+            connection = self._connect()
+            rowcount = connection.execute(sql, params).rowcount
+            connection.commit()
+            return rowcount
+
+    def _fetch(self, sql, params=()):
+        with self._lock:
+            return [dict(row) for row in self._connect().execute(sql, params)]
+
+    def start(self):
+        """Start the workers and queue the pending jobs and the running jobs whose worker has stopped."""
+        if self._threads:
+            return
+        pending = self._fetch("SELECT id FROM jobs WHERE status = 'pending' ORDER BY created")
+        for job in pending:
+            self._put(job["id"])
+        resumed = self._resume_expired()
+        if pending or resumed:
+            print(f"Queued {len(pending)} pending and {resumed} interrupted ingestion jobs")
+
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"ingestion-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        thread = threading.Thread(target=self._heartbeat, name="ingestion-heartbeat", daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def _put(self, job_id):
+        with self._lock:
+            if job_id in self._queued:
+                return False
+            self._queued.add(job_id)
+        self._queue.put(job_id)
+        return True
+
+    def _resume_expired(self):
+        # Running jobs whose worker stopped sending heartbeats (a crash, or another process that was stopped)
+        expired = self._fetch("SELECT id FROM jobs WHERE status = 'running' AND (heartbeat IS NULL OR heartbeat < ?) ORDER BY created",
+                              (time.time() - self.lease,))
+        resumed = sum(self._put(job["id"]) for job in expired)
+        self._stats["resumed"] += resumed
+        return resumed
+
+    def _heartbeat(self):
+        while True:
+            time.sleep(self.lease / 3)
+            try:
+                self._execute("UPDATE jobs SET heartbeat = ? WHERE owner = ? AND status = 'running'", (time.time(), self.owner))
+                self._resume_expired()
+            except Exception as e:
+                print(f"Error: ingestion job heartbeat failed: {e}")
+
+    def submit(self, subject, files):
+        """Queue a job for `files`, a list of (lecture material id, file name, content). Returns the job id."""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+
+        # The files are written before the job is committed, so a queued job always has its files
+        rows, stages = [], []
+        for file_id, file_name, content in files:
+            source_dir = os.path.join(self.directory, job_id, str(file_id), "source")
+            os.makedirs(source_dir, exist_ok=True)
+            with open(os.path.join(source_dir, f"{file_id}-{file_name}"), "wb") as f:
+                f.write(content)
+
+            names = file_stages(file_name)
+            rows.append((job_id, file_id, file_name, "pending" if names else "skipped"))
+            stages += [(job_id, file_id, name, position, "pending") for position, name in enumerate(names)]
+
+        with self._lock:
+            connection = self._connect()
+            connection.execute("INSERT INTO jobs (id, subject, status, created) VALUES (?, ?, 'pending', ?)", (job_id, subject, now))
+            connection.executemany("INSERT INTO job_files (job_id, file_id, file_name, status) VALUES (?, ?, ?, ?)", rows)
+            connection.executemany("INSERT INTO job_stages (job_id, file_id, stage, position, status) VALUES (?, ?, ?, ?, ?)", stages)
+            connection.commit()
+
+        self._put(job_id)
+        self._stats["submitted"] += 1
+        print(f"Queued ingestion job {job_id} ({len(files)} files, {self._queue.qsize()} jobs waiting)")
+        return job_id
+
+    def cancel(self, job_id):
+        """Cancel a pending or running job. Returns its status, or None if there is no such job."""
+        with self._lock:
+            connection = self._connect()
+            row = connection.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            if row["status"] not in ACTIVE:
+                return row["status"]
+            connection.execute("UPDATE jobs SET status = 'cancelled', finished = ? WHERE id = ?", (time.time(), job_id))
+            connection.commit()
+        self._stats["cancelled"] += 1
+        print(f"Cancelled ingestion job {job_id}")
+        return "cancelled"
+
+    def get(self, job_id):
+        """Status of a job with its files and their stages (done and total items per stage)."""
+        jobs = self._fetch("SELECT * FROM jobs WHERE id = ?", (job_id,))
+        if not jobs:
+            return None
+        job = jobs[0]
+
+        files = self._fetch("SELECT file_id, file_name, status, error FROM job_files WHERE job_id = ? ORDER BY file_id", (job_id,))
+        stages = self._fetch("SELECT file_id, stage, status, done, total, seconds FROM job_stages WHERE job_id = ? ORDER BY file_id, position", (job_id,))
+        for file in files:
+            file["stages"] = [{key: stage[key] for key in ("stage", "status", "done", "total", "seconds")}
+                              for stage in stages if stage["file_id"] == file["file_id"]]
+
+        counts = {}
+        for file in files:
+            counts[file["status"]] = counts.get(file["status"], 0) + 1
+        job["files"] = files
+        job["file_counts"] = counts
+        return job
+
+    def recent(self, limit=20):
+        return self._fetch("SELECT * FROM jobs ORDER BY created DESC LIMIT ?", (limit,))
+
+    def stats(self):
+        running = self._fetch("SELECT COUNT(*) AS count FROM jobs WHERE status = 'running'")[0]["count"]
+        return dict(self._stats, queued=self._queue.qsize(), running=running)
+
+    def _worker(self):
+        self._lower_priority()
+        while True:
+            job_id = self._queue.get()
+            with self._lock:
+                self._queued.discard(job_id)
+            try:
+                self._run_job(job_id)
+            except JobLost:
+                print(f"Ingestion job {job_id} was taken over by another worker, stopped")
+            except Exception as e:
+                print(f"Error: ingestion job {job_id} stopped: {e}")
+
+    def _lower_priority(self):
+        # On Linux the nice value is per thread, so this only affects the worker
+        if not self.nice or not sys.platform.startswith("linux"):
+            return
+        try:
+            thread_id = threading.get_native_id()
+            os.setpriority(os.PRIO_PROCESS, thread_id, os.getpriority(os.PRIO_PROCESS, thread_id) + self.nice)
+        except OSError as e:
+            print(f"Could not lower the priority of the ingestion worker: {e}")
+
+    def _check_cancelled(self, job_id):
+        # Read from the database, since the cancel request may have been handled by another server process
+        jobs = self._fetch("SELECT status, owner FROM jobs WHERE id = ?", (job_id,))
+        if not jobs or jobs[0]["status"] not in ACTIVE:
+            raise JobCancelled()
+        if jobs[0]["owner"] != self.owner:
+            raise JobLost()
+
+    def _run_job(self, job_id):
+        jobs = self._fetch("SELECT * FROM jobs WHERE id = ?", (job_id,))
+        if not jobs or jobs[0]["status"] not in ACTIVE:
+            # Cancelled while it was waiting
+            shutil.rmtree(os.path.join(self.directory, job_id), ignore_errors=True)
+            return
+        job = jobs[0]
+        # Claimed if it is still pending, or running with an expired lease. Not if it was cancelled
+        # since it was read, or another worker claimed it first.
+        now = time.time()
+        claimed = self._execute("""
+            UPDATE jobs SET status = 'running', owner = ?, heartbeat = ?, started = COALESCE(started, ?)
+            WHERE id = ? AND (status = 'pending' OR (status = 'running' AND (heartbeat IS NULL OR heartbeat < ?)))
+        """, (self.owner, now, now, job_id, now - self.lease))
+        if not claimed:
+            if self._fetch("SELECT status FROM jobs WHERE id = ?", (job_id,))[0]["status"] not in ACTIVE:
+                shutil.rmtree(os.path.join(self.directory, job_id), ignore_errors=True)
+            return
+        start = time.time()
+
+        files = self._fetch("SELECT * FROM job_files WHERE job_id = ? AND status IN (?, ?) ORDER BY file_id", (job_id, *ACTIVE))
+        cancelled = False
+        for file in files:
+            try:
+                self._run_file(job, file)
+            except JobCancelled:
+                self._execute("UPDATE job_files SET status = 'cancelled' WHERE job_id = ? AND status IN (?, ?)", (job_id, *ACTIVE))
+                self._execute("UPDATE job_stages SET status = 'cancelled' WHERE job_id = ? AND status IN (?, ?)", (job_id, *ACTIVE))
+                cancelled = True
+                break
+            except JobLost:
+                raise
+            except Exception as e:
+                print(f"Error: ingestion of {file['file_name']} (job {job_id}) failed: {e}")
+                self._execute("UPDATE job_files SET status = 'failed', error = ? WHERE job_id = ? AND file_id = ?", (str(e), job_id, file["file_id"]))
+                self._execute("UPDATE job_stages SET status = 'failed' WHERE job_id = ? AND file_id = ? AND status = 'running'", (job_id, file["file_id"]))
+
+        if not cancelled:
+            failed = self._fetch("SELECT COUNT(*) AS count FROM job_files WHERE job_id = ? AND status = 'failed'", (job_id,))[0]["count"]
+            status = "failed" if failed else "done"
+            # Unless it was cancelled while its last stage was running
+            if self._execute("UPDATE jobs SET status = ?, finished = ? WHERE id = ? AND status = 'running' AND owner = ?",
+                             (status, time.time(), job_id, self.owner)):
+                self._stats["failed" if failed else "completed"] += 1
+                print(f"Ingestion job {job_id} {status} in {time.time() - start:.1f}s")
+            elif self._fetch("SELECT owner FROM jobs WHERE id = ?", (job_id,))[0]["owner"] != self.owner:
+                # Taken over by another worker while its last stage was running, the files are still needed
+                raise JobLost()
+        shutil.rmtree(os.path.join(self.directory, job_id), ignore_errors=True)
+
+    def _run_file(self, job, file):
+        job_id, file_id = job["id"], file["file_id"]
+        work_dir = os.path.join(self.directory, job_id, str(file_id))
+        path = os.path.join(work_dir, "source", f"{file_id}-{file['file_name']}")
+        self._execute("UPDATE job_files SET status = 'running' WHERE job_id = ? AND file_id = ?", (job_id, file_id))
+
+        stages = self._fetch("SELECT stage, status FROM job_stages WHERE job_id = ? AND file_id = ? ORDER BY position", (job_id, file_id))
+        for stage in stages:
+            if stage["status"] == "done":
+                continue
+            self._check_cancelled(job_id)
+            name = stage["stage"]
+            self._execute("UPDATE job_stages SET status = 'running', done = 0 WHERE job_id = ? AND file_id = ? AND stage = ?", (job_id, file_id, name))
+
+            def progress(done, total, name=name):
+                self._execute("UPDATE job_stages SET done = ?, total = ? WHERE job_id = ? AND file_id = ? AND stage = ?", (done, total, job_id, file_id, name))
+                self._check_cancelled(job_id)
+
+            start = time.time()
+            documents = getattr(self, f"_{name}")(job, path, work_dir, progress)
+            if documents is not None:
+                # Kept for the embed stage, so a restart doesn't have to redo the captioning
+                with open(os.path.join(work_dir, f"{name}.json"), "w") as f:
+                    json.dump([{"page_content": doc.page_content, "metadata": doc.metadata} for doc in documents], f)
+            self._execute("UPDATE job_stages SET status = 'done', seconds = ? WHERE job_id = ? AND file_id = ? AND stage = ?",
+                          (round(time.time() - start, 3), job_id, file_id, name))
+
+        self._execute("UPDATE job_files SET status = 'done' WHERE job_id = ? AND file_id = ?", (job_id, file_id))
+
+    # Stages. Each one gets the uploaded file, the file's work directory and a progress(done, total)
+    # callback, and returns the documents it produced (or None). MultimodalRAG is imported in the
+    # stages because it pulls in OpenCV, PyMuPDF, Tesseract and Gemini.
+
+    def _transcribe(self, job, path, work_dir, progress):
+        from MultimodalRAG import transcribe_audio_files
+        progress(0, 1)
+        with open(path, "rb") as f:
+            documents = transcribe_audio_files([(f.read(), os.path.basename(path))], job["subject"])
+        progress(1, 1)
+        return documents
+
+    def _caption_pages(self, job, path, work_dir, progress):
+        # Rendered and captioned in memory. If the stage is interrupted, the pages captioned so far
+        # come from the caption cache when it runs again.
+        from MultimodalRAG import count_pdf_pages, caption_pdf_pages, create_documents_from_captions
+        captions = self._caption(lambda on_caption: caption_pdf_pages(path, self.images_dir, on_caption), count_pdf_pages(path), progress)
+        return create_documents_from_captions(captions, job["subject"])
+
+    def _caption_frames(self, job, path, work_dir, progress):
+        from MultimodalRAG import caption_video_frames, create_documents_from_frames
+        # The number of scene changes isn't known up front
+        transcriptions = self._caption(lambda on_caption: caption_video_frames(path, VIDEO_FRAME_RATE, on_caption), None, progress)
+        return create_documents_from_frames(transcriptions, job["subject"])
+
+    def _caption(self, caption_images, total, progress):
+        done = 0
+        progress(done, total)
+
+        def on_caption():
+            nonlocal done
+            done += 1
+            progress(done, total)
+        return caption_images(on_caption)
+
+    def _load_text(self, job, path, work_dir, progress):
+        from MultimodalRAG import text_preprocess, update_metadata
+        # The source directory only holds this file
+        documents = update_metadata(text_preprocess(os.path.dirname(path)), job["subject"])
+        progress(len(documents), len(documents))
+        return documents
+
+    def _embed(self, job, path, work_dir, progress):
+        from MultimodalRAG import save_doc
+        documents = []
+        for name in file_stages(os.path.basename(path)):
+            stage_path = os.path.join(work_dir, f"{name}.json")
+            if os.path.exists(stage_path):
+                with open(stage_path) as f:
+                    documents += [Document(**doc) for doc in json.load(f)]
+        progress(0, len(documents))
+
+        # An interrupted attempt may have added some of the vectors already
+        file_id = int(os.path.basename(path).split("-", 1)[0])
+        chroma = get_vectorstore(KNOWLEDGE_BASE_DIR)
+        existing = chroma.get(where={"id": file_id})["ids"]
+        if existing:
+            chroma.delete(ids=existing)
+        if documents:
+            save_doc(documents)
+        # Cached answers were generated without the new material, and the subject centroids computed without it
+        response_cache.invalidate()
+        invalidate_query_constructors()
+        progress(len(documents), len(documents))
+
+
+# Shared job queue for /upload-files, started by the server
+ingestion_jobs = IngestionJobs(
+    path=INGESTION_DB,
+    directory=INGESTION_DIR,
+    workers=INGESTION_WORKERS,
+    nice=INGESTION_NICE,
+    lease=INGESTION_LEASE_SECONDS,
+    images_dir="images"  # IMG_DIRECTORY in server.py, where page images are saved
+)
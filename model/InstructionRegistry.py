@@ -0,0 +1,91 @@
+import os
+import threading
+import time
+from fastapi.concurrency import run_in_threadpool
+
+from ChatStoreSQL import get_all_instructions, get_instruction
+
+INSTRUCTION_CACHE_TTL = float(os.getenv("INSTRUCTION_CACHE_TTL", "600"))  # seconds between reloads
+
+
+class InstructionRegistry:
+    """In-memory copy of the Personalization_instructions table.
+
+    The table is small and rarely edited, so it is loaded in one query and reloaded after `ttl`
+    seconds or when invalidated (see /refresh-instructions). A parameter that isn't in the copy is
+    read from the database directly. If a reload fails the previous copy keeps being served.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._instructions = {}
+        self._loaded_at = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "refreshes": 0, "errors": 0}
+
+    def is_stale(self):
+        return self._loaded_at is None or time.monotonic() - self._loaded_at >= self.ttl
+
+    def refresh(self):
+        # Only one thread reloads at a time. The others keep using the current copy unless
+        # there is nothing loaded yet.
+        if not self._refresh_lock.acquire(blocking=not self._instructions):
+            return False
+        try:
+            instructions = get_all_instructions()
+        except Exception as e:
+            with self._lock:
+                self._stats["errors"] += 1
+            print(f"Error loading personalization instructions: {e}")
+            if not self._instructions:
+                raise
+            return False
+        finally:
+            self._refresh_lock.release()
+
+        with self._lock:
+            self._instructions = instructions
+            self._loaded_at = time.monotonic()
+            self._stats["refreshes"] += 1
+        print(f"Loaded {len(instructions)} personalization instructions")
+        return True
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def needs_database(self, parameters):
+        return self.is_stale() or any(parameter not in self._instructions for parameter in parameters)
+
+    def get(self, parameter):
+        if self.is_stale():
+            self.refresh()
+
+        instruction = self._instructions.get(parameter)
+        if instruction is not None:
+            with self._lock:
+                self._stats["hits"] += 1
+            return instruction
+
+        # Added since the last reload
+        instruction = get_instruction(parameter)
+        with self._lock:
+            self._stats["misses"] += 1
+            self._instructions[parameter] = instruction
+        return instruction
+
+    async def get_many(self, parameters):
+        # Served from memory on the event loop. Reloads and lookups hit MySQL, so they run in a worker thread.
+        if self.needs_database(parameters):
+            return await run_in_threadpool(lambda: [self.get(parameter) for parameter in parameters])
+        return [self.get(parameter) for parameter in parameters]
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, instructions=len(self._instructions),
+                        age=time.monotonic() - self._loaded_at if self._loaded_at is not None else None)
+
+
+# Shared registry used to build every chat turn's prompt
+instruction_registry = InstructionRegistry(ttl=INSTRUCTION_CACHE_TTL)
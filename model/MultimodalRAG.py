@@ -1,25 +1,23 @@
 import os
-import time
 from pydub import AudioSegment # type: ignore
 from math import ceil
-import base64
 import tempfile
 from langchain.schema import Document
 import fitz # type: ignore
-import google.generativeai as genai # type: ignore
 import PIL.Image
 from groq import Groq
 from openai import OpenAI
 import cv2 # type: ignore
 from PIL import Image
-import pytesseract # type: ignore
 from langchain_openai.embeddings import OpenAIEmbeddings
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_chroma import Chroma # type: ignore
 from dotenv import load_dotenv
 import os
 import warnings
 
+from VectorStores import get_vectorstore, KNOWLEDGE_BASE_DIR
+from Captioning import captioner
+from FrameSampler import sample_frames
+
 warnings.filterwarnings("ignore", category=FutureWarning, module="transformers")
 
 # Load environment variables from .env file
@@ -155,118 +153,68 @@ def transcribe_large_audio(file, file_size, file_name):
 #     pdf_document.close()
 
 
-def extract_images_from_pdf(pdf_path, output_dir, zoom=2):
-    # Open the PDF file
+# Page images are served at /images for the sources of an answer. They are the only copies of the
+# pages written to disk, compressed once (WEBP or JPEG).
+PAGE_IMAGE_FORMAT = os.getenv("PAGE_IMAGE_FORMAT", "WEBP")
+PAGE_IMAGE_QUALITY = int(os.getenv("PAGE_IMAGE_QUALITY", "80"))
+PAGE_IMAGE_EXTENSIONS = {"WEBP": "webp", "JPEG": "jpg"}
+
+
+def count_pdf_pages(pdf_path):
+    with fitz.open(pdf_path) as pdf_document:
+        return len(pdf_document)
+
+
+def render_pdf_pages(pdf_path, zoom=2):
+    """Yields (page number, PIL image) for every page of the PDF, rendered in memory."""
     pdf_document = fitz.open(pdf_path)
+    try:
+        for page_number in range(len(pdf_document)):
+            page = pdf_document.load_page(page_number)
 
-    # Ensure the output directory exists
-    os.makedirs(output_dir, exist_ok=True)
+            # Render the page to an image
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom))
+            yield page_number + 1, Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+    finally:
+        # Close the PDF document
+        pdf_document.close()
+
+
+# Step 1: Generate Captions for All Pages of a PDF
+# on_caption, if given, is called after every page (the ingestion jobs use it for progress and cancellation)
+def caption_pdf_pages(pdf_path, images_dir, on_caption=None):
+    # Ensure the images directory exists
+    os.makedirs(images_dir, exist_ok=True)
 
     # Extract the PDF's base name without the extension
     pdf_name = os.path.splitext(os.path.basename(pdf_path))[0]
+    extension = PAGE_IMAGE_EXTENSIONS[PAGE_IMAGE_FORMAT]
+    image_filenames = []
 
-    # Iterate through each page in the PDF
-    for page_number in range(len(pdf_document)):
-        page = pdf_document.load_page(page_number)
+    def pages():
+        for page_number, img in render_pdf_pages(pdf_path):
+            image_filename = f"{pdf_name}_page_{page_number}.{extension}"
+            img.save(os.path.join(images_dir, image_filename), format=PAGE_IMAGE_FORMAT, quality=PAGE_IMAGE_QUALITY)
+            image_filenames.append(image_filename)
+            yield img
 
-        # Render the page to an image
-        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom))
-        
-        # Define the output image filename
-        image_filename = f"{pdf_name}_page_{page_number + 1}.png"
+    # Pages go from the renderer straight to OCR and captioning, in page order
+    captions = captioner.caption_images(pages(), on_caption)
 
-        # Save the rendered image to the output directory
-        pix.save(os.path.join(output_dir, image_filename))
+    # Store the caption along with image reference
+    return list(zip(image_filenames, captions))
 
-    # Close the PDF document
-    pdf_document.close()
 
-def process_all_pdfs(input_dir, output_dir):
-    # Ensure the output directory exists
-    os.makedirs(output_dir, exist_ok=True)
+def process_all_pdfs(input_dir, images_dir):
+    captions = []
 
     # Iterate through all files in the input directory
     for filename in os.listdir(input_dir):
         if filename.endswith(".pdf"):
             pdf_path = os.path.join(input_dir, filename)
             print(f"Processing {pdf_path}")
-            extract_images_from_pdf(pdf_path, output_dir)
+            captions += caption_pdf_pages(pdf_path, images_dir)
 
-
-# Step 1: Generate Captions for All Images in Output Directory
-def generate_captions_for_images(output_dir):
-    genai.configure(api_key=os.getenv('GOOGLE_API_KEY'))
-    gemini_model = genai.GenerativeModel('gemini-1.5-flash')
-
-    captions = []
-    gemini_counter = 0
-    gemini_tpm_limit = 14  # Gemini model's 15 TPM limit
-    timer_duration = 60  # 1 minute
-    timer_start = time.time()
-    
-    def reset_gemini_counter():
-        nonlocal gemini_counter
-        gemini_counter = 0
-        print("Gemini counter reset. You can now process another 15 images with Gemini.")
-    
-    
-    # Iterate through each image file in the output directory
-    for image_filename in sorted(os.listdir(output_dir)):
-        image_path = os.path.join(output_dir, image_filename)
-
-        # Ensure it's a file (not a subdirectory) and an image
-        if os.path.isfile(image_path) and image_filename.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp')):
-            img = PIL.Image.open(image_path)
-            initial_caption = pytesseract.image_to_string(img).strip()
-            gemini_counter += 1
-            
-            if gemini_counter < gemini_tpm_limit:
-                # If the Gemini model can still process images
-                response = gemini_model.generate_content(img)
-                model_caption = response.text.strip()
-                
-                combined_caption = (f"Caption by pytesseract:\n{initial_caption}\n\n"
-                                    f"Caption by model:\n{model_caption}")
-
-                print(f"Gemini processed {gemini_counter} images.")
-            else:
-                # If Gemini reaches the cap, switch to Llama
-                print(f"GPT-4o processed {gemini_counter - 13} images.")
-                
-                # Convert image to base64 to pass to Llama
-                with open(image_path, "rb") as image_file:
-                    img_base64 = base64.b64encode(image_file.read()).decode('utf-8')
-
-                chat_completion = client.chat.completions.create(
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": [
-                                {"type": "text", "text": "What is in this image?"},
-                                {
-                                    "type": "image_url",
-                                    "image_url": {
-                                        "url": f"data:image/jpeg;base64,{img_base64}",
-                                    },
-                                },
-                            ],
-                        }
-                    ],
-                    model="gpt-4o-mini",
-                )
-                
-                llama_caption = chat_completion.choices[0].message.content
-                combined_caption = (f"Caption by pytesseract:\n{initial_caption}\n\n"
-                                    f"Caption by model:\n{llama_caption}")
-
-            # Store the caption along with image reference
-            captions.append((image_filename, combined_caption))
-
-            # Check if the timer has reached one minute and reset the Gemini counter
-            if time.time() - timer_start >= timer_duration:
-                reset_gemini_counter()
-                timer_start = time.time()  # Reset the timer start
-                
     return captions
 
 # Step 2: Create a Document with All Captions
@@ -291,125 +239,21 @@ def create_documents_from_captions(captions, subject):
 
 ######################### VIDEOS ##########################
 
-def extract_frames_from_video(video_path, output_dir, desired_fps=None):
-    # Open the video file
-    video_capture = cv2.VideoCapture(video_path)
-
-    # Get the original FPS of the video
-    original_fps = video_capture.get(cv2.CAP_PROP_FPS)
-
-    # Calculate the exact number of frames to skip to match the desired FPS
-    frame_interval = original_fps / desired_fps if desired_fps else 1
-
-    # Ensure the output directory exists
-    os.makedirs(output_dir, exist_ok=True)
-
+def caption_video_frames(video_path, desired_fps=None, on_caption=None):
     # Extract the video filename without extension
     video_filename = os.path.splitext(os.path.basename(video_path))[0]
+    frame_names = []
 
-    frame_count = 0
-    extracted_count = 0  
-    while True:
-        # Read the next frame
-        ret, frame = video_capture.read()
-        if not ret:
-            break
-
-        # Calculate timestamp for the current frame
-        timestamp = frame_count / original_fps  # in seconds
-
-        # Extract frame based on the interval
-        if frame_count >= extracted_count * frame_interval:
+    def frames():
+        # Only frames where the scene or slide changes, out of `desired_fps` candidates per second.
+        # They are decoded, OCR'd and captioned in memory, nothing serves them so they aren't saved.
+        for extracted_count, (timestamp, frame) in enumerate(sample_frames(video_path, desired_fps)):
+            frame_names.append(f"{video_filename}_time_{timestamp:.2f}_frame_{extracted_count:04d}")
             # Convert frame to RGB (PIL expects RGB images)
-            frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-
-            # Convert to PIL Image
-            img = Image.fromarray(frame_rgb)
-
-            # Save the frame as an image file with the desired format
-            frame_filename = f"{video_filename}_time_{timestamp:.2f}_frame_{extracted_count:04d}.png"
-            img.save(os.path.join(output_dir, frame_filename))
-            extracted_count += 1
-
-        frame_count += 1
-
-    video_capture.release()
-    print(f"Extracted {extracted_count} frames from {video_path} at {desired_fps or original_fps} FPS")
+            yield Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
 
-
-def transcribe_frames(input_dir):
-    genai.configure(api_key=os.getenv('GOOGLE_API_KEY'))
-    gemini_model = genai.GenerativeModel('gemini-1.5-flash')
-
-    transcriptions = {}
-    gemini_counter = 0
-    gemini_tpm_limit = 14  # Gemini model's 15 TPM limit
-    timer_duration = 60  # 1 minute
-    timer_start = time.time()
-    
-    def reset_gemini_counter():
-        nonlocal gemini_counter
-        gemini_counter = 0
-        print("Gemini counter reset. You can now process another 15 images with Gemini.")
-
-    # Iterate over all image files in the directory
-    for filename in sorted(os.listdir(input_dir)):
-        if filename.endswith(".png"):
-            file_path = os.path.join(input_dir, filename)
-
-            # Open the image
-            img = PIL.Image.open(file_path)
-            initial_caption = pytesseract.image_to_string(img).strip()
-
-            if gemini_counter < gemini_tpm_limit:
-                # If the Gemini model can still process images
-                response = gemini_model.generate_content(img)
-                model_caption = response.text.strip()
-                gemini_counter += 1
-
-                combined_caption = (f"Caption by pytesseract:\n{initial_caption}\n\n"
-                                    f"Caption by model:\n{model_caption}")
-
-                print(f"Gemini processed {gemini_counter} images.")
-            else:
-                # If Gemini reaches the cap, switch to Llama
-                print("Gemini model limit reached. Switching to Llama model.")
-                
-                # Convert image to base64 to pass to Llama
-                with open(file_path, "rb") as image_file:
-                    img_base64 = base64.b64encode(image_file.read()).decode('utf-8')
-
-                chat_completion = client.chat.completions.create(
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": [
-                                {"type": "text", "text": "What is in this image?"},
-                                {
-                                    "type": "image_url",
-                                    "image_url": {
-                                        "url": f"data:image/jpeg;base64,{img_base64}",
-                                    },
-                                },
-                            ],
-                        }
-                    ],
-                    model="llama-3.2-11b-vision-preview",
-                )
-                
-                llama_caption = chat_completion.choices[0].message.content
-                combined_caption = (f"Caption by pytesseract:\n{initial_caption}\n\n"
-                                    f"Caption by model:\n{llama_caption}")
-
-            # Store the transcription
-            transcriptions[filename] = combined_caption
-            
-            # Check if the timer has reached one minute and reset the Gemini counter
-            if time.time() - timer_start >= timer_duration:
-                reset_gemini_counter()
-                timer_start = time.time()  # Reset the timer start
-    
-    return transcriptions
+    captions = captioner.caption_images(frames(), on_caption)
+    return dict(zip(frame_names, captions))
 
 
 def create_documents_from_frames(captions, subject):
@@ -417,7 +261,7 @@ def create_documents_from_frames(captions, subject):
 
     for image_filename, caption in captions.items():
         # Extracting the source file name, timestamp, and frame number from the filename
-        # Assuming the filename format is "video_filename_time_XX.XX_frame_XXXX.png"
+        # Assuming the frame name format is "video_filename_time_XX.XX_frame_XXXX"
         parts = image_filename.split('_')
         video_filename = parts[0]  # Extract the source video file name
         timestamp = parts[-3]  # Extract timestamp
@@ -440,21 +284,15 @@ def create_documents_from_frames(captions, subject):
     return documents
 
 
-def process_videos_in_directory(input_dir, output_dir_base, frame_rate, subject):
+def process_videos_in_directory(input_dir, frame_rate, subject):
     documents=[]
     # Iterate over all video files in the input directory
     for video_filename in os.listdir(input_dir):
         if video_filename.endswith((".mp4", ".avi", ".mov", ".mkv")):  # Add other video formats if needed
             video_path = os.path.join(input_dir, video_filename)
 
-            # Create a specific output directory for each video
-            video_output_dir = os.path.join(output_dir_base, os.path.splitext(video_filename)[0])
-
-            # Extract frames from the video
-            extract_frames_from_video(video_path, video_output_dir, frame_rate)
-
-            # Transcribe the frames
-            transcriptions = transcribe_frames(video_output_dir)
+            # Caption the frames
+            transcriptions = caption_video_frames(video_path, frame_rate)
 
             # Create documents with the required format
             document = create_documents_from_frames(transcriptions, subject)
@@ -551,13 +389,8 @@ def update_metadata(documents, subject):
 
 
 def save_doc(documents):
-    embeddings=HuggingFaceEmbeddings(model_name="sentence-transformers/all-mpnet-base-v2")
-
-    # Create a Chroma instance
-    chroma = Chroma(
-        embedding_function=embeddings,
-        persist_directory="../knowledge_base"  # Specify your directory for persistence
-    )
+    # Shared with the chat chain, so uploads don't load the embedding model again
+    chroma = get_vectorstore(KNOWLEDGE_BASE_DIR)
     
     # Add documents to the Chroma vector store
     chroma.add_documents(documents)
\ No newline at end of file
@@ -0,0 +1,175 @@
+import os
+import time
+import threading
+from mysql.connector import pooling
+from mysql.connector.errors import PoolError
+
+from Telemetry import record_span
+
+MYSQL_HOST = os.getenv("MYSQL_HOST")
+MYSQL_USER = os.getenv("MYSQL_USER")
+MYSQL_PASSWORD = os.getenv("MYSQL_PASSWORD")
+MYSQL_DB = os.getenv("MYSQL_DB")
+
+# Pool settings. mysql.connector caps a single pool at 32 connections.
+MYSQL_POOL_SIZE = int(os.getenv("MYSQL_POOL_SIZE", "10"))
+MYSQL_POOL_TIMEOUT = float(os.getenv("MYSQL_POOL_TIMEOUT", "10"))  # seconds to wait for a free connection
+MYSQL_CONNECT_TIMEOUT = int(os.getenv("MYSQL_CONNECT_TIMEOUT", "10"))  # seconds to open a new connection
+
+
+class PooledConnection:
+    """Connection checked out of a ConnectionPool.
+
+    Behaves like a normal mysql.connector connection. Calling close() hands it back to the
+    pool instead of closing the socket, so existing `connection.close()` calls keep working.
+    """
+
+    def __init__(self, pool, cnx):
+        self._pool = pool
+        self._cnx = cnx
+        self._checked_out_at = time.perf_counter()
+
+    def __getattr__(self, name):
+        if self._cnx is None:
+            raise PoolError("Connection has already been returned to the pool")
+        return getattr(self._cnx, name)
+
+    def close(self):
+        if self._cnx is None:
+            return
+        cnx, self._cnx = self._cnx, None
+        try:
+            # Returns the connection to the mysql.connector pool, which resets the session
+            # (rolling back anything left uncommitted).
+            cnx.close()
+        except Exception:
+            # A broken connection can't be reset and is dropped by mysql.connector, so open a
+            # replacement to keep the pool at its configured size.
+            self._pool._replace_connection()
+            raise
+        finally:
+            held = time.perf_counter() - self._checked_out_at
+            self._pool._release(held)
+            # Every ChatStoreSQL call checks out its own connection, so this is the time of one MySQL call
+            record_span("mysql", held)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        # Safety net for code paths that raise before reaching close(). Without this a
+        # leaked checkout would permanently shrink the pool.
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+class ConnectionPool:
+    """Bounded MySQL connection pool with checkout metrics.
+
+    Callers block for up to `wait_timeout` seconds when every connection is in use and get a
+    PoolError after that. The underlying pool is created on first use so importing this module
+    never touches the database.
+    """
+
+    def __init__(self, pool_name, pool_size, wait_timeout, **connect_args):
+        self.pool_name = pool_name
+        self.pool_size = pool_size
+        self.wait_timeout = wait_timeout
+        self._connect_args = connect_args
+        self._pool = None
+        self._init_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._in_use = 0
+        self._checkouts = 0
+        self._timeouts = 0
+        self._errors = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._hold_total = 0.0
+        self._hold_max = 0.0
+
+    def _get_pool(self):
+        if self._pool is None:
+            with self._init_lock:
+                if self._pool is None:
+                    self._pool = pooling.MySQLConnectionPool(
+                        pool_name=self.pool_name,
+                        pool_size=self.pool_size,
+                        pool_reset_session=True,
+                        **self._connect_args
+                    )
+        return self._pool
+
+    def get_connection(self):
+        start = time.perf_counter()
+        if not self._slots.acquire(timeout=self.wait_timeout):
+            with self._stats_lock:
+                self._timeouts += 1
+            raise PoolError(f"Timed out after {self.wait_timeout}s waiting for a MySQL connection "
+                            f"(pool size {self.pool_size})")
+        waited = time.perf_counter() - start
+
+        try:
+            # The mysql.connector pool health-checks each connection on checkout (is_connected()
+            # pings the server) and transparently reconnects stale ones.
+            cnx = self._get_pool().get_connection()
+        except Exception:
+            self._slots.release()
+            with self._stats_lock:
+                self._errors += 1
+            raise
+
+        with self._stats_lock:
+            self._in_use += 1
+            self._checkouts += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+
+        return PooledConnection(self, cnx)
+
+    def _replace_connection(self):
+        try:
+            self._get_pool().add_connection()
+        except Exception as e:
+            print(f"Error replacing pooled MySQL connection: {e}")
+
+    def _release(self, held):
+        with self._stats_lock:
+            self._in_use -= 1
+            self._hold_total += held
+            self._hold_max = max(self._hold_max, held)
+        self._slots.release()
+
+    def stats(self):
+        with self._stats_lock:
+            checkouts = self._checkouts
+            return {
+                "pool_size": self.pool_size,
+                "in_use": self._in_use,
+                "checkouts": checkouts,
+                "timeouts": self._timeouts,
+                "errors": self._errors,
+                "wait_avg_ms": (self._wait_total / checkouts * 1000) if checkouts else 0.0,
+                "wait_max_ms": self._wait_max * 1000,
+                "hold_avg_ms": (self._hold_total / checkouts * 1000) if checkouts else 0.0,
+                "hold_max_ms": self._hold_max * 1000,
+            }
+
+
+# Shared pool used by every ChatStoreSQL function
+mysql_pool = ConnectionPool(
+    pool_name="chatstore",
+    pool_size=MYSQL_POOL_SIZE,
+    wait_timeout=MYSQL_POOL_TIMEOUT,
+    host=MYSQL_HOST,
+    user=MYSQL_USER,
+    password=MYSQL_PASSWORD,
+    database=MYSQL_DB,
+    connection_timeout=MYSQL_CONNECT_TIMEOUT
+)
@@ -0,0 +1,179 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+RESOURCE_CACHE_DB = os.getenv("RESOURCE_CACHE_DB", "resource_cache.db")
+RESOURCE_CACHE_TTL = float(os.getenv("RESOURCE_CACHE_TTL", "86400"))  # seconds
+RESOURCE_CACHE_MAX_ENTRIES = int(os.getenv("RESOURCE_CACHE_MAX_ENTRIES", "5000"))
+# Minimum word overlap (Jaccard similarity) for a cached query to be reused for a different one
+RESOURCE_CACHE_SIMILARITY = float(os.getenv("RESOURCE_CACHE_SIMILARITY", "0.8"))
+
+# Words that make a question depend on the conversation before it
+REFERENCE_WORDS = {"it", "its", "this", "that", "these", "those", "they", "them", "above", "previous", "again", "more"}
+
+
+def normalize_query(query):
+    # Queries differing only in case, punctuation or spacing share cached results
+    query = re.sub(r"[^\w\s]", " ", query.lower())
+    return " ".join(query.split())
+
+
+def is_self_contained(text):
+    """Whether a student's question can be matched on its own text.
+
+    Follow-ups like "can you explain that again?" mean different things in different chats, so they
+    aren't matched against other chats' questions. Their resources are only looked up by the search
+    query generated from the conversation, and their answers are not cached (see app.py).
+    """
+    words = normalize_query(text).split()
+    return len(words) >= 3 and not REFERENCE_WORDS.intersection(words)
+
+
+class ResourceCache:
+    """Recommended resources stored in SQLite by normalized query, so they survive restarts.
+
+    A lookup first tries the exact normalized query and then the most similar cached query by word
+    overlap, so near-identical questions from different students reuse the same search results.
+    Entries expire `ttl` seconds after they were fetched, and the least recently used entries are
+    evicted once there are more than `max_entries`.
+    """
+
+    def __init__(self, path, ttl, max_entries, similarity):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.similarity = similarity
+        self._connection = None
+        self._words = None  # key -> set of words, for similarity lookups
+        self._postings = None  # word -> keys containing it
+        self._lock = threading.Lock()
+        self._stats = {"exact_hits": 0, "similar_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    def _connect(self):
+        # Opened on first use. All access goes through self._lock, so one connection is shared by every thread.
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._connection.execute("""
+                CREATE TABLE IF NOT EXISTS resources (
+                    query TEXT PRIMARY KEY,
+                    resources TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    last_used REAL NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            self._connection.execute("CREATE INDEX IF NOT EXISTS resources_created ON resources (created)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS resources_last_used ON resources (last_used)")
+            self._connection.commit()
+
+            self._words = {}
+            self._postings = {}
+            for (key,) in self._connection.execute("SELECT query FROM resources"):
+                self._index(key)
+        return self._connection
+
+    def _index(self, key):
+        words = set(key.split())
+        self._words[key] = words
+        for word in words:
+            self._postings.setdefault(word, set()).add(key)
+
+    def _unindex(self, key):
+        for word in self._words.pop(key, ()):
+            keys = self._postings.get(word)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._postings[word]
+
+    def _most_similar(self, words):
+        candidates = set()
+        for word in words:
+            candidates.update(self._postings.get(word, ()))
+
+        best_key, best_score = None, self.similarity
+        for key in candidates:
+            cached = self._words[key]
+            score = len(words & cached) / len(words | cached)
+            if score >= best_score:
+                best_key, best_score = key, score
+        return best_key
+
+    def lookup(self, query):
+        key = normalize_query(query)
+        if not key:
+            return None
+
+        with self._lock:
+            connection = self._connect()
+            exact = key in self._words
+            match = key if exact else self._most_similar(set(key.split()))
+            if match is None:
+                self._stats["misses"] += 1
+                return None
+
+            now = time.time()
+            row = connection.execute("SELECT resources, created FROM resources WHERE query = ?", (match,)).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                connection.execute("DELETE FROM resources WHERE query = ?", (match,))
+                connection.commit()
+                self._unindex(match)
+                self._stats["misses"] += 1
+                return None
+
+            connection.execute("UPDATE resources SET last_used = ?, hits = hits + 1 WHERE query = ?", (now, match))
+            connection.commit()
+            self._stats["exact_hits" if exact else "similar_hits"] += 1
+
+        if not exact:
+            print(f"Reusing resources of '{match}' for '{key}'")
+        return json.loads(row[0])
+
+    def store(self, query, resources):
+        key = normalize_query(query)
+        if not key:
+            return
+
+        with self._lock:
+            connection = self._connect()
+            now = time.time()
+            connection.execute("""
+                INSERT INTO resources (query, resources, created, last_used) VALUES (?, ?, ?, ?)
+                ON CONFLICT (query) DO UPDATE SET resources = excluded.resources, created = excluded.created, last_used = excluded.last_used
+            """, (key, json.dumps(resources), now, now))
+            if key not in self._words:
+                self._index(key)
+            self._stats["stores"] += 1
+            self._evict(connection, now)
+            connection.commit()
+
+    def _evict(self, connection, now):
+        expired = [key for (key,) in connection.execute("SELECT query FROM resources WHERE created < ?", (now - self.ttl,))]
+        excess = len(self._words) - len(expired) - self.max_entries
+        if excess > 0:
+            expired += [key for (key,) in connection.execute(
+                "SELECT query FROM resources WHERE created >= ? ORDER BY last_used LIMIT ?", (now - self.ttl, excess))]
+
+        for key in expired:
+            connection.execute("DELETE FROM resources WHERE query = ?", (key,))
+            self._unindex(key)
+        self._stats["evictions"] += len(expired)
+
+    def stats(self):
+        with self._lock:
+            hits = self._stats["exact_hits"] + self._stats["similar_hits"]
+            lookups = hits + self._stats["misses"]
+            return dict(self._stats, entries=len(self._words) if self._words is not None else 0,
+                        hit_rate=hits / lookups if lookups else 0.0)
+
+
+# Shared cache used by WebScraper.fetch_recommended_resources
+resource_cache = ResourceCache(
+    path=RESOURCE_CACHE_DB,
+    ttl=RESOURCE_CACHE_TTL,
+    max_entries=RESOURCE_CACHE_MAX_ENTRIES,
+    similarity=RESOURCE_CACHE_SIMILARITY
+)
@@ -0,0 +1,144 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+from ResourceCache import is_self_contained
+
+# Minimum cosine similarity between two questions for a cached answer to be reused
+RESPONSE_CACHE_THRESHOLD = float(os.getenv("RESPONSE_CACHE_THRESHOLD", "0.95"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "2000"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "86400"))  # seconds
+
+# The extract passed to the chain when a turn has no attached file
+NO_ATTACHMENTS = "No file attachments provided"
+
+
+def is_cacheable(question, extract):
+    """Answers to follow-up questions and to questions about an attached file depend on more than the question, so they aren't cached."""
+    return extract in (None, "", NO_ATTACHMENTS) and is_self_contained(question)
+
+
+def personalization_key(personalization, notes, feedback):
+    """Answers are only shared between chats with the same personalization, mentor notes and feedback."""
+    digest = hashlib.sha256(json.dumps([notes, feedback], sort_keys=True, default=str).encode()).hexdigest()
+    return (
+        personalization["student_type"],
+        personalization["learning_style"],
+        personalization["communication_format"],
+        personalization["tone_style"],
+        personalization["reasoning_framework"],
+        digest
+    )
+
+
+class ResponseCache:
+    """Semantic cache of chat answers.
+
+    Answers are grouped by personalization key and matched on the cosine similarity of the question
+    embeddings, so a differently worded version of a question that was already answered with the
+    same personalization gets the stored answer. Each entry keeps the IDs of the documents the
+    answer was based on so callers can check they are still in the knowledge base. invalidate()
+    drops everything and should be called whenever the knowledge base changes.
+    """
+
+    def __init__(self, threshold, max_entries, ttl):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # entry id -> entry, least recently used first
+        self._by_key = {}  # personalization key -> entry ids
+        self._next_id = 0
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "invalidations": 0}
+
+    @property
+    def generation(self):
+        """Changes on every invalidate(). Pass the value read before answering to store()."""
+        return self._generation
+
+    def lookup(self, key, embedding):
+        vector = self._normalize(embedding)
+        now = time.monotonic()
+        with self._lock:
+            for entry_id in [entry_id for entry_id in self._by_key.get(key, ()) if self._entries[entry_id]["expires"] <= now]:
+                self._remove(entry_id)
+                self._stats["evictions"] += 1
+
+            entry_ids = self._by_key.get(key, [])
+            if entry_ids:
+                similarities = np.stack([self._entries[entry_id]["vector"] for entry_id in entry_ids]) @ vector
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    entry_id = entry_ids[best]
+                    self._entries.move_to_end(entry_id)
+                    self._stats["hits"] += 1
+                    return dict(self._entries[entry_id], id=entry_id, similarity=float(similarities[best]))
+            self._stats["misses"] += 1
+            return None
+
+    def store(self, key, embedding, question, response, context, generation):
+        with self._lock:
+            # The knowledge base changed while this answer was being generated
+            if generation != self._generation:
+                return
+
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = {
+                "key": key,
+                "vector": self._normalize(embedding),
+                "question": question,
+                "response": response,
+                "context": context,
+                "doc_ids": [doc.id for doc in context if getattr(doc, "id", None)],
+                "expires": time.monotonic() + self.ttl
+            }
+            self._by_key.setdefault(key, []).append(entry_id)
+            self._stats["stores"] += 1
+
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self._stats["evictions"] += 1
+
+    def discard(self, entry_id):
+        with self._lock:
+            if entry_id in self._entries:
+                self._remove(entry_id)
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_key.clear()
+            self._generation += 1
+            self._stats["invalidations"] += 1
+
+    def _remove(self, entry_id):
+        entry = self._entries.pop(entry_id)
+        entry_ids = self._by_key[entry["key"]]
+        entry_ids.remove(entry_id)
+        if not entry_ids:
+            del self._by_key[entry["key"]]
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def stats(self):
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return dict(self._stats, entries=len(self._entries), hit_rate=self._stats["hits"] / lookups if lookups else 0.0)
+
+
+# Shared cache used by app.process_chat and app.stream_chat
+response_cache = ResponseCache(
+    threshold=RESPONSE_CACHE_THRESHOLD,
+    max_entries=RESPONSE_CACHE_MAX_ENTRIES,
+    ttl=RESPONSE_CACHE_TTL
+)
@@ -0,0 +1,193 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from fastapi.concurrency import run_in_threadpool
+from langchain_core.messages import BaseMessage
+
+from ChatStoreSQL import load_chat_data, get_personalization_params, get_mentor_notes, get_existing_feedback
+from ChatTaskQueue import chat_tasks
+
+SESSION_CACHE_MAX_ENTRIES = int(os.getenv("SESSION_CACHE_MAX_ENTRIES", "1000"))
+SESSION_CACHE_TTL = float(os.getenv("SESSION_CACHE_TTL", "3600"))  # seconds since last access
+SESSION_CACHE_MAX_MB = float(os.getenv("SESSION_CACHE_MAX_MB", "256"))
+# Number of recent messages kept in a chat session. run_model only uses the latest 10.
+CHAT_HISTORY_WINDOW = int(os.getenv("CHAT_HISTORY_WINDOW", "20"))
+
+CHAT = "chat"
+USER = "user"
+
+
+def estimate_size(value):
+    """Rough size of a cached value in bytes. Only used to enforce the memory budget."""
+    if isinstance(value, BaseMessage):
+        return sys.getsizeof(value.content) + estimate_size(value.response_metadata)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return sys.getsizeof(value) + sum(estimate_size(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class SessionCache:
+    """In-memory cache for chat and user session data.
+
+    Entries live in separate namespaces (chat and user data are keyed by different IDs) and are
+    evicted least-recently-used first when the cache exceeds either its entry limit or its memory
+    budget. Entries not accessed for `ttl` seconds expire.
+    """
+
+    def __init__(self, max_entries, ttl, max_bytes):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def _namespace_stats(self, namespace):
+        if namespace not in self._stats:
+            self._stats[namespace] = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+        return self._stats[namespace]
+
+    def get(self, namespace, key):
+        with self._lock:
+            stats = self._namespace_stats(namespace)
+            entry = self._entries.get((namespace, key))
+            if entry is None:
+                stats["misses"] += 1
+                return None
+            if entry["expires"] <= time.monotonic():
+                self._remove((namespace, key))
+                stats["expirations"] += 1
+                stats["misses"] += 1
+                return None
+
+            stats["hits"] += 1
+            entry["expires"] = time.monotonic() + self.ttl
+            self._entries.move_to_end((namespace, key))
+
+            # Session values are mutated in place (e.g. new chat messages), so re-measure on access
+            size = estimate_size(entry["value"])
+            self._total_bytes += size - entry["size"]
+            entry["size"] = size
+            self._evict(keep=(namespace, key))
+            return entry["value"]
+
+    def set(self, namespace, key, value):
+        with self._lock:
+            if (namespace, key) in self._entries:
+                self._remove((namespace, key))
+            size = estimate_size(value)
+            self._entries[(namespace, key)] = {"value": value, "size": size, "expires": time.monotonic() + self.ttl}
+            self._total_bytes += size
+            self._evict(keep=(namespace, key))
+        return value
+
+    def delete(self, namespace, key):
+        with self._lock:
+            if (namespace, key) in self._entries:
+                self._remove((namespace, key))
+
+    def _remove(self, cache_key):
+        entry = self._entries.pop(cache_key)
+        self._total_bytes -= entry["size"]
+
+    def _evict(self, keep):
+        now = time.monotonic()
+        for cache_key in [k for k, entry in self._entries.items() if entry["expires"] <= now and k != keep]:
+            self._remove(cache_key)
+            self._namespace_stats(cache_key[0])["expirations"] += 1
+
+        # The OrderedDict is kept in access order, so the first entry is the least recently used
+        while len(self._entries) > 1 and (len(self._entries) > self.max_entries or self._total_bytes > self.max_bytes):
+            cache_key = next(iter(self._entries))
+            if cache_key == keep:
+                self._entries.move_to_end(cache_key)
+                cache_key = next(iter(self._entries))
+            self._remove(cache_key)
+            self._namespace_stats(cache_key[0])["evictions"] += 1
+
+    def stats(self):
+        with self._lock:
+            namespaces = {}
+            for namespace, stats in self._stats.items():
+                lookups = stats["hits"] + stats["misses"]
+                namespaces[namespace] = dict(stats, hit_rate=stats["hits"] / lookups if lookups else 0.0)
+            return {
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "namespaces": namespaces,
+            }
+
+
+# Single cache shared by the web app and the WhatsApp bot
+session_cache = SessionCache(
+    max_entries=SESSION_CACHE_MAX_ENTRIES,
+    ttl=SESSION_CACHE_TTL,
+    max_bytes=int(SESSION_CACHE_MAX_MB * 1024 * 1024)
+)
+
+
+# Helper function to preload chat-specific data.
+# After this the cached session is the working copy of the chat: each turn updates it in place and
+# writes it through to MySQL, so it is not reloaded after every turn. Only the latest messages are
+# kept: `first_seq` is the sequence number of the first one in `chat_history` and `saved_count` how
+# many messages of the chat are already persisted.
+async def preload_chat_data(ChatID):
+    # Let queued updates for this chat (resources, summary) finish first so the reload doesn't miss them
+    await chat_tasks.join(ChatID)
+
+    # Preload the latest chat messages and the summary
+    chat_data = await run_in_threadpool(load_chat_data, ChatID, CHAT_HISTORY_WINDOW)
+
+    # Preload personalization data
+    personalization = await run_in_threadpool(get_personalization_params, ChatID)
+
+    print(f"Preloaded data for ChatID {ChatID}")
+    return session_cache.set(CHAT, ChatID, {
+        "chat_history": chat_data["chat_history"],
+        "chat_summary": chat_data["chat_summary"] if chat_data["chat_summary"] else "",
+        "personalization": personalization,
+        "first_seq": chat_data["first_seq"],
+        "saved_count": chat_data["message_count"],
+        # Held while saving messages, so concurrent turns of the chat save in order (see app.save_turn)
+        "save_lock": asyncio.Lock()
+    })
+
+
+# Drops saved messages that have fallen out of the session window. Unsaved messages are always kept.
+def trim_chat_history(chat_data):
+    chat_history = chat_data["chat_history"]
+    excess = min(len(chat_history) - CHAT_HISTORY_WINDOW, chat_data["saved_count"] - chat_data["first_seq"])
+    if excess > 0:
+        del chat_history[:excess]
+        chat_data["first_seq"] += excess
+
+
+async def preload_user_data(UserID):
+    # Preload mentor notes and feedback using UserID
+    notes = await run_in_threadpool(get_mentor_notes, UserID)
+    feedback = await run_in_threadpool(get_existing_feedback, UserID)
+
+    print(f"Preloaded data for UserID {UserID}")
+    return session_cache.set(USER, UserID, {"notes": notes, "feedback": feedback})
+
+
+async def get_chat_session(ChatID):
+    chat_data = session_cache.get(CHAT, ChatID)
+    if chat_data is None:
+        chat_data = await preload_chat_data(ChatID)
+    return chat_data
+
+
+async def get_user_session(UserID):
+    user_data = session_cache.get(USER, UserID)
+    if user_data is None:
+        user_data = await preload_user_data(UserID)
+    return user_data
@@ -0,0 +1,189 @@
+import os
+import re
+import threading
+import weakref
+from collections import OrderedDict
+import numpy as np
+from langchain_core.runnables import RunnableLambda
+from langchain_core.runnables.config import run_in_executor
+from langchain_core.structured_query import Comparator, Comparison, StructuredQuery
+
+from Telemetry import span
+
+# The classifier is only trusted when the best subject is at least this similar to the query...
+SUBJECT_CLASSIFIER_MIN_SIMILARITY = float(os.getenv("SUBJECT_CLASSIFIER_MIN_SIMILARITY", "0.3"))
+# ...and beats the second best subject by this margin. Otherwise the LLM query constructor is used.
+SUBJECT_CLASSIFIER_MIN_MARGIN = float(os.getenv("SUBJECT_CLASSIFIER_MIN_MARGIN", "0.05"))
+# Documents per subject averaged into its centroid
+SUBJECT_CLASSIFIER_SAMPLE_SIZE = int(os.getenv("SUBJECT_CLASSIFIER_SAMPLE_SIZE", "200"))
+STRUCTURED_QUERY_CACHE_SIZE = int(os.getenv("STRUCTURED_QUERY_CACHE_SIZE", "1000"))
+
+SEARCH_QUERY_PATTERN = re.compile(r"Search Query:\s*(.+)", re.IGNORECASE)
+
+# Every CachedQueryConstructor, so they can be reset when the knowledge base changes
+_query_constructors = weakref.WeakSet()
+
+
+def invalidate_query_constructors():
+    """Call when documents are added to or removed from the knowledge base.
+
+    Subject centroids are recomputed on the next query, so new material (including a first upload
+    for a subject that had no centroid) affects classification, and cached structured queries are dropped.
+    """
+    for query_constructor in list(_query_constructors):
+        query_constructor.invalidate()
+
+
+def parse_search_query(text):
+    # The history aware retriever's prompt asks for "Search Query: <query>" followed by "Filter: ..."
+    match = SEARCH_QUERY_PATTERN.search(text)
+    return match.group(1).strip() if match else text.strip()
+
+
+def normalize(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector, axis=-1, keepdims=True)
+    return vector / np.where(norm == 0, 1, norm)
+
+
+class SubjectClassifier:
+    """Nearest-centroid subject classifier over the knowledge base embeddings.
+
+    Each subject's centroid is the mean embedding of (a sample of) its documents, read from the
+    vector store on first use and again after invalidate(). Subjects without documents have no
+    centroid and are never chosen, so off-topic queries stay below the similarity threshold and go
+    to the LLM instead.
+    """
+
+    def __init__(self, vectorstore, subjects, sample_size=SUBJECT_CLASSIFIER_SAMPLE_SIZE,
+                 min_similarity=SUBJECT_CLASSIFIER_MIN_SIMILARITY, min_margin=SUBJECT_CLASSIFIER_MIN_MARGIN):
+        self.vectorstore = vectorstore
+        self.subjects = subjects
+        self.sample_size = sample_size
+        self.min_similarity = min_similarity
+        self.min_margin = min_margin
+        self._labels = None
+        self._centroids = None
+        self._lock = threading.Lock()
+
+    def _load_centroids(self):
+        # Returns the labels and centroids together, since invalidate() may reset them at any time
+        with self._lock:
+            if self._centroids is not None:
+                return self._labels, self._centroids
+            labels, centroids = [], []
+            for subject in self.subjects:
+                result = self.vectorstore.get(where={"subject": subject}, include=["embeddings"], limit=self.sample_size)
+                if len(result["embeddings"]):
+                    labels.append(subject)
+                    centroids.append(normalize(normalize(result["embeddings"]).mean(axis=0)))
+            self._labels = labels
+            self._centroids = np.stack(centroids) if centroids else np.zeros((0, 0), dtype=np.float32)
+            print(f"Subject classifier centroids: {', '.join(labels) or 'none'}")
+            return self._labels, self._centroids
+
+    def invalidate(self):
+        with self._lock:
+            self._labels = None
+            self._centroids = None
+
+    def classify(self, text):
+        """Returns (subject, similarity, margin). subject is None when the classifier isn't confident."""
+        labels, centroids = self._load_centroids()
+        if not labels:
+            return None, 0.0, 0.0
+
+        similarities = centroids @ normalize(self.vectorstore.embeddings.embed_query(text))
+        order = np.argsort(similarities)[::-1]
+        best = float(similarities[order[0]])
+        margin = best - float(similarities[order[1]]) if len(order) > 1 else best
+
+        if best < self.min_similarity or margin < self.min_margin:
+            return None, best, margin
+        return labels[order[0]], best, margin
+
+
+class CachedQueryConstructor:
+    """Query constructor for the SelfQueryRetriever that avoids the LLM call when it can.
+
+    Structured queries are cached by the rewritten query. On a cache miss the subject filter comes
+    from the SubjectClassifier, and only when it isn't confident is the LLM query constructor called.
+    """
+
+    def __init__(self, classifier, llm_query_constructor, cache_size=STRUCTURED_QUERY_CACHE_SIZE):
+        self.classifier = classifier
+        self.llm_query_constructor = llm_query_constructor
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"cache_hits": 0, "classified": 0, "llm_fallbacks": 0}
+        _query_constructors.add(self)
+
+    def invalidate(self):
+        with self._lock:
+            self._cache.clear()
+        self.classifier.invalidate()
+
+    def _cache_get(self, key):
+        with self._lock:
+            structured_query = self._cache.get(key)
+            if structured_query is not None:
+                self._cache.move_to_end(key)
+                self._stats["cache_hits"] += 1
+            return structured_query
+
+    def _cache_set(self, key, structured_query, source):
+        with self._lock:
+            self._cache[key] = structured_query
+            self._stats[source] += 1
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _from_subject(self, search_query, subject):
+        return StructuredQuery(
+            query=search_query,
+            filter=Comparison(comparator=Comparator.EQ, attribute="subject", value=subject),
+            limit=None
+        )
+
+    def construct(self, inputs, config):
+        with span("query_construction"):
+            key = " ".join(inputs["query"].lower().split())
+            structured_query = self._cache_get(key)
+            if structured_query is not None:
+                return structured_query
+
+            search_query = parse_search_query(inputs["query"])
+            subject, _, _ = self.classifier.classify(search_query)
+            if subject is not None:
+                structured_query, source = self._from_subject(search_query, subject), "classified"
+            else:
+                structured_query, source = self.llm_query_constructor.invoke(inputs, config), "llm_fallbacks"
+
+            self._cache_set(key, structured_query, source)
+            return structured_query
+
+    async def aconstruct(self, inputs, config):
+        with span("query_construction"):
+            key = " ".join(inputs["query"].lower().split())
+            structured_query = self._cache_get(key)
+            if structured_query is not None:
+                return structured_query
+
+            # Embedding the query is CPU bound, so keep it off the event loop
+            search_query = parse_search_query(inputs["query"])
+            subject, _, _ = await run_in_executor(None, self.classifier.classify, search_query)
+            if subject is not None:
+                structured_query, source = self._from_subject(search_query, subject), "classified"
+            else:
+                structured_query, source = await self.llm_query_constructor.ainvoke(inputs, config), "llm_fallbacks"
+
+            self._cache_set(key, structured_query, source)
+            return structured_query
+
+    def as_runnable(self):
+        return RunnableLambda(self.construct, afunc=self.aconstruct, name="cached_query_constructor")
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, cached=len(self._cache))
@@ -0,0 +1,258 @@
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.embeddings import Embeddings
+
+# Number of recent chat turn traces kept in memory for /traces
+TELEMETRY_TRACE_HISTORY = int(os.getenv("TELEMETRY_TRACE_HISTORY", "200"))
+
+# Histogram buckets in seconds, from fast cache/MySQL calls up to slow LLM answers
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# The trace of the chat turn being processed and the span code is currently running in
+_current_trace = ContextVar("current_trace", default=None)
+_current_span = ContextVar("current_span", default=None)
+
+
+def new_id():
+    return uuid.uuid4().hex[:16]
+
+
+class Histogram:
+    """Prometheus style histogram with one label."""
+
+    def __init__(self, name, description, label, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.buckets = buckets
+        self._series = {}  # label value -> [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, seconds):
+        with self._lock:
+            series = self._series.setdefault(value, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series[0][i] += 1
+            series[1] += seconds
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for value, (counts, total, count) in sorted(self._series.items()):
+                label = f'{self.label}="{value}"'
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {bucket_count}')
+                lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {count}')
+                lines.append(f"{self.name}_sum{{{label}}} {total}")
+                lines.append(f"{self.name}_count{{{label}}} {count}")
+        return lines
+
+
+turn_latency = Histogram("chat_turn_duration_seconds", "Time to answer a chat turn", "endpoint")
+stage_latency = Histogram("chat_stage_duration_seconds", "Time spent in each stage of a chat turn", "stage")
+
+
+class Trace:
+    """Spans of one chat turn, in the style of an OpenTelemetry trace.
+
+    The root span covers the request. Spans recorded by the post-response tasks of the turn
+    (resources, title, summary, save) are added to the same trace when they finish, after it ended.
+    """
+
+    def __init__(self, name, **attributes):
+        self.trace_id = uuid.uuid4().hex
+        self.root_id = new_id()
+        self.name = name
+        self.attributes = attributes
+        self.start = time.time()
+        self.duration = None
+        self.spans = []
+        self._started = time.perf_counter()
+        self._lock = threading.Lock()
+        recent_traces.append(self)
+
+    def add(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def end(self):
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self._started
+        turn_latency.observe(self.name, self.duration)
+
+        # Time per stage, so slow turns show where the time went
+        stages = {}
+        with self._lock:
+            for span in self.spans:
+                stages[span["name"]] = stages.get(span["name"], 0.0) + span["duration"]
+        breakdown = ", ".join(f"{name} {duration:.2f}s" for name, duration in stages.items())
+        print(f"Trace {self.trace_id[:8]} {self.name} took {self.duration:.2f}s: {breakdown}")
+
+    def to_dict(self):
+        with self._lock:
+            spans = list(self.spans)
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.root_id,
+            "name": self.name,
+            "attributes": self.attributes,
+            "start": self.start,
+            "duration": self.duration,
+            "spans": spans,
+        }
+
+
+recent_traces = deque(maxlen=TELEMETRY_TRACE_HISTORY)
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+@contextmanager
+def use_trace(trace):
+    """Runs the block as part of `trace`, e.g. a post-response task of the turn that started it."""
+    previous_trace, previous_span = _current_trace.get(), _current_span.get()
+    # Plain set() instead of reset(token): streaming responses can be closed from another context
+    _current_trace.set(trace)
+    _current_span.set(trace.root_id if trace else None)
+    try:
+        yield trace
+    finally:
+        _current_trace.set(previous_trace)
+        _current_span.set(previous_span)
+
+
+@contextmanager
+def trace(name, **attributes):
+    """Traces a chat turn. Spans opened inside the block are recorded as part of it."""
+    turn = Trace(name, **attributes)
+    with use_trace(turn):
+        try:
+            yield turn
+        finally:
+            turn.end()
+
+
+def record_span(name, duration, parent_id=None, span_id=None, **attributes):
+    """Records a span that was timed by the caller, e.g. how long a MySQL connection was held."""
+    stage_latency.observe(name, duration)
+    turn = _current_trace.get()
+    if turn is not None:
+        turn.add({
+            "span_id": span_id or new_id(),
+            "parent_id": parent_id or _current_span.get(),
+            "name": name,
+            "start": time.time() - duration,
+            "duration": duration,
+            "attributes": attributes,
+        })
+
+
+@contextmanager
+def span(name, **attributes):
+    """Times the block as a stage of the current chat turn. Works in both sync and async code."""
+    span_id, parent_id = new_id(), _current_span.get()
+    _current_span.set(span_id)
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        attributes["error"] = repr(e)
+        raise
+    finally:
+        _current_span.set(parent_id)
+        record_span(name, time.perf_counter() - start, parent_id=parent_id, span_id=span_id, **attributes)
+
+
+class LLMSpanHandler(BaseCallbackHandler):
+    """Records a span for every LLM call of the chat chain.
+
+    The span is named after the innermost tag of the call (see chain.py, which tags the query
+    rewrite, query construction and answer models), or "llm" if it has none.
+    """
+
+    # Run in the caller's context, so the span's parent and trace are the ones of the chain call
+    run_inline = True
+
+    def __init__(self):
+        self._runs = {}
+        self._lock = threading.Lock()
+
+    def _start(self, run_id, tags):
+        with self._lock:
+            self._runs[run_id] = (tags[-1] if tags else "llm", _current_trace.get(), _current_span.get(), time.perf_counter())
+
+    def _end(self, run_id, **attributes):
+        with self._lock:
+            run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        name, turn, parent_id, start = run
+        with use_trace(turn):
+            record_span(name, time.perf_counter() - start, parent_id=parent_id, **attributes)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, tags=None, **kwargs):
+        self._start(run_id, tags)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, tags=None, **kwargs):
+        self._start(run_id, tags)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error=repr(error))
+
+
+# Shared handler passed to the chat chain's calls in app.py
+llm_spans = LLMSpanHandler()
+
+
+class TracedEmbeddings(Embeddings):
+    """Wraps embeddings so every query embedding is recorded as an "embedding" span."""
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        with span("embedding"):
+            return self.embeddings.embed_query(text)
+
+
+def format_stats(prefix, stats):
+    # Component stats (see the stats() methods of the caches and pools) as Prometheus gauges.
+    # Nested dicts, like the session cache namespaces, become part of the metric name.
+    lines = []
+    for key, value in stats.items():
+        name = f"{prefix}_{key}"
+        if isinstance(value, dict):
+            lines.extend(format_stats(name, value))
+        elif isinstance(value, (int, float)):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {float(value)}")
+    return lines
+
+
+def render_metrics(components):
+    """Prometheus text exposition of the latency histograms and the given {prefix: stats} dict."""
+    lines = turn_latency.render() + stage_latency.render()
+    for prefix, stats in components.items():
+        lines.extend(format_stats(prefix, stats))
+    return "\n".join(lines) + "\n"
+
+
+def get_traces(limit):
+    return [turn.to_dict() for turn in list(recent_traces)[-limit:]][::-1]
@@ -0,0 +1,52 @@
+import os
+import threading
+
+from Telemetry import TracedEmbeddings
+from EmbeddingService import EmbeddingService
+
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-mpnet-base-v2")
+
+# Vector stores used by the app
+KNOWLEDGE_BASE_DIR = "../knowledge_base"  # lecture materials, searched by the chat chain
+
+_embeddings = None
+_vectorstores = {}
+_lock = threading.Lock()
+
+
+def get_embeddings():
+    """The embedding model shared by every module, loaded on first use.
+
+    Loading all-mpnet-base-v2 takes a few seconds and ~420MB, so it must only happen once per process.
+    The backend, batch size and threads come from EMBEDDING_* (see EmbeddingService.py). Query
+    embeddings are recorded as spans of the current chat turn.
+    """
+    global _embeddings
+    if _embeddings is None:
+        with _lock:
+            if _embeddings is None:
+                service = EmbeddingService(EMBEDDING_MODEL)
+                print(f"Loaded embedding model {EMBEDDING_MODEL} ({service.backend}, batch size {service.batch_size})")
+                _embeddings = TracedEmbeddings(service)
+    return _embeddings
+
+
+def warm_up_embeddings():
+    # Loads the model and runs it once, since the first embedding is much slower than the rest.
+    # Uses the untraced model so this doesn't show up in the chat turn latencies.
+    get_embeddings().embeddings.embed_query("warm-up")
+
+
+def get_vectorstore(persist_directory):
+    """The Chroma store persisted in `persist_directory`, opened on first use and shared afterwards."""
+    vectorstore = _vectorstores.get(persist_directory)
+    if vectorstore is None:
+        embeddings = get_embeddings()
+        with _lock:
+            vectorstore = _vectorstores.get(persist_directory)
+            if vectorstore is None:
+                # Imported here because chromadb is slow to import
+                from langchain_chroma import Chroma # type: ignore
+                vectorstore = Chroma(persist_directory=persist_directory, embedding_function=embeddings)
+                _vectorstores[persist_directory] = vectorstore
+    return vectorstore
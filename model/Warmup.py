@@ -0,0 +1,68 @@
+import asyncio
+import time
+from fastapi.concurrency import run_in_threadpool
+
+
+class Warmup:
+    """Slow start-up work, run in the background once the server is accepting requests.
+
+    Every step is something the app would otherwise do lazily on first use (load the embedding
+    model, open the knowledge base, build the chain, ...), so requests are served before warm-up
+    has finished, just more slowly. /ready reports not ready until every required step has
+    succeeded, so load balancers only send traffic to warm workers. Steps run one after another
+    in the order they were added and can be plain functions (run in the threadpool) or coroutine
+    functions.
+    """
+
+    def __init__(self):
+        self._steps = []
+        self._results = {}
+        self._started = None
+        self._finished = None
+        self._task = None
+
+    def add(self, name, func, required=True):
+        self._steps.append((name, func, required))
+        self._results[name] = {"status": "pending", "required": required}
+
+    def start(self):
+        # Keep a reference so the task isn't garbage collected while it runs
+        self._task = asyncio.create_task(self.run())
+
+    async def run(self):
+        self._started = time.perf_counter()
+        for name, func, required in self._steps:
+            result = self._results[name]
+            result["status"] = "running"
+            start = time.perf_counter()
+            try:
+                if asyncio.iscoroutinefunction(func):
+                    await func()
+                else:
+                    await run_in_threadpool(func)
+                result["status"] = "done"
+            except Exception as e:
+                # Optional steps (e.g. ones that need MySQL) are retried lazily on first use
+                result["status"] = "failed"
+                result["error"] = str(e)
+                print(f"Warm-up step {name} failed{'' if required else ' (optional)'}: {e}")
+            result["seconds"] = round(time.perf_counter() - start, 3)
+        self._finished = time.perf_counter()
+
+        steps = ", ".join(f"{name} {result['seconds']:.2f}s" for name, result in self._results.items())
+        print(f"Warm-up finished in {self._finished - self._started:.2f}s: {steps}")
+
+    def is_ready(self):
+        return all(result["status"] == "done" for result in self._results.values() if result["required"])
+
+    def status(self):
+        now = self._finished or time.perf_counter()
+        return {
+            "ready": self.is_ready(),
+            "seconds": round(now - self._started, 3) if self._started is not None else None,
+            "steps": {name: dict(result) for name, result in self._results.items()},
+        }
+
+
+# Shared warm-up run by the server on startup
+warmup = Warmup()
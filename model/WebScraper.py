@@ -4,8 +4,15 @@ from langchain_groq import ChatGroq
 from langchain_openai import ChatOpenAI
 from dotenv import load_dotenv
 from google.oauth2 import service_account
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
+from concurrent.futures import ThreadPoolExecutor
+import httplib2
 import os
+import threading
+import time
+
+from ResourceCache import resource_cache, is_self_contained
 
 load_dotenv()
 groq_api_key=os.getenv('GROQ_API_KEY')
@@ -21,11 +28,45 @@ YOUTUBE_API_KEY = os.getenv("YOUTUBE_API_KEY")
 # Custom Search Engine ID
 CSE_ID = os.getenv('CSE_ID')
 
+# Seconds to wait for the YouTube and web searches. Whatever hasn't arrived by then is left out.
+RESOURCE_SEARCH_TIMEOUT = float(os.getenv("RESOURCE_SEARCH_TIMEOUT", "10"))
+# Threads that run the searches. Both searches of a turn run at the same time.
+search_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="resource-search")
+
+# The service account credentials are loaded once and shared. The API clients are built once per
+# search thread because they share an httplib2 connection, which isn't thread-safe.
+credentials = None
+credentials_lock = threading.Lock()
+clients = threading.local()
+
+def get_credentials():
+    global credentials
+    with credentials_lock:
+        if credentials is None:
+            # Load the credentials from the service account file
+            credentials = service_account.Credentials.from_service_account_file(
+                SERVICE_ACCOUNT_FILE, scopes=["https://www.googleapis.com/auth/cse", "https://www.googleapis.com/auth/cloud-platform"]
+            )
+    return credentials
+
+def get_youtube_client():
+    if not hasattr(clients, "youtube"):
+        clients.youtube = build('youtube', 'v3', developerKey=YOUTUBE_API_KEY,
+                                http=httplib2.Http(timeout=RESOURCE_SEARCH_TIMEOUT))
+    return clients.youtube
+
+def get_search_client():
+    if not hasattr(clients, "customsearch"):
+        # Build the custom search service
+        http = AuthorizedHttp(get_credentials(), http=httplib2.Http(timeout=RESOURCE_SEARCH_TIMEOUT))
+        clients.customsearch = build("customsearch", "v1", http=http)
+    return clients.customsearch
+
 def fetch_youtube_videos(query, max_results=3):
     """
     Fetch top YouTube video links related to the query using YouTube Data API.
     """
-    youtube = build('youtube', 'v3', developerKey=YOUTUBE_API_KEY)
+    youtube = get_youtube_client()
     search_response = youtube.search().list(
         q=query,
         part='snippet',
@@ -43,13 +84,7 @@ def fetch_youtube_videos(query, max_results=3):
     return videos
 
 def google_search(query, num_results=3):
-    # Load the credentials from the service account file
-    credentials = service_account.Credentials.from_service_account_file(
-        SERVICE_ACCOUNT_FILE, scopes=["https://www.googleapis.com/auth/cse", "https://www.googleapis.com/auth/cloud-platform"]
-    )
-
-    # Build the custom search service
-    service = build("customsearch", "v1", credentials=credentials)
+    service = get_search_client()
 
     # Call the search API
     result = service.cse().list(q=query, cx=CSE_ID, num=num_results).execute()
@@ -87,20 +122,47 @@ def fetch_recommended_resources(input_text, response, chat_history):
     This function fetches recommended resources like YouTube videos and web articles
     based on the search_query.
     """
+    # A question that doesn't depend on the conversation can reuse the resources found for the
+    # same or a near-identical question, without generating a search query
+    self_contained = is_self_contained(input_text)
+    if self_contained:
+        resources = resource_cache.lookup(input_text)
+        if resources is not None:
+            return resources
+
     # Use the response or input_text for the search
     search_query = generate_query(input_text, response, chat_history)
     print(search_query)
 
-    # Get recommended YouTube videos
-    youtube_videos = fetch_youtube_videos(search_query)
-
-    # Get recommended web articles
-    web_articles = google_search(search_query)
-
-    # Combine and return all resources
-    resources = {
-        "YouTube Videos": youtube_videos,
-        "Web Articles": web_articles,
+    resources = resource_cache.lookup(search_query)
+    if resources is None:
+        resources, complete = search_resources(search_query)
+        # Partial results are returned but not cached, so the next turn with this query tries again
+        if not complete:
+            return resources
+        resource_cache.store(search_query, resources)
+
+    if self_contained:
+        resource_cache.store(input_text, resources)
+    return resources
+
+def search_resources(search_query):
+    # Get recommended YouTube videos and web articles at the same time
+    searches = {
+        "YouTube Videos": search_pool.submit(fetch_youtube_videos, search_query),
+        "Web Articles": search_pool.submit(google_search, search_query),
     }
 
-    return resources
\ No newline at end of file
+    # Combine and return all resources, and whether every search succeeded
+    resources = {}
+    complete = True
+    deadline = time.monotonic() + RESOURCE_SEARCH_TIMEOUT
+    for name, search in searches.items():
+        try:
+            resources[name] = search.result(timeout=max(0, deadline - time.monotonic()))
+        except Exception as e:
+            print(f"Error fetching {name} for '{search_query}': {e!r}")
+            resources[name] = []
+            complete = False
+
+    return resources, complete
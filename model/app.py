@@ -1,18 +1,25 @@
 from langchain_openai import OpenAIEmbeddings
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_chroma import Chroma # type: ignore
 from langchain_core.messages import HumanMessage, AIMessage
 from dotenv import load_dotenv
 import os
 import time
 import warnings
 from fastapi import BackgroundTasks
+from fastapi.concurrency import run_in_threadpool
 
 from chain import create_chain
-from ChatStoreSQL import save_chat_history, get_instruction, update_personalization_params, get_courses_and_subjects, store_mentor_query
+from ChatStoreSQL import (append_chat_messages, save_chat_summary, update_chat_message, load_chat_data, ChatVersionConflict,
+                          update_personalization_params, store_mentor_query)
 from ChatSummarizer import summarize_chat_history
 from TitleGenerator import generate_chat_title
 from WebScraper import fetch_recommended_resources
+from ChatTaskQueue import chat_tasks
+from SessionCache import CHAT_HISTORY_WINDOW, trim_chat_history
+from InstructionRegistry import instruction_registry
+from Curriculum import curriculum_cache
+from ResponseCache import response_cache, personalization_key, is_cacheable
+from Telemetry import span, llm_spans
+from VectorStores import get_embeddings, get_vectorstore, KNOWLEDGE_BASE_DIR
 
 load_dotenv()
 os.environ["LANGCHAIN_TRACING_V2"]="true"
@@ -20,32 +27,127 @@ os.environ["LANGCHAIN_API_KEY"]=os.getenv("LANGCHAIN_API_KEY")
 warnings.filterwarnings("ignore", category=FutureWarning, module="transformers")
 
 
-# Pre-load the vector store and chain
-embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-mpnet-base-v2")
-chroma = Chroma(persist_directory="../knowledge_base", embedding_function=embeddings)
-chain = create_chain(chroma)
+# The chain is built on first use (or during warm-up, see server.py) from the cached curriculum subjects.
+# The embedding model and knowledge base store are shared with file processing and uploads (see VectorStores.py).
+chain = None
+chain_subjects = None
 
 
-def process_chat(chain, question, extract, chat_history, chat_summary, personalization, notes, feedback):
-    response = chain.invoke({
+# Returns the retrieval chain, rebuilding it when the curriculum subjects have changed (e.g. after /refresh-curriculum)
+async def get_chain():
+    global chain, chain_subjects
+    subjects = await curriculum_cache.filter_subjects()
+    if chain is None or subjects != chain_subjects:
+        vectorStore = await run_in_threadpool(get_vectorstore, KNOWLEDGE_BASE_DIR)
+        chain = create_chain(vectorStore, subjects)
+        chain_subjects = subjects
+    return chain
+
+
+# Returned instead of the model's answer when no relevant documents are found
+OUT_OF_CONTEXT_RESPONSE = "Your query is outside of my knowledge. Apologies for the inconvenience. This question will be directed to a mentor."
+
+
+async def build_chain_input(question, extract, chat_history, chat_summary, personalization, notes, feedback):
+    # Instructions come from the in-memory registry, which only goes to MySQL when its copy is stale
+    student_type, learning_style, communication_format, tone_style, reasoning_framework = await instruction_registry.get_many([
+        personalization['student_type'],
+        personalization['learning_style'],
+        personalization['communication_format'],
+        personalization['tone_style'],
+        personalization['reasoning_framework']
+    ])
+
+    return {
         "input": question,
         "extract": extract,
         "chat_history": chat_history,
         "chat_summary": chat_summary,
-        "student_type" : get_instruction(personalization['student_type']),
-        "learning_style" : get_instruction(personalization['learning_style']),
-        "communication_format" : get_instruction(personalization['communication_format']),
-        "tone_style" : get_instruction(personalization['tone_style']),
-        "reasoning_framework" : get_instruction(personalization['reasoning_framework']),
+        "student_type" : student_type,
+        "learning_style" : learning_style,
+        "communication_format" : communication_format,
+        "tone_style" : tone_style,
+        "reasoning_framework" : reasoning_framework,
         "mentor_notes" : notes,
         "feedback" : feedback
-    })
+    }
+
+
+# Looks up a stored answer to the same or a very similar question asked with the same personalization.
+# Returns the cache key and question embedding (None if the question can't be cached) and the cached entry, if any.
+async def lookup_cached_response(question, extract, personalization, notes, feedback):
+    if not is_cacheable(question, extract):
+        return None, None, None
+
+    with span("response_cache_lookup"):
+        cache_key = personalization_key(personalization, notes, feedback)
+        embedding = await run_in_threadpool(lambda: get_embeddings().embed_query(question))
+        cached = response_cache.lookup(cache_key, embedding)
+
+        # Documents can be removed from the knowledge base outside this server, so check the answer's sources still exist
+        if cached and cached["doc_ids"]:
+            stored = await run_in_threadpool(lambda: get_vectorstore(KNOWLEDGE_BASE_DIR).get(ids=cached["doc_ids"], include=[]))
+            if len(stored["ids"]) < len(set(cached["doc_ids"])):
+                response_cache.discard(cached["id"])
+                cached = None
+
+    if cached:
+        print(f"Reusing the answer to '{cached['question']}' (similarity {cached['similarity']:.3f})")
+    return cache_key, embedding, cached
+
+
+async def process_chat(chain, question, extract, chat_history, chat_summary, personalization, notes, feedback):
+    cache_key, embedding, cached = await lookup_cached_response(question, extract, personalization, notes, feedback)
+    if cached:
+        return cached["response"], cached["context"], ""
+
+    generation = response_cache.generation
+    chain_input = await build_chain_input(question, extract, chat_history, chat_summary, personalization, notes, feedback)
+    response = await chain.ainvoke(chain_input, config={"callbacks": [llm_spans]})
 
     # This condition is to handle out of context queries
     if response["context"] == []:
-        return "Your query is outside of my knowledge. Apologies for the inconvenience. This question will be directed to a mentor.", [], response["answer"]
+        return OUT_OF_CONTEXT_RESPONSE, [], response["answer"]
     else:
+        if cache_key:
+            response_cache.store(cache_key, embedding, question, response["answer"], response["context"], generation)
         return response["answer"], response["context"], ""
+
+
+async def stream_chat(chain, question, extract, chat_history, chat_summary, personalization, notes, feedback):
+    """Streaming version of process_chat.
+
+    Yields ("token", text) for each piece of the answer as the LLM produces it, followed by a single
+    ("result", (response, context, internal_response)) with the same values process_chat returns.
+    """
+    cache_key, embedding, cached = await lookup_cached_response(question, extract, personalization, notes, feedback)
+    if cached:
+        yield "token", cached["response"]
+        yield "result", (cached["response"], cached["context"], "")
+        return
+
+    generation = response_cache.generation
+    chain_input = await build_chain_input(question, extract, chat_history, chat_summary, personalization, notes, feedback)
+
+    context = None
+    answer = ""
+    async for chunk in chain.astream(chain_input, config={"callbacks": [llm_spans]}):
+        # The retrieved documents arrive in one chunk before any answer tokens
+        if "context" in chunk:
+            context = chunk["context"]
+        if "answer" in chunk:
+            answer += chunk["answer"]
+            # Out of context answers are replaced by a fixed message, so don't stream them
+            if context:
+                yield "token", chunk["answer"]
+
+    if not context:
+        yield "token", OUT_OF_CONTEXT_RESPONSE
+        yield "result", (OUT_OF_CONTEXT_RESPONSE, [], answer)
+    else:
+        if cache_key:
+            response_cache.store(cache_key, embedding, question, answer, context, generation)
+        yield "result", (answer, context, "")
     
 
 # This function processes the context and returns a list of strings.
@@ -73,73 +175,174 @@ def process_context(context):
     return result_lines, files
 
 
-def update_chat_history_and_summary(ChatID, UserID, input_text, mediaType, fileName, chat_history, response, context, files, internal_response, personalization, chat_summary):
+def message_index(chat_history, message):
+    # Position of `message` itself in the session history (messages with the same content compare equal)
+    return next((i for i, other in enumerate(chat_history) if other is message), None)
+
+
+async def save_turn(ChatID, UserID, chat_data, last_message):
+    """Saves the chat's unsaved messages up to `last_message`, the end of a turn, and updates the cached session in place.
+
+    Later turns may already be in the session while this runs, they are saved by their own call.
+    """
+    async with chat_data["save_lock"]:
+        saved_count = chat_data["saved_count"]
+        unsaved_from = saved_count - chat_data["first_seq"]
+        turn_end = message_index(chat_data["chat_history"], last_message)
+        if turn_end is None or turn_end < unsaved_from:
+            # Already saved (and maybe trimmed from the session), e.g. along with a later turn
+            return
+        new_messages = chat_data["chat_history"][unsaved_from:turn_end + 1]
+
+        try:
+            await run_in_threadpool(append_chat_messages, ChatID, UserID, new_messages, saved_count)
+        except ChatVersionConflict:
+            # Someone else saved messages for this chat since it was loaded. Put the messages that only
+            # exist in this session after the stored ones and save again.
+            print(f"Chat {ChatID} was modified by another writer, merging")
+            stored = await run_in_threadpool(load_chat_data, ChatID, CHAT_HISTORY_WINDOW)
+            saved_count = stored["message_count"]
+            await run_in_threadpool(append_chat_messages, ChatID, UserID, new_messages, saved_count)
+
+            # Keep any messages appended by turns that finished while this was running
+            chat_data["chat_history"][:] = stored["chat_history"] + chat_data["chat_history"][unsaved_from:]
+            chat_data["first_seq"] = stored["first_seq"]
+
+        chat_data["saved_count"] = saved_count + len(new_messages)
+        trim_chat_history(chat_data)
+
+
+# The functions below run after the response has been sent, through the per-chat task queue.
+# Tasks for a chat run in submission order, so each one sees the state left by the previous turn.
+# The turn's messages are already saved, so if these are lost (e.g. in a restart) the chat only
+# misses its resources, title or summary update.
+def update_recommended_resources(ChatID, UserID, input_text, response, context, internal_response, latest_chat_history, ai_message, chat_data):
     if context == []:
         resources = []
         store_mentor_query(UserID, input_text, internal_response)
     else:
-        resources = fetch_recommended_resources(input_text, response, chat_history[-10:])
-    
-    # Store input and response in chat history
-    chat_history.append(HumanMessage(content=input_text, response_metadata={"mediaType": mediaType, "fileName": fileName}))
-    chat_history.append(AIMessage(content=response, response_metadata={"context": resources, "files": files}))
+        with span("resource_recommendation"):
+            resources = fetch_recommended_resources(input_text, response, latest_chat_history)
+
+    ai_message.response_metadata["context"] = resources
+
+    # The message was saved without its resources. If its save failed, they are saved along with it later.
+    index = message_index(chat_data["chat_history"], ai_message)
+    if index is not None and chat_data["first_seq"] + index < chat_data["saved_count"]:
+        update_chat_message(ChatID, chat_data["first_seq"] + index, ai_message)
 
+
+def update_chat_title(ChatID, UserID, chat_history, personalization):
     if personalization["chat_title"] == "":
-        personalization["chat_title"] = generate_chat_title(chat_history)
-        update_personalization_params(ChatID, UserID, personalization["chat_title"], 
+        with span("title_generation"):
+            chat_title = generate_chat_title(chat_history)
+        update_personalization_params(ChatID, UserID, chat_title, 
                                         personalization["learning_style"], personalization["communication_format"], 
                                         personalization["tone_style"], personalization["reasoning_framework"])
+        personalization["chat_title"] = chat_title
 
-    # This contains the latest history with the current user query and response added.
-    latest_chat_history = chat_history[-10:]  # Use the last 10 interactions
-    # Chat summary is generated using the latest chat history and existing chat summary.
-    new_chat_summary = summarize_chat_history(chat_summary, latest_chat_history)
-    
-    # Save the chat history and new summary
-    save_chat_history(ChatID, UserID, chat_history, new_chat_summary)
+
+def update_chat_summary(ChatID, latest_chat_history, chat_data):
+    # The summary is read when the task runs (not when the turn was answered) so that turns
+    # arriving back-to-back build on each other's summaries.
+    with span("summarization"):
+        new_chat_summary = summarize_chat_history(chat_data["chat_summary"], latest_chat_history)
+    with span("save"):
+        save_chat_summary(ChatID, new_chat_summary)
+    chat_data["chat_summary"] = new_chat_summary
     print("task completed")
 
 
-def run_model(ChatID, UserID, input_text, extract, mediaType, fileName, preloaded_data, background_tasks: BackgroundTasks):
-    data = get_courses_and_subjects()
-    courses = [entry["Course"] for entry in data]
-    subjects = [entry["Subject"] for entry in data]
+async def record_turn(ChatID, UserID, input_text, mediaType, fileName, response, context, internal_response, files, chat_data):
+    chat_history = chat_data["chat_history"]
+    personalization = chat_data["personalization"]
+    latest_chat_history = chat_history[-10:]
 
-    # Remove duplicates by converting to a set, then back to a list
-    distinct_courses = list(set(courses))
-    distinct_subjects = list(set(subjects))
+    # Store input and response in chat history right away so the next turn sees them
+    ai_message = AIMessage(content=response, response_metadata={"context": [], "files": files})
+    chat_history.extend([
+        HumanMessage(content=input_text, response_metadata={"mediaType": mediaType, "fileName": fileName}),
+        ai_message
+    ])
+    # This contains the latest history with the current user query and response added.
+    updated_chat_history = chat_history[-10:]
 
-    # Optionally, sort the lists for better readability
-    distinct_courses.sort()
-    distinct_subjects.sort()
+    # The messages are saved before the response is returned, so a crash or redeploy can't lose a
+    # turn the user has already seen
+    with span("save"):
+        try:
+            await save_turn(ChatID, UserID, chat_data, ai_message)
+        except Exception as e:
+            # Retried after the response. The next turn's save includes these messages as well.
+            print(f"Error saving turn of ChatID {ChatID}, retrying in the background: {e}")
+            chat_tasks.submit(ChatID, save_turn, ChatID, UserID, chat_data, ai_message)
 
-    # Create comma-separated strings
-    courses_string = ", ".join(distinct_courses)
-    subjects_string = ", ".join(distinct_subjects)
-    # TODO: Add the courses and subjects to process chat
+    # Recommended resources, chat title and summary don't affect the answer, so they run after the
+    # response is sent.
+    # Kept so /fetch-resources can wait for the resources without waiting for the title and summary
+    chat_data["resources_task"] = chat_tasks.submit(ChatID, update_recommended_resources, ChatID, UserID, input_text, response, context, internal_response, latest_chat_history, ai_message, chat_data)
+    chat_tasks.submit(ChatID, update_chat_title, ChatID, UserID, chat_history, personalization)
+    chat_tasks.submit(ChatID, update_chat_summary, ChatID, updated_chat_history, chat_data)
 
-    print("Courses:", courses_string)
-    print("Subjects:", subjects_string)
-    
-    chat_history = preloaded_data[ChatID]["chat_history"]
-    chat_summary = preloaded_data[ChatID]["chat_summary"]
-    personalization = preloaded_data[ChatID]["personalization"]
-    notes = preloaded_data[UserID]["notes"]
-    feedback = preloaded_data[UserID]["feedback"]
+
+async def run_model(ChatID, UserID, input_text, extract, mediaType, fileName, chat_data, user_data, background_tasks: BackgroundTasks):
+    chain = await get_chain()
+
+    chat_history = chat_data["chat_history"]
+    chat_summary = chat_data["chat_summary"]
+    personalization = chat_data["personalization"]
+    notes = user_data["notes"]
+    feedback = user_data["feedback"]
 
     if input_text:
         start=time.time()
 
         # Only the latest 5 query-response pairs are used in processing phase. This maintains a fixed token size.
         latest_chat_history = chat_history[-10:]
-        response, context, internal_response = process_chat(chain, input_text, extract, latest_chat_history, chat_summary, personalization, notes, feedback)
+        response, context, internal_response = await process_chat(chain, input_text, extract, latest_chat_history, chat_summary, personalization, notes, feedback)
         formatted_string, files = process_context(context)
         response_time = str(time.time()-start)
         print(response_time)
         response_str = {"response":response, "response_time":response_time, "context":formatted_string, "files":files}
 
-        # Offload the chat history and summary updates to a background task
-        update_chat_history_and_summary(ChatID, UserID, input_text, mediaType, fileName, chat_history, response, context, files, internal_response, personalization, chat_summary)
+        await record_turn(ChatID, UserID, input_text, mediaType, fileName, response, context, internal_response, files, chat_data)
+
+        return (response_str)
+
+
+async def stream_model(ChatID, UserID, input_text, extract, mediaType, fileName, chat_data, user_data):
+    """Streaming version of run_model.
+
+    Yields ("token", text) events while the answer is generated and a final ("done", response_str)
+    event carrying the same payload run_model returns. The turn is recorded after the stream ends.
+    """
+    chain = await get_chain()
+
+    chat_history = chat_data["chat_history"]
+    chat_summary = chat_data["chat_summary"]
+    personalization = chat_data["personalization"]
+    notes = user_data["notes"]
+    feedback = user_data["feedback"]
+
+    if input_text:
+        start=time.time()
+        first_token_time = None
+
+        # Only the latest 5 query-response pairs are used in processing phase. This maintains a fixed token size.
+        latest_chat_history = chat_history[-10:]
+        async for event, value in stream_chat(chain, input_text, extract, latest_chat_history, chat_summary, personalization, notes, feedback):
+            if event == "token":
+                if first_token_time is None:
+                    first_token_time = time.time()-start
+                yield "token", value
+            else:
+                response, context, internal_response = value
+
+        formatted_string, files = process_context(context)
+        response_time = str(time.time()-start)
+        print(f"First token: {first_token_time}, total: {response_time}")
+        response_str = {"response":response, "response_time":response_time, "first_token_time":str(first_token_time), "context":formatted_string, "files":files}
 
+        await record_turn(ChatID, UserID, input_text, mediaType, fileName, response, context, internal_response, files, chat_data)
 
-        return (response_str)
\ No newline at end of file
+        yield "done", response_str
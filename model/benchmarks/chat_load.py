@@ -0,0 +1,134 @@
+"""Load test for the /run-model endpoint.
+
+Runs 1, 10 and 50 concurrent chats against a running server and reports p50/p99 latency for
+/run-model, together with the latency of a lightweight endpoint (/get-chat-ids) probed while the
+chats are in flight. If the event loop is blocked by a chat turn the probe latency climbs with it.
+
+Usage (from the model directory, with the server running):
+    python -m benchmarks.chat_load --user-id student@example.com --turns 3
+
+The user must already exist in User_data (a date of birth is required to create chats).
+"""
+import argparse
+import asyncio
+import random
+import string
+import time
+import httpx
+
+QUESTIONS = [
+    "What is a for loop?",
+    "How does a resistor limit current?",
+    "Explain what a microcontroller does.",
+    "What is the difference between a list and a tuple in Python?",
+    "How do I debounce a push button?",
+    "What is Ohm's law?",
+]
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def random_chat_id():
+    return "load" + "".join(random.choices(string.ascii_letters + string.digits, k=6))
+
+
+async def create_chat(client, chat_id, user_id):
+    response = await client.post("/update-personalization", json={
+        "ChatID": chat_id,
+        "UserID": user_id,
+        "chat_title": "Load test",
+        "learning_style": "Verbal",
+        "communication_format": "Textbook",
+        "tone_style": "Neutral",
+        "reasoning_framework": "Deductive"
+    })
+    response.raise_for_status()
+
+
+async def run_chat(client, chat_id, user_id, turns, latencies, errors):
+    for _ in range(turns):
+        start = time.perf_counter()
+        try:
+            response = await client.post("/run-model", data={
+                "ChatID": chat_id,
+                "UserID": user_id,
+                "input_text": random.choice(QUESTIONS),
+                "mediaType": "text",
+                "fileName": "text"
+            })
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+        except httpx.HTTPError as e:
+            errors.append(str(e))
+
+
+async def probe(client, stop, latencies):
+    while not stop.is_set():
+        start = time.perf_counter()
+        try:
+            response = await client.get("/get-chat-ids")
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(0.5)
+
+
+async def run_level(base_url, user_id, concurrency, turns, timeout):
+    limits = httpx.Limits(max_connections=concurrency + 5)
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits) as client:
+        chat_ids = [random_chat_id() for _ in range(concurrency)]
+        await asyncio.gather(*(create_chat(client, chat_id, user_id) for chat_id in chat_ids))
+
+        latencies, errors, probe_latencies = [], [], []
+        stop = asyncio.Event()
+        probe_task = asyncio.create_task(probe(client, stop, probe_latencies))
+
+        start = time.perf_counter()
+        await asyncio.gather(*(run_chat(client, chat_id, user_id, turns, latencies, errors) for chat_id in chat_ids))
+        elapsed = time.perf_counter() - start
+
+        stop.set()
+        await probe_task
+
+        # Remove the chats created for this run
+        await asyncio.gather(*(client.post("/delete-chat", json={"chat_id": chat_id}) for chat_id in chat_ids))
+
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": len(errors),
+        "elapsed": elapsed,
+        "p50": percentile(latencies, 50),
+        "p99": percentile(latencies, 99),
+        "probe_p50": percentile(probe_latencies, 50),
+        "probe_p99": percentile(probe_latencies, 99),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Concurrent chat load test for /run-model")
+    parser.add_argument("--base-url", default="http://127.0.0.1:8000")
+    parser.add_argument("--user-id", required=True, help="Existing UserID to create the test chats under")
+    parser.add_argument("--turns", type=int, default=3, help="Chat turns sent by each concurrent chat")
+    parser.add_argument("--levels", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--timeout", type=float, default=300)
+    args = parser.parse_args()
+
+    print(f"{'chats':>6} {'reqs':>5} {'errs':>5} {'p50 (s)':>8} {'p99 (s)':>8} {'probe p50':>10} {'probe p99':>10} {'req/s':>6}")
+    for level in args.levels:
+        result = await run_level(args.base_url, args.user_id, level, args.turns, args.timeout)
+        throughput = result["requests"] / result["elapsed"] if result["elapsed"] else 0.0
+        print(f"{result['concurrency']:>6} {result['requests']:>5} {result['errors']:>5} "
+              f"{result['p50']:>8.2f} {result['p99']:>8.2f} "
+              f"{result['probe_p50']:>10.3f} {result['probe_p99']:>10.3f} {throughput:>6.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,82 @@
+"""CPU embedding throughput benchmark for the EmbeddingService backends (see EmbeddingService.py).
+
+Embeds the same texts with every combination of backend, batch size and thread count and reports
+documents/sec. Each backend's vectors are compared with the torch backend's (mean and minimum
+cosine similarity), so the speed of the quantized model can be weighed against how far its
+vectors drift from the ones already in the knowledge base.
+
+Usage (from the model directory):
+    python -m benchmarks.embeddings
+    python -m benchmarks.embeddings --texts chunks.txt --batch-sizes 16 32 64 --threads 4 8
+
+--texts is a text file with one document per line, by default the fixture corpus of the retrieval
+benchmark is used. --repeat repeats the texts to get a longer, more stable run. The onnx backends
+need ONNX Runtime: pip install "optimum[onnxruntime]"
+"""
+import argparse
+import json
+import time
+import numpy as np
+
+from EmbeddingService import BACKENDS, EmbeddingService
+from VectorStores import EMBEDDING_MODEL
+
+
+def load_texts(path, repeat):
+    if path:
+        with open(path) as f:
+            texts = [line.strip() for line in f if line.strip()]
+    else:
+        with open("benchmarks/fixtures/retrieval_corpus.json") as f:
+            texts = [doc["content"] for doc in json.load(f)["documents"]]
+    return texts * repeat
+
+
+def cosine_similarities(a, b):
+    a, b = np.asarray(a), np.asarray(b)
+    return np.sum(a * b, axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Embedding throughput per backend")
+    parser.add_argument("--model", default=EMBEDDING_MODEL)
+    parser.add_argument("--texts", help="File with one document per line")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--backends", nargs="+", choices=BACKENDS, default=BACKENDS)
+    parser.add_argument("--batch-sizes", nargs="+", type=int, default=[32])
+    parser.add_argument("--threads", nargs="+", type=int, default=[0], help="0 for the library default")
+    args = parser.parse_args()
+
+    texts = load_texts(args.texts, args.repeat)
+    print(f"{len(texts)} texts, model {args.model}")
+    print(f"{'backend':>10} {'threads':>8} {'batch':>6} {'docs/s':>9} {'seconds':>8} {'mean cos':>9} {'min cos':>8}")
+
+    reference = None
+    for backend in args.backends:
+        for threads in args.threads:
+            try:
+                service = EmbeddingService(args.model, backend=backend, threads=threads)
+            except ImportError as e:
+                print(f"{backend:>10} skipped: {e}")
+                continue
+            # The first calls are slower (lazy initialization, memory allocation)
+            service.embed_documents(texts[:service.batch_size])
+
+            for batch_size in args.batch_sizes:
+                service.batch_size = batch_size
+                start = time.perf_counter()
+                vectors = service.embed_documents(texts)
+                seconds = time.perf_counter() - start
+
+                if reference is None and backend == "torch":
+                    reference = vectors
+                if reference is not None:
+                    similarities = cosine_similarities(vectors, reference)
+                    mean, minimum = f"{similarities.mean():.4f}", f"{similarities.min():.4f}"
+                else:
+                    mean, minimum = "-", "-"
+                print(f"{backend:>10} {threads or 'default':>8} {batch_size:>6} {len(texts) / seconds:>9.1f} {seconds:>8.2f} {mean:>9} {minimum:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""Import-time profile of the server (or any module).
+
+Imports the module in a fresh interpreter with `python -X importtime` and reports the total import
+time and the slowest imports, both cumulative (including everything they import) and self time.
+Run it after touching module-level code: anything slow that shows up here delays every worker's
+start. Heavy subsystems should be imported or created on first use (see LAZY_MODULES and the
+warm-up in server.py).
+
+Usage (from the model directory):
+    python -m benchmarks.import_profile
+    python -m benchmarks.import_profile --module app --top 30
+"""
+import argparse
+import re
+import subprocess
+import sys
+import time
+
+LINE_PATTERN = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def profile_imports(module):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    if result.returncode != 0:
+        # The traceback is printed after the import times
+        sys.exit(f"import {module} failed: {result.stderr.splitlines()[-1]}")
+
+    imports = []
+    for line in result.stderr.splitlines():
+        match = LINE_PATTERN.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            imports.append({"name": name, "self": int(self_us) / 1e6, "cumulative": int(cumulative_us) / 1e6,
+                            "depth": len(indent) // 2})
+    return wall, imports
+
+
+def top_level_package(name):
+    return name.split(".")[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import-time profile")
+    parser.add_argument("--module", default="server")
+    parser.add_argument("--top", type=int, default=20)
+    args = parser.parse_args()
+
+    wall, imports = profile_imports(args.module)
+    imported = sum(entry["self"] for entry in imports)
+    print(f"import {args.module}: {wall:.2f}s wall clock (interpreter start included), {imported:.2f}s in {len(imports)} imports")
+
+    # Direct imports of the profiled module: what each of its imports costs, all dependencies included
+    direct = sorted((entry for entry in imports if entry["depth"] == 1), key=lambda entry: entry["cumulative"], reverse=True)
+    print(f"\nSlowest imports of {args.module} (cumulative)")
+    for entry in direct[:args.top]:
+        print(f"{entry['cumulative']:>8.3f}s  {entry['name']}")
+
+    # Time per package, wherever it was first imported from
+    packages = {}
+    for entry in imports:
+        package = top_level_package(entry["name"])
+        packages[package] = packages.get(package, 0.0) + entry["self"]
+    print("\nSlowest packages (self time of all their modules)")
+    for package, seconds in sorted(packages.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+        print(f"{seconds:>8.3f}s  {package}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+"""Offline retrieval benchmark for the knowledge base retrievers (see chain.create_retriever).
+
+Loads a fixture corpus into an in-memory Chroma collection and replays its query set through the
+retriever, with a stub chat model standing in for the LLM, so it runs without network access or API
+keys. Reports, per retriever mode, p50/p95 latency of each retrieval stage together with recall@k and
+MRR, so retriever or embedding changes can be compared before they are rolled out:
+
+    embedding  time spent embedding queries (including the subject classifier's)
+    filter     everything else before the search: query rewriting and filter construction
+    search     the vector store search, without the query embedding
+
+Off-topic queries (no relevant documents) are reported as the share that retrieved nothing.
+
+Usage (from the model directory):
+    python -m benchmarks.retrieval
+    python -m benchmarks.retrieval --embeddings mpnet --k 3 --llm-latency 0.3
+
+--embeddings hashing (the default) uses a bag-of-words hashing embedding so no model has to be
+downloaded, mpnet uses the knowledge base's embedding model (see VectorStores.py). --llm-latency adds a delay to each
+stub LLM call, to see what the LLM calls would cost in the filter stage.
+
+Corpus file format:
+    {"subjects": [...], "keywords": {"Programming": ["loop", ...]},
+     "documents": [{"id": "...", "subject": "...", "source": "file.pdf", "page": 1, "content": "..."}],
+     "queries": [{"input": "...", "chat_history": [["human", "..."], ["ai", "..."]], "relevant": ["doc id"]}]}
+The stub LLM picks the subject whose keywords appear most often in the question.
+"""
+import argparse
+import json
+import re
+import time
+import uuid
+import zlib
+import numpy as np
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.runnables import RunnableLambda
+from langchain_chroma import Chroma # type: ignore
+
+from chain import create_retriever
+from FusedRetriever import RetrievalQuery
+from VectorStores import get_embeddings
+
+MODES = ["self_query", "fused"]
+STAGES = ["embedding", "filter", "search", "total"]
+
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+STOP_WORDS = {"a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for", "from", "how", "i", "in",
+              "is", "it", "me", "my", "of", "on", "or", "should", "that", "the", "this", "to", "use", "what", "when",
+              "which", "why", "with", "you", "your"}
+
+
+class HashingEmbeddings(Embeddings):
+    """Bag-of-words embeddings hashed into a fixed number of dimensions. Deterministic and needs no model."""
+
+    def __init__(self, dimensions=512):
+        self.dimensions = dimensions
+
+    def _embed(self, text):
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        for word in WORD_PATTERN.findall(text.lower()):
+            if word not in STOP_WORDS:
+                vector[zlib.crc32(word.encode()) % self.dimensions] += 1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+
+class StageTimer:
+    """Time spent in each stage of the current query."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.embedding = 0.0
+        self.search = 0.0
+
+
+class TimedEmbeddings(Embeddings):
+    # Wraps the embeddings given to Chroma so every query embedding is timed, wherever it happens
+    def __init__(self, embeddings, timer):
+        self.embeddings = embeddings
+        self.timer = timer
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text):
+        start = time.perf_counter()
+        try:
+            return self.embeddings.embed_query(text)
+        finally:
+            self.timer.embedding += time.perf_counter() - start
+
+
+def time_searches(vectorStore, timer):
+    # Both retrievers search through similarity_search, which embeds the query first. That part is
+    # already counted as embedding time.
+    similarity_search = vectorStore.similarity_search
+
+    def timed_similarity_search(*args, **kwargs):
+        start, embedding = time.perf_counter(), timer.embedding
+        try:
+            return similarity_search(*args, **kwargs)
+        finally:
+            timer.search += time.perf_counter() - start - (timer.embedding - embedding)
+
+    vectorStore.similarity_search = timed_similarity_search
+
+
+class StubChatModel(BaseChatModel):
+    """Answers the retrievers' prompts the way the real model would, using keyword matching.
+
+    Handles the history aware retriever's rewrite prompt ("Search Query: ... Filter: subject = ..."),
+    the SelfQueryRetriever's query constructor prompt (a structured request) and the fused
+    retriever's structured output (a RetrievalQuery as JSON).
+    """
+
+    keywords: dict
+    default_subject: str = "Other"
+    latency: float = 0.0
+
+    @property
+    def _llm_type(self):
+        return "retrieval-benchmark-stub"
+
+    def pick_subject(self, *texts):
+        # The first text with any keyword decides, so the latest query wins over the chat history
+        for text in texts:
+            text = text.lower()
+            scores = {
+                subject: sum(len(re.findall(rf"\b{re.escape(keyword)}\b", text)) for keyword in keywords)
+                for subject, keywords in self.keywords.items()
+            }
+            subject, score = max(scores.items(), key=lambda item: item[1])
+            if score:
+                return subject
+        return self.default_subject
+
+    def rewrite(self, messages):
+        # The prompts end with the instructions, preceded by the latest query and the chat history
+        questions = [message.content for message in messages[:-1] if isinstance(message, HumanMessage)]
+        latest, history = questions[-1], questions[:-1]
+        subject = self.pick_subject(latest, *reversed(history))
+        # Follow-ups without a topic of their own are searched together with the previous question
+        search_query = latest if self.pick_subject(latest) != self.default_subject or not history else f"{history[-1]} {latest}"
+        return search_query, subject
+
+    def construct_query(self, prompt):
+        query = prompt.rsplit("User Query:", 1)[1].split("Structured Request:", 1)[0].strip()
+        search_query = re.search(r"Search Query:\s*(.+)", query)
+        search_query = search_query.group(1).strip() if search_query else query
+        filter_subject = re.search(r"Filter:\s*subject\s*=\s*(.+)", query)
+        subject = filter_subject.group(1).strip().strip("'\"") if filter_subject else self.pick_subject(search_query)
+        return "```json\n" + json.dumps({"query": search_query, "filter": f'eq("subject", "{subject}")'}) + "\n```"
+
+    def respond(self, messages):
+        prompt = messages[-1].content
+        if "<< Structured Request Schema >>" in prompt:
+            return self.construct_query(prompt)
+        search_query, subject = self.rewrite(messages)
+        if "Search Query: <your generated search query>" in prompt:
+            return f"Search Query: {search_query}\nFilter: subject = {subject}"
+        return RetrievalQuery(search_query=search_query, subject=subject).model_dump_json()
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.respond(messages)))])
+
+    def with_structured_output(self, schema, **kwargs):
+        return self | RunnableLambda(lambda message: schema.model_validate_json(message.content))
+
+
+class LLMCallCounter(BaseCallbackHandler):
+    def __init__(self):
+        self.calls = 0
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self.calls += 1
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        self.calls += 1
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def load_corpus(path):
+    with open(path) as f:
+        corpus = json.load(f)
+    for query in corpus["queries"]:
+        query["chat_history"] = [
+            HumanMessage(content=text) if role == "human" else AIMessage(content=text)
+            for role, text in query.get("chat_history", [])
+        ]
+    return corpus
+
+
+def create_embeddings(name):
+    if name == "hashing":
+        return HashingEmbeddings()
+    if name == "mpnet":
+        return get_embeddings()
+    raise ValueError(f"Unknown embeddings: {name}")
+
+
+def create_vectorstore(corpus, embeddings, timer):
+    # A new in-memory collection per run, so nothing is written to disk
+    vectorStore = Chroma(collection_name=f"retrieval-benchmark-{uuid.uuid4().hex[:8]}",
+                         embedding_function=TimedEmbeddings(embeddings, timer))
+    documents = corpus["documents"]
+    vectorStore.add_texts(
+        texts=[doc["content"] for doc in documents],
+        metadatas=[{"subject": doc["subject"], "source": doc["source"], "page": doc["page"], "id": doc["id"]} for doc in documents],
+        ids=[doc["id"] for doc in documents]
+    )
+    time_searches(vectorStore, timer)
+    return vectorStore
+
+
+def run_mode(retriever, queries, timer):
+    results = []
+    for query in queries:
+        counter = LLMCallCounter()
+        timer.reset()
+        start = time.perf_counter()
+        docs = retriever.invoke({"input": query["input"], "chat_history": query["chat_history"]},
+                                config={"callbacks": [counter]})
+        total = time.perf_counter() - start
+        results.append({
+            "embedding": timer.embedding,
+            "search": timer.search,
+            "filter": max(0.0, total - timer.embedding - timer.search),
+            "total": total,
+            "llm_calls": counter.calls,
+            "ids": [doc.metadata.get("id") for doc in docs],
+        })
+    return results
+
+
+def summarize(queries, results, k):
+    recalls, reciprocal_ranks, rejected = [], [], []
+    for query, result in zip(queries, results):
+        ids = result["ids"][:k]
+        relevant = set(query["relevant"])
+        if not relevant:
+            rejected.append(not ids)
+            continue
+        recalls.append(len(relevant.intersection(ids)) / len(relevant))
+        rank = next((i for i, doc_id in enumerate(ids, 1) if doc_id in relevant), None)
+        reciprocal_ranks.append(1 / rank if rank else 0.0)
+
+    summary = {stage: (percentile([r[stage] for r in results], 50), percentile([r[stage] for r in results], 95)) for stage in STAGES}
+    summary["llm_calls"] = sum(result["llm_calls"] for result in results) / len(results)
+    summary["recall"] = sum(recalls) / len(recalls) if recalls else None
+    summary["mrr"] = sum(reciprocal_ranks) / len(reciprocal_ranks) if reciprocal_ranks else None
+    summary["rejected"] = sum(rejected) / len(rejected) if rejected else None
+    return summary
+
+
+def format_metric(value, fmt):
+    return format(value, fmt) if value is not None else "-"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline retrieval latency and quality benchmark")
+    parser.add_argument("--corpus", default="benchmarks/fixtures/retrieval_corpus.json")
+    parser.add_argument("--embeddings", choices=["hashing", "mpnet"], default="hashing")
+    parser.add_argument("--mode", choices=MODES, action="append", help="Retriever mode to run, repeatable (default: all)")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="Seconds added to each stub LLM call")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    queries = corpus["queries"]
+    timer = StageTimer()
+    vectorStore = create_vectorstore(corpus, create_embeddings(args.embeddings), timer)
+    model = StubChatModel(keywords=corpus["keywords"], latency=args.llm_latency)
+
+    print(f"{len(corpus['documents'])} documents, {len(queries)} queries, k={args.k}, embeddings={args.embeddings}")
+    print(f"{'mode':>10} " + " ".join(f"{stage + ' p50/p95 (ms)':>24}" for stage in STAGES)
+          + f" {'LLM calls':>10} {'recall@k':>9} {'MRR':>6} {'off-topic':>10}")
+    for mode in args.mode or MODES:
+        retriever = create_retriever(model, vectorStore, corpus["subjects"], mode=mode)
+        summary = summarize(queries, run_mode(retriever, queries, timer), args.k)
+        latencies = " ".join(f"{f'{summary[stage][0] * 1000:.1f} / {summary[stage][1] * 1000:.1f}':>24}" for stage in STAGES)
+        print(f"{mode:>10} {latencies} {summary['llm_calls']:>10.2f} {format_metric(summary['recall'], '.2%'):>9} "
+              f"{format_metric(summary['mrr'], '.3f'):>6} {format_metric(summary['rejected'], '.0%'):>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+"""Compares the "self_query" and "fused" retrievers (see chain.create_retriever) on the knowledge base.
+
+Replays a query set through both retrievers and reports, per mode, the latency of the retrieval
+step, the number of LLM calls it made, how often the top document has the expected subject and,
+where expected sources are given, recall@k. It also reports how much the two modes' results
+overlap. Uses the real LLM and ../knowledge_base, so it needs the API keys in .env.
+
+Usage (from the model directory):
+    python -m benchmarks.retriever_eval --queries benchmarks/retrieval_queries.json
+
+Query file format, a JSON list of:
+    {"input": "...", "chat_history": [["human", "..."], ["ai", "..."]], "subject": "Programming", "sources": ["file.pdf"]}
+Only "input" is required. Use "subject": null for questions that should retrieve nothing.
+"""
+import argparse
+import asyncio
+import json
+import time
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import AIMessage, HumanMessage
+
+from chain import create_model, create_retriever
+from Curriculum import DEFAULT_SUBJECTS, GENERAL_SUBJECTS
+from VectorStores import get_vectorstore
+
+MODES = ["self_query", "fused"]
+
+
+class LLMCallCounter(BaseCallbackHandler):
+    def __init__(self):
+        self.calls = 0
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self.calls += 1
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        self.calls += 1
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def load_queries(path):
+    with open(path) as f:
+        queries = json.load(f)
+    for query in queries:
+        query["chat_history"] = [
+            HumanMessage(content=text) if role == "human" else AIMessage(content=text)
+            for role, text in query.get("chat_history", [])
+        ]
+    return queries
+
+
+def document_key(doc):
+    return doc.metadata.get("source"), doc.metadata.get("page"), doc.metadata.get("id")
+
+
+async def run_mode(retriever, queries):
+    results = []
+    for query in queries:
+        counter = LLMCallCounter()
+        start = time.perf_counter()
+        docs = await retriever.ainvoke({"input": query["input"], "chat_history": query["chat_history"]},
+                                       config={"callbacks": [counter]})
+        results.append({"latency": time.perf_counter() - start, "llm_calls": counter.calls, "docs": docs})
+    return results
+
+
+def summarize(queries, results, k):
+    subject_checks, recalls = [], []
+    for query, result in zip(queries, results):
+        docs = result["docs"][:k]
+        if "subject" in query:
+            top_subject = docs[0].metadata.get("subject") if docs else None
+            subject_checks.append(top_subject == query["subject"])
+        if query.get("sources"):
+            found = {doc.metadata.get("source") for doc in docs}
+            recalls.append(len(found & set(query["sources"])) / len(query["sources"]))
+
+    latencies = [result["latency"] for result in results]
+    return {
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "llm_calls": sum(result["llm_calls"] for result in results) / len(results),
+        "subject_accuracy": sum(subject_checks) / len(subject_checks) if subject_checks else None,
+        "recall": sum(recalls) / len(recalls) if recalls else None,
+    }
+
+
+def overlap(results_a, results_b, k):
+    scores = []
+    for a, b in zip(results_a, results_b):
+        keys_a = {document_key(doc) for doc in a["docs"][:k]}
+        keys_b = {document_key(doc) for doc in b["docs"][:k]}
+        union = keys_a | keys_b
+        scores.append(len(keys_a & keys_b) / len(union) if union else 1.0)
+    return sum(scores) / len(scores) if scores else 0.0
+
+
+def format_metric(value, fmt):
+    return format(value, fmt) if value is not None else "-"
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Compare the self_query and fused retrievers")
+    parser.add_argument("--queries", default="benchmarks/retrieval_queries.json")
+    parser.add_argument("--knowledge-base", default="../knowledge_base")
+    parser.add_argument("--k", type=int, default=5)
+    args = parser.parse_args()
+
+    queries = load_queries(args.queries)
+    vectorStore = get_vectorstore(args.knowledge_base)
+    model = create_model()
+    subjects = DEFAULT_SUBJECTS + GENERAL_SUBJECTS
+
+    results = {}
+    for mode in MODES:
+        retriever = create_retriever(model, vectorStore, subjects, mode=mode)
+        results[mode] = await run_mode(retriever, queries)
+
+    print(f"{len(queries)} queries, k={args.k}")
+    print(f"{'mode':>10} {'p50 (s)':>8} {'p95 (s)':>8} {'LLM calls':>10} {'subject acc':>12} {'recall@k':>9}")
+    for mode in MODES:
+        summary = summarize(queries, results[mode], args.k)
+        print(f"{mode:>10} {summary['p50']:>8.2f} {summary['p95']:>8.2f} {summary['llm_calls']:>10.2f} "
+              f"{format_metric(summary['subject_accuracy'], '.2%'):>12} {format_metric(summary['recall'], '.2%'):>9}")
+    print(f"Result overlap@{args.k} (Jaccard): {overlap(results[MODES[0]], results[MODES[1]], args.k):.2%}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -11,27 +11,66 @@ from dotenv import load_dotenv
 import os
 from PromptEng import get_template
 from examples import get_examples
+from SubjectClassifier import SubjectClassifier, CachedQueryConstructor
+from FusedRetriever import create_fused_retriever
+from Telemetry import span
 
 load_dotenv()
 groq_api_key=os.getenv('GROQ_API_KEY')
 openai_api_key = os.getenv('OPENAI_API_KEY')
 
-def create_chain(vectorStore):
-    # model=ChatGroq(groq_api_key=groq_api_key, model_name="llama-3.2-90b-text-preview")
-    model=ChatOpenAI(openai_api_key=openai_api_key, model_name="gpt-4o-mini")
+# Which retriever create_chain uses, see create_retriever
+RETRIEVER_MODE = os.getenv("RETRIEVER_MODE", "self_query")
+
+# Formats a list of options as 'A, B or C', each option wrapped in quote
+def format_options(options, quote):
+    quoted = [f"{quote}{option}{quote}" for option in options]
+    return ", ".join(quoted[:-1]) + " or " + quoted[-1]
+
+# The LLM calls are tagged with their stage, which names their spans (see Telemetry.LLMSpanHandler)
+def create_model():
+    # return ChatGroq(groq_api_key=groq_api_key, model_name="llama-3.2-90b-text-preview")
+    return ChatOpenAI(openai_api_key=openai_api_key, model_name="gpt-4o-mini")
+
+# subjects are the values the retriever can filter the subject metadata on (see Curriculum.py)
+def create_chain(vectorStore, subjects):
+    model = create_model()
     chain = create_stuff_documents_chain(
-        llm=model,
+        llm=model.with_config(tags=["answer_llm"]),
         prompt=get_template(),
     )
 
+    retrieval_chain = create_retrieval_chain(
+        create_retriever(model, vectorStore, subjects),
+        chain
+    )
+
+    return retrieval_chain
+
+class TracedSelfQueryRetriever(SelfQueryRetriever):
+    # Records the vector store search, without the query construction before it, as a span
+    def _get_docs_with_query(self, query, search_kwargs):
+        with span("vector_search"):
+            return super()._get_docs_with_query(query, search_kwargs)
+
+    async def _aget_docs_with_query(self, query, search_kwargs):
+        with span("vector_search"):
+            return await super()._aget_docs_with_query(query, search_kwargs)
+
+# Returns the retriever used by create_chain. mode is "self_query" (history aware retriever followed by
+# SelfQueryRetriever) or "fused" (one LLM call for both the query and the filter, see FusedRetriever.py).
+def create_retriever(model, vectorStore, subjects, mode=RETRIEVER_MODE):
+    if mode == "fused":
+        return create_fused_retriever(model, vectorStore, subjects, format_options(subjects, "'"))
+    if mode != "self_query":
+        raise ValueError(f"Unknown retriever mode: {mode}")
 
     # Define metadata field information. This is mandatory for the query constructor.
-    # The values for course and subject are hardcoded here. The mySQL functions are in place to get them dynamically 
-    # from the database. Didn't use it because we need to update the knowledge base to include these attribute values.
+    # The subjects come from the curriculum, mapped to the subject names used in the knowledge base.
     metadata_field_info = [
         AttributeInfo(
             name="subject",
-            description='The subject relevant to the document. One of "Programming", "Electronics", "Embedded Systems", "3D Design", "Manufacturing", "Non-Technical", "Sports", "Business and Finance" or "Other".',
+            description="The subject relevant to the document. One of " + format_options(subjects, '"') + ".",
             type="string",
         ),
     ]
@@ -44,28 +83,32 @@ def create_chain(vectorStore):
         examples=get_examples(),
     )
     output_parser = StructuredQueryOutputParser.from_components()
-    query_constructor = prompt | model | output_parser
+    llm_query_constructor = prompt | model.with_config(tags=["query_construction_llm"]) | output_parser
+
+    # The subject filter usually comes from an embedding classifier or the cache. The LLM is only
+    # asked when the classifier isn't confident.
+    query_constructor = CachedQueryConstructor(SubjectClassifier(vectorStore, subjects), llm_query_constructor).as_runnable()
 
     # The self query retriever is able to filter the database based on filters it generates before doing the similarity search.
-    self_query_retriever = SelfQueryRetriever(
+    self_query_retriever = TracedSelfQueryRetriever(
     query_constructor=query_constructor,
     vectorstore=vectorStore,
     structured_query_translator=ChromaTranslator(),
     search_kwargs={"k": 5}
     )
 
-    # In here also the values for course and subject are hardcoded. The mySQL functions are in place to get them dynamically.
+    # The same subjects are offered here for the filter
     retriever_prompt = ChatPromptTemplate.from_messages([
         MessagesPlaceholder(variable_name="chat_history"),
         ("human", "{input}"),
         ("human", 
-            """Based on the conversation above and the user's latest query, generate a focused search query and appropriate filtering criteria. Follow these steps:
+            f"""Based on the conversation above and the user's latest query, generate a focused search query and appropriate filtering criteria. Follow these steps:
 
             1. Analyze the user's latest query and identify the main topic or concept.
             2. Consider any relevant context from the chat history, but prioritize the latest query.
             3. Formulate a concise, specific search query that captures the core information need. Keep it to about 15-20 words.
             4. Determine the most relevant subject for filtering from the following options:
-            'Programming', 'Electronics', 'Embedded Systems', '3D Design', 'Manufacturing', 'Miscellaneous', 'Non-Technical', 'Sports', 'Business and Finance' or 'Other'
+            {format_options(subjects, "'")}
 
             Your response should be in the following format:
             Search Query: <your generated search query>
@@ -79,14 +122,9 @@ def create_chain(vectorStore):
 
 
     history_aware_retriever = create_history_aware_retriever(
-        llm=model,
+        llm=model.with_config(tags=["query_rewrite"]),
         retriever=self_query_retriever,
         prompt=retriever_prompt
     )
 
-    retrieval_chain = create_retrieval_chain(
-        history_aware_retriever,
-        chain
-    )
-
-    return retrieval_chain
\ No newline at end of file
+    return history_aware_retriever
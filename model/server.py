@@ -1,39 +1,45 @@
 from fastapi import FastAPI, Request, BackgroundTasks, HTTPException, UploadFile, File, Form
 from fastapi.staticfiles import StaticFiles
-from typing import List
+from typing import List, Optional
 from pydantic import BaseModel
 from passlib.context import CryptContext # type: ignore
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 import os
 import shutil
 import random
 import string
 from groq import Groq
-from langchain_chroma import Chroma # type: ignore
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse
 from gtts import gTTS # type: ignore
 import io
+import json
+import importlib
 import aiofiles # type: ignore
-from datetime import datetime, date
 
-from app import run_model
-from FileProcess import process_file
+from app import run_model, stream_model, get_chain
+from ChatTaskQueue import chat_tasks
+from InstructionRegistry import instruction_registry
+from Curriculum import curriculum_cache
+from ResponseCache import response_cache, NO_ATTACHMENTS
+from SubjectClassifier import invalidate_query_constructors
+from ResourceCache import resource_cache
+from IngestionJobs import ingestion_jobs
+from CaptionCache import caption_cache
+from MySQLPool import mysql_pool
+from Telemetry import Trace, trace, span, use_trace, render_metrics, get_traces
+from VectorStores import get_vectorstore, warm_up_embeddings, KNOWLEDGE_BASE_DIR
+from Warmup import warmup
+from SessionCache import session_cache, CHAT, get_chat_session, get_user_session, preload_user_data
 from ProcessFeedback import review_feedback
-from whatsapp import whatsapp
 from ChatStoreSQL import (update_personalization_params, get_personalization_params, get_past_chats, get_chat_ids, get_all_user_data, update_user_role,
-                        load_chat_history, store_feedback, log_feedback, get_existing_feedback, fetch_feedback_logs, delete_feedback, update_feedback, delete_chat, get_mentor_notes, 
+                        load_chat_data, count_chat_messages, store_feedback, log_feedback, get_existing_feedback, fetch_feedback_logs, delete_feedback, update_feedback, delete_chat, get_mentor_notes, 
                         insert_mentor_notes, get_mentor_queries, respond_to_query, delete_mentor_query_by_id, get_answered_queries, update_query, get_user, create_user)
-from MultimodalRAG import (transcribe_audio_files, process_all_pdfs, generate_captions_for_images, 
-                            create_documents_from_captions, process_videos_in_directory, 
-                            text_preprocess, update_metadata, save_doc)
-from AdminDB import conn, lecture_materials
+from AdminDB import get_connection, create_tables, lecture_materials
 
 client = Groq(api_key=os.getenv('GROQ_API_KEY'))
 
 
-# Cache for preloading variables
-preloaded_data = {}
-
 # Password hashing setup using bcrypt
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
@@ -45,6 +51,14 @@ os.makedirs(UPLOAD_DIRECTORY, exist_ok=True)
 IMG_DIRECTORY = "images"
 os.makedirs(IMG_DIRECTORY, exist_ok=True)
 
+# Seconds /fetch-resources waits for the latest turn's resources to be ready
+RESOURCE_WAIT_TIMEOUT = 30
+# Seconds to wait for post-response chat tasks on shutdown
+SHUTDOWN_DRAIN_TIMEOUT = 60
+# Imported on first use instead of at startup (see the warm-up below): file processing, the
+# multimodal ingestion pipeline and the WhatsApp bot pull in OpenCV, PyMuPDF, Tesseract, Gemini and Twilio
+LAZY_MODULES = ["FileProcess", "MultimodalRAG", "whatsapp"]
+
 class PersonalizationData(BaseModel):
     ChatID: str
     UserID: str
@@ -121,6 +135,32 @@ app.add_middleware(
 
 app.mount("/images", StaticFiles(directory=IMG_DIRECTORY), name="images")
 
+def import_lazy_modules():
+    for module in LAZY_MODULES:
+        importlib.import_module(module)
+
+# Everything here also happens lazily on first use. Warming up in the background lets the worker
+# start accepting requests right away, /ready tells load balancers when it is warm.
+warmup.add("embedding_model", warm_up_embeddings)
+warmup.add("knowledge_base", lambda: get_vectorstore(KNOWLEDGE_BASE_DIR))
+# Loads the personalization instructions once so chat turns don't query them
+warmup.add("instructions", instruction_registry.refresh, required=False)
+# Loads the curriculum and builds the chat chain
+warmup.add("chain", get_chain)
+warmup.add("modules", import_lazy_modules)
+warmup.add("admin_db", create_tables, required=False)
+
+@app.on_event("startup")
+async def startup():
+    warmup.start()
+    # Also resumes the upload jobs interrupted by the last shutdown
+    ingestion_jobs.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    # Let queued chat history/summary updates finish so they are not lost on restart
+    await chat_tasks.drain(timeout=SHUTDOWN_DRAIN_TIMEOUT)
+
 async def handle_file(file):
     # Async file read and write
     file_content = await file.read()
@@ -162,82 +202,100 @@ def generate_random_string(length, past_chats):
         if not any(chat == random_string for chat in past_chats):
             return random_string
 
-# Helper function to preload chat-specific data
-async def preload_chat_data(ChatID):
-    global preloaded_data
-    if ChatID not in preloaded_data:
-        preloaded_data[ChatID] = {}
-        
-    # Preload chat history and summary
-    chat_history, chat_summary = load_chat_history(ChatID)
-    preloaded_data[ChatID]["chat_history"] = chat_history if chat_history else []
-    preloaded_data[ChatID]["chat_summary"] = chat_summary if chat_summary else ""
-
-    # Preload personalization data
-    preloaded_data[ChatID]["personalization"] = get_personalization_params(ChatID)
-
-    print(f"Preloaded data for ChatID {ChatID}")
-
-async def preload_user_data(UserID):
-    global preloaded_data
-    if UserID not in preloaded_data:
-        preloaded_data[UserID] = {}
-        
-    # Preload mentor notes and feedback using UserID
-    preloaded_data[UserID]["notes"] = get_mentor_notes(UserID)
-    preloaded_data[UserID]["feedback"] = get_existing_feedback(UserID)
-
-    print(f"Preloaded data for UserID {UserID}")
-
-async def update_preload_data(ChatID):
-    global preloaded_data
-    if ChatID not in preloaded_data:
-        preloaded_data[ChatID] = {}
-        
-    # Preload chat history and summary
-    chat_history, chat_summary = load_chat_history(ChatID)
-    preloaded_data[ChatID]["chat_history"] = chat_history if chat_history else []
-    preloaded_data[ChatID]["chat_summary"] = chat_summary if chat_summary else ""
-
-    print(f"Updated chat history and chat summary for ChatID {ChatID}")
-
+# Runs in the threadpool. FileProcess is imported on first use (or during warm-up) since it loads OCR, PDF and video libraries.
+def process_attachment(file_location, input_text):
+    from FileProcess import process_file
+    return process_file(file_location, input_text)
 
 @app.post("/run-model")
 async def process_input(ChatID: str = Form(...), UserID: str = Form(...), input_text: str = Form(...), mediaType: str = Form(...), fileName: str = Form(...), file: UploadFile = File(None), background_tasks: BackgroundTasks = BackgroundTasks()):
-    if ChatID not in preloaded_data:
-            await preload_chat_data(ChatID)
-    if UserID not in preloaded_data:
-            await preload_user_data(UserID)
-    
-    # If a file is uploaded, handle the file
-    if file:
-        # Handle the uploaded file
-        file_location = await handle_file(file)
-        
-        # Process the file content
-        extract = process_file(file_location, input_text, background_tasks)
-        
-        # Process the text input
-        response = run_model(ChatID, UserID, input_text, extract, mediaType, fileName, preloaded_data, background_tasks)
-        
-        # After processing, remove the file
-        remove_response = await remove_file(file_location)
-        if remove_response:
-            return remove_response
-    else:
-        extract = "No file attachments provided"
-        response = run_model(ChatID, UserID, input_text, extract, mediaType, fileName, preloaded_data, background_tasks)
+    # Every stage of the turn is recorded as a span of this trace (see /metrics and /traces)
+    with trace("run-model", chat_id=ChatID):
+        with span("session_preload"):
+            chat_data = await get_chat_session(ChatID)
+            user_data = await get_user_session(UserID)
         
-    await update_preload_data(ChatID)
+        # If a file is uploaded, handle the file
+        if file:
+            # Handle the uploaded file
+            file_location = await handle_file(file)
+            
+            # Process the file content. OCR, captioning and embeddings are CPU/network bound, so keep them off the event loop.
+            with span("file_processing"):
+                extract = await run_in_threadpool(process_attachment, file_location, input_text)
+            
+            # Process the text input
+            response = await run_model(ChatID, UserID, input_text, extract, mediaType, fileName, chat_data, user_data, background_tasks)
+            
+            # After processing, remove the file
+            remove_response = await remove_file(file_location)
+            if remove_response:
+                return remove_response
+        else:
+            extract = NO_ATTACHMENTS
+            response = await run_model(ChatID, UserID, input_text, extract, mediaType, fileName, chat_data, user_data, background_tasks)
+            
+        return response
 
-    return response
+
+def format_sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+# Streaming variant of /run-model. Sends the answer as Server-Sent Events:
+#   event: token  data: {"text": "..."}   for each piece of the answer as it is generated
+#   event: done   data: {...}             the same payload /run-model returns (context, files, timings)
+@app.post("/run-model-stream")
+async def process_input_stream(ChatID: str = Form(...), UserID: str = Form(...), input_text: str = Form(...), mediaType: str = Form(...), fileName: str = Form(...), file: UploadFile = File(None), background_tasks: BackgroundTasks = BackgroundTasks()):
+    # The trace is ended when the stream is, not when this handler returns
+    turn = Trace("run-model-stream", chat_id=ChatID)
+    with use_trace(turn):
+        try:
+            with span("session_preload"):
+                chat_data = await get_chat_session(ChatID)
+                user_data = await get_user_session(UserID)
+
+            # Attachments are processed before the stream starts, since the answer depends on them
+            if file:
+                file_location = await handle_file(file)
+                with span("file_processing"):
+                    extract = await run_in_threadpool(process_attachment, file_location, input_text)
+                remove_response = await remove_file(file_location)
+                if remove_response:
+                    turn.end()
+                    return remove_response
+            else:
+                extract = NO_ATTACHMENTS
+        except Exception:
+            turn.end()
+            raise
+
+    async def event_stream():
+        with use_trace(turn):
+            try:
+                async for event, value in stream_model(ChatID, UserID, input_text, extract, mediaType, fileName, chat_data, user_data):
+                    if event == "token":
+                        yield format_sse("token", {"text": value})
+                    else:
+                        yield format_sse("done", value)
+            except Exception as e:
+                print(f"Error streaming response for ChatID {ChatID}: {e}")
+                yield format_sse("error", {"detail": str(e)})
+            finally:
+                turn.end()
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @app.post("/fetch-resources")
 async def fetch_resources(request: ResourceRequest):
     try:
         ChatID = request.chatId
-        chat_history = preloaded_data[ChatID]["chat_history"]
+        chat_data = await get_chat_session(ChatID)
+        # Resources for the latest turn are fetched after its response was sent
+        if "resources_task" in chat_data:
+            await chat_tasks.wait(chat_data["resources_task"], timeout=RESOURCE_WAIT_TIMEOUT)
+        chat_history = chat_data["chat_history"]
         msg = chat_history[-1]
         context = msg.response_metadata["context"]
         resources = []
@@ -248,7 +306,7 @@ async def fetch_resources(request: ResourceRequest):
 
 
 @app.post("/update-personalization")
-async def update_personalization(data: PersonalizationData):
+def update_personalization(data: PersonalizationData):
     try:
         print(data)
         update_personalization_params(
@@ -267,7 +325,7 @@ async def update_personalization(data: PersonalizationData):
 
 
 @app.get("/get-personalization")
-async def get_personalization(chat_id: str):
+def get_personalization(chat_id: str):
     try:
         data = get_personalization_params(chat_id)
         
@@ -281,7 +339,7 @@ async def get_personalization(chat_id: str):
 @app.get("/get-past-chats")
 async def get_past_chats_endpoint(userId: str, background_tasks: BackgroundTasks = BackgroundTasks()):
     try:
-        past_chats = get_past_chats(userId)
+        past_chats = await run_in_threadpool(get_past_chats, userId)
         
         await preload_user_data(userId)
         return past_chats
@@ -290,7 +348,7 @@ async def get_past_chats_endpoint(userId: str, background_tasks: BackgroundTasks
 
 
 @app.get("/get-chat-ids", response_model=List[str])
-async def fetch_chat_ids():
+def fetch_chat_ids():
     try:
         chat_ids = get_chat_ids()
         return chat_ids
@@ -298,25 +356,97 @@ async def fetch_chat_ids():
         raise HTTPException(status_code=500, detail=str(e))
 
 
+# Without limit the whole chat is returned. With limit only the latest `limit` messages are returned,
+# and older pages are fetched by passing the returned next_cursor as `before` (null on the first page).
 @app.get("/get-chat")
-async def get_chat(chat_id: str, background_tasks: BackgroundTasks = BackgroundTasks()):
+async def get_chat(chat_id: str, limit: Optional[int] = None, before: Optional[int] = None, background_tasks: BackgroundTasks = BackgroundTasks()):
+    if limit is not None and limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be at least 1")
     try:
-        chat_history, chat_summary = load_chat_history(chat_id)
+        chat_data = await run_in_threadpool(load_chat_data, chat_id, limit, before)
         
         # Convert chat history to a dictionary format for the frontend
         response_data = {
-            "messages": chat_history,
-            "summary": chat_summary
+            "messages": chat_data["chat_history"],
+            "summary": chat_data["chat_summary"],
+            "total": chat_data["message_count"],
+            "next_cursor": chat_data["first_seq"] if chat_data["first_seq"] > 0 else None
         }
         
-        background_tasks.add_task(preload_chat_data, chat_id)
+        # The cached session is kept in sync with the database, so it only needs loading if it isn't cached
+        background_tasks.add_task(get_chat_session, chat_id)
         return response_data
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/get-chat-count")
+def get_chat_count(chat_id: str):
+    try:
+        return {"total": count_chat_messages(chat_id)}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# Reloads the personalization instructions after Personalization_instructions was edited
+@app.post("/refresh-instructions")
+async def refresh_instructions():
+    try:
+        instruction_registry.invalidate()
+        await run_in_threadpool(instruction_registry.refresh)
+        return {"message": "Personalization instructions reloaded", **instruction_registry.stats()}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# Reloads the curriculum after the Curriculum table was edited. The chat chain picks up the new subjects on the next turn.
+@app.post("/refresh-curriculum")
+async def refresh_curriculum():
+    try:
+        curriculum_cache.invalidate()
+        await run_in_threadpool(curriculum_cache.refresh)
+        courses, subjects = await curriculum_cache.get()
+        return {"message": "Curriculum reloaded", "courses": courses, "subjects": subjects}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+# Liveness probe: the worker is up and its event loop is responsive
+@app.get("/health")
+async def health():
+    return {"status": "ok"}
+
+
+# Readiness probe: 503 until the warm-up has finished, with the time each step took
+@app.get("/ready")
+async def ready():
+    status = warmup.status()
+    return JSONResponse(content=status, status_code=200 if status["ready"] else 503)
+
+
+# Prometheus metrics: chat turn and per-stage latency histograms, plus the pool, cache and task queue stats
+@app.get("/metrics")
+def metrics():
+    return PlainTextResponse(render_metrics({
+        "mysql_pool": mysql_pool.stats(),
+        "session_cache": session_cache.stats(),
+        "chat_tasks": chat_tasks.stats(),
+        "instruction_registry": instruction_registry.stats(),
+        "resource_cache": resource_cache.stats(),
+        "response_cache": response_cache.stats(),
+        "ingestion_jobs": ingestion_jobs.stats(),
+        "caption_cache": caption_cache.stats(),
+    }), media_type="text/plain; version=0.0.4")
+
+
+# Spans of the latest chat turns, newest first
+@app.get("/traces")
+def traces(limit: int = 20):
+    return get_traces(limit)
+
+
 @app.get("/get-users")
-async def get_users():
+def get_users():
     user_data = get_all_user_data()
     if user_data is None:
         raise HTTPException(status_code=500, detail="Could not retrieve user data.")
@@ -324,7 +454,7 @@ async def get_users():
 
 
 @app.put("/update-user")
-async def update_user_endpoint(request: UpdateUserRole):
+def update_user_endpoint(request: UpdateUserRole):
     try:
         userId = request.userId
         isAdmin = request.isAdmin
@@ -335,7 +465,7 @@ async def update_user_endpoint(request: UpdateUserRole):
 
 
 @app.post("/transcribe-audio")
-async def get_transcription(file: UploadFile = File(...)):
+def get_transcription(file: UploadFile = File(...)):
     try:
         # Send the audio file for transcription
         transcription = client.audio.transcriptions.create(
@@ -355,7 +485,7 @@ async def get_transcription(file: UploadFile = File(...)):
     
 
 @app.post("/text-to-speech")
-async def text_to_speech(request: TextRequest):
+def text_to_speech(request: TextRequest):
     text = request.text
 
     if not text:
@@ -382,14 +512,14 @@ async def feedback(request: Feedback, background_tasks: BackgroundTasks = Backgr
     feedbackText = feedbackText if feedbackText else "No feedback provided"
     
     # Get existing feedback from the database
-    existing_feedback = get_existing_feedback(userId)
+    existing_feedback = await run_in_threadpool(get_existing_feedback, userId)
     
-    review = review_feedback(userText, text, feedback_type, feedbackText, existing_feedback)
+    review = await run_in_threadpool(review_feedback, userText, text, feedback_type, feedbackText, existing_feedback)
     print(review)
     
     # Store the updated review in the feedback table
-    store_feedback(userId, review)
-    log_feedback(userId, userText, text, feedback_type, feedbackText, review)
+    await run_in_threadpool(store_feedback, userId, review)
+    await run_in_threadpool(log_feedback, userId, userText, text, feedback_type, feedbackText, review)
     
     await preload_user_data(userId)
 
@@ -397,7 +527,7 @@ async def feedback(request: Feedback, background_tasks: BackgroundTasks = Backgr
 
 
 @app.get("/feedback-logs")
-async def get_feedback_logs():
+def get_feedback_logs():
     try:
         feedback_logs = fetch_feedback_logs()
         return feedback_logs
@@ -406,7 +536,7 @@ async def get_feedback_logs():
 
 
 @app.delete("/delete-feedback")
-async def delete_feedback_endpoint(id: int):
+def delete_feedback_endpoint(id: int):
     try:
         delete_feedback(id)
         return {"message": "Feedback log deleted successfully"}
@@ -415,7 +545,7 @@ async def delete_feedback_endpoint(id: int):
 
 
 @app.put("/update-feedback")
-async def update_feedback_endpoint(request: UpdateFeedback):
+def update_feedback_endpoint(request: UpdateFeedback):
     try:
         id = request.id
         instruction = request.instruction
@@ -427,13 +557,14 @@ async def update_feedback_endpoint(request: UpdateFeedback):
 
 
 @app.post("/delete-chat")
-async def delete_chat_endpoint(request: DeleteChatRequest):
+def delete_chat_endpoint(request: DeleteChatRequest):
     chat_id = request.chat_id
     print(chat_id)
     
     try:
         # Call the delete_chat function from ChatStoreSQL to delete the chat from the database
         response = delete_chat(chat_id)
+        session_cache.delete(CHAT, chat_id)
         return response
 
     except ValueError as e:
@@ -446,6 +577,8 @@ async def delete_chat_endpoint(request: DeleteChatRequest):
 # WhatsApp Bot Endpoint
 @app.post("/")
 async def bot(request: Request, background_tasks: BackgroundTasks = BackgroundTasks()):
+    # The bot (and the Twilio client) is loaded on first use or during warm-up
+    from whatsapp import whatsapp
     await whatsapp(request, background_tasks)
 
 
@@ -453,8 +586,9 @@ async def bot(request: Request, background_tasks: BackgroundTasks = BackgroundTa
 
 # Retrieve all lecture materials
 @app.get("/get-files")
-async def read_data():
-    result = conn.execute(lecture_materials.select()).fetchall()
+def read_data():
+    with get_connection() as conn:
+        result = conn.execute(lecture_materials.select()).fetchall()
     response = [] 
     for row in result:
         response.append({
@@ -482,29 +616,30 @@ async def read_data():
 
 # Update an existing lecture material by ID
 @app.put("/update-file/{id}")
-async def update_data(id: int, material: LectureMaterialSchema):
-    result = conn.execute(lecture_materials.select().where(lecture_materials.c.id == id)).fetchone()
+def update_data(id: int, material: LectureMaterialSchema):
+    with get_connection() as conn:
+        result = conn.execute(lecture_materials.select().where(lecture_materials.c.id == id)).fetchone()
+        if result:
+            conn.execute(lecture_materials.update().where(lecture_materials.c.id == id).values(
+                file=material.file,  # Update the Binary data
+                file_name=material.file_name,
+                file_type=material.file_type
+            ))
     if result:
-        conn.execute(lecture_materials.update().where(lecture_materials.c.id == id).values(
-            file=material.file,  # Update the Binary data
-            file_name=material.file_name,
-            file_type=material.file_type
-        ))
-        conn.connection.commit()
         return {"message": "Lecture material updated successfully"}
     else:
         raise HTTPException(status_code=404, detail="Lecture Material not found")
 
 # Delete a lecture material by ID
 @app.delete("/delete-file/{id}")
-async def delete_data(id: int):
-    result = conn.execute(lecture_materials.select().where(lecture_materials.c.id == id)).fetchone()
+def delete_data(id: int):
+    with get_connection() as conn:
+        result = conn.execute(lecture_materials.select().where(lecture_materials.c.id == id)).fetchone()
+        if result:
+            conn.execute(lecture_materials.delete().where(lecture_materials.c.id == id))
     if result:
-        conn.execute(lecture_materials.delete().where(lecture_materials.c.id == id))
-        conn.connection.commit()
-
-        # Initialize ChromaDB index
-        chroma = Chroma(persist_directory="../knowledge_base") 
+        # Shared knowledge base index
+        chroma = get_vectorstore(KNOWLEDGE_BASE_DIR)
         
         ids_to_delete = []
         print("document id: ", id)
@@ -514,20 +649,34 @@ async def delete_data(id: int):
         print("no. of vectors: ",len(ids_to_delete))
         if ids_to_delete:
             chroma.delete(ids=ids_to_delete)
+            # Cached answers and subject centroids may be based on the deleted material
+            response_cache.invalidate()
+            invalidate_query_constructors()
         return {"message": "Lecture material deleted successfully"}
     else:
         raise HTTPException(status_code=404, detail="Lecture Material not found")
 
 
+def insert_lecture_materials(uploads):
+    # (id, file name, content) of each uploaded (file name, content type, content)
+    job_files = []
+    with get_connection() as conn:
+        for file_name, file_type, content in uploads:
+            insert_stmt = lecture_materials.insert().values(
+                file_name=file_name,
+                file_type=file_type
+            )
+            result = conn.execute(insert_stmt)
+            job_files.append((result.lastrowid, file_name, content))
+    return job_files
+
+
 @app.post("/upload-files")
 async def write_data(subject: str = Form(...), files: List[UploadFile] = File(...)):
-
-    audio_files = []
-    converted_audio_files = []
-    pdf_files = []
-    video_files = []
-    text_files = []
+    # Transcription, captioning and embedding can take tens of minutes, so they run in a background
+    # job (see IngestionJobs.py). Progress is at GET /jobs/{job_id}.
     file_info = []
+    uploads = []
     
     for file in files:
         file_info.append({
@@ -535,155 +684,43 @@ async def write_data(subject: str = Form(...), files: List[UploadFile] = File(..
             "subject": subject
         })
 
-        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-        filename, file_extension = os.path.splitext(file.filename)
-        new_filename = f"{filename}_{timestamp}{file_extension}"
-        file_location = os.path.join(UPLOAD_DIRECTORY, new_filename)
-    
-        # Open the file location and write the uploaded file content
-        with open(file_location, "wb") as f:
-            content = file.file.read()  # Read the file content
-            f.write(content) 
-
-        insert_stmt = lecture_materials.insert().values(
-            file_name=file.filename,
-            file_type=file.content_type
-        )
-        result = conn.execute(insert_stmt)
-        conn.connection.commit()
-
-        file_id = result.lastrowid
-        file_name = file.filename
-        file.name = str(file_id) + "-" + file.filename
-        print(file.name)
-
-        if file_name.endswith((".m4a", ".mp3", ".webm", ".wav", ".mpeg", ".ogg", ".opus", ".flac", ".mp4")):
-                audio_files.append((content, file.name))
-        if file_name.endswith(".pdf"):
-                pdf_files.append((content, file))
-                # text_files.append(file)
-        if file_name.endswith((".mp4", ".avi", ".mov", ".mkv", ".webm", ".mpeg", ".ogg")):
-                video_files.append((content, file.name))
-        if file_name.endswith((".docx", ".txt", ".html", ".md", ".epub", ".pptx", ".csv", ".xlsx", ".ipynb", ".py", ".xml")):
-                text_files.append(file)
-
-    ############## Audio ###############
-
-    if audio_files:
-        for content, file_name in audio_files:
-            # audio, sr = librosa.load(io.BytesIO(file_content), sr=None)
-            converted_audio_files.append((content, file_name))
-
-        transcribed_audio_files = transcribe_audio_files(converted_audio_files, subject)
-    
-    ############## Images ###############
-
-    pdf_dir = os.path.join(UPLOAD_DIRECTORY, 'pdfs')
-    extracted_images_dir = os.path.join(UPLOAD_DIRECTORY, 'extracted_images')
-
-    if os.path.exists(pdf_dir):
-        shutil.rmtree(pdf_dir)
-
-    os.makedirs(pdf_dir, exist_ok=True)
-    os.makedirs(extracted_images_dir, exist_ok=True) 
-
-    for content, file in pdf_files:
-        file_path = os.path.join(pdf_dir, file.name)
-        with open(file_path, 'wb') as f:
-            f.write(content)
-
-    process_all_pdfs(pdf_dir, extracted_images_dir)
+        # Written to disk by ingestion_jobs.submit, into the job's directory
+        content = await file.read()
+        uploads.append((file.filename, file.content_type, content))
 
-    captions = generate_captions_for_images(extracted_images_dir)
-    pdf_image_captions = create_documents_from_captions(captions, subject)
+    job_files = await run_in_threadpool(insert_lecture_materials, uploads)
+    job_id = await run_in_threadpool(ingestion_jobs.submit, subject, job_files)
 
+    return JSONResponse(content={"message": "Files uploaded, processing started", "job_id": job_id, "files": file_info}, status_code=202)
 
-    ############## Video ###############
 
-    video_dir = os.path.join(UPLOAD_DIRECTORY, 'videos')
-    os.makedirs(video_dir, exist_ok=True)  # Create the videos directory if it doesn't exist
-
-    for content, file_name in video_files:
-        file_path = os.path.join(video_dir, file_name)
-        with open(file_path, 'wb') as f:
-            f.write(content)
-
-    frame_dir = os.path.join(UPLOAD_DIRECTORY, 'video_frames')
-    os.makedirs(frame_dir, exist_ok=True) 
-
-    frame_rate = 1
-    proccessed_videos = process_videos_in_directory(video_dir, frame_dir, frame_rate, subject)
-    
-    converted_audio_files = []
+# Recent ingestion jobs, newest first
+@app.get("/jobs")
+def list_jobs(limit: int = 20):
+    return ingestion_jobs.recent(limit)
 
 
-    ############## Text ###############
+# Ingestion job status with per-file, per-stage progress
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    job = ingestion_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
 
-    text_files_dir = os.path.join(UPLOAD_DIRECTORY, 'textFiles')
-    os.makedirs(text_files_dir, exist_ok=True)  # Create the textFiles directory if it doesn't exist
 
-    for file in text_files:
-        file_path = os.path.join(text_files_dir, file.name)
-        await file.seek(0)
-        async with aiofiles.open(file_path, 'wb') as f:
-            while True:
-                chunk = await file.read(1024)  # Read in chunks of 1024 bytes
-                if not chunk:
-                    break
-                await f.write(chunk)
-
-    preproccessed_text = text_preprocess(text_files_dir)
-    # print(preproccessed_text)
-
-    documents = update_metadata(preproccessed_text, subject)
-
-    ############## Update Metadata ###############
-
-    if audio_files:
-        for doc in transcribed_audio_files:
-            documents.append(doc)
-
-    if pdf_files:
-        for doc in pdf_image_captions:
-            documents.append(doc)
-
-    if video_files:
-        for doc in proccessed_videos:
-            documents.append(doc)
-
-    print(len(documents))
-    # print(documents)
-    
-    save_doc(documents)
-    print("done")
-
-    ############## Cleanup ###############
-
-    # Remove the directories and their contents
-    if os.path.exists(pdf_dir):
-        shutil.rmtree(pdf_dir)
-    if os.path.exists(extracted_images_dir):
-        for filename in os.listdir(extracted_images_dir):
-            src_file = os.path.join(extracted_images_dir, filename)
-            dest_file = os.path.join(IMG_DIRECTORY, filename)
-            shutil.move(src_file, dest_file)
-        shutil.rmtree(extracted_images_dir)
-    if os.path.exists(video_dir):
-        shutil.rmtree(video_dir)
-    if os.path.exists(frame_dir):
-        for filename in os.listdir(frame_dir):
-            src_file = os.path.join(frame_dir, filename)
-            dest_file = os.path.join(IMG_DIRECTORY, filename)
-            shutil.move(src_file, dest_file)
-        shutil.rmtree(frame_dir)
-    if os.path.exists(text_files_dir):
-        shutil.rmtree(text_files_dir)
-
-    return JSONResponse(content={"message": "Files uploaded successfully!", "files": file_info})
+@app.post("/jobs/{job_id}/cancel")
+def cancel_job(job_id: str):
+    status = ingestion_jobs.cancel(job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if status != "cancelled":
+        raise HTTPException(status_code=409, detail=f"Job already {status}")
+    return {"message": "Job cancelled", "job_id": job_id}
 
 
 @app.post("/mentor-notes")
-async def submit_notes(
+def submit_notes(
     week_no: str = Form(...),
     has_attended: bool = Form(...),
     activity_summary: str = Form(...),
@@ -730,7 +767,7 @@ async def submit_notes(
 
 
 @app.post("/get-mentor-queries")
-async def get_mentor_queries_endpoint():
+def get_mentor_queries_endpoint():
     try:
         queries = get_mentor_queries()
         return {"queries": queries}
@@ -738,7 +775,7 @@ async def get_mentor_queries_endpoint():
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/respond-to-query")
-async def respond_to_query_endpoint(response: QueryResponse):
+def respond_to_query_endpoint(response: QueryResponse):
     try:
         query_id = response.queryId
         mentor_response = response.mentorResponse
@@ -750,7 +787,7 @@ async def respond_to_query_endpoint(response: QueryResponse):
 
 
 @app.delete("/delete-mentor_query")
-async def delete_mentor_query(queryId: str):
+def delete_mentor_query(queryId: str):
     try:
         print("queryId:", queryId)
         delete_mentor_query_by_id(queryId)
@@ -760,7 +797,7 @@ async def delete_mentor_query(queryId: str):
 
 
 @app.get("/get-notifications")
-async def get_notifications_endpoint(user_id: str):
+def get_notifications_endpoint(user_id: str):
     try:
         notifications = get_answered_queries(user_id)
         return notifications
@@ -769,7 +806,7 @@ async def get_notifications_endpoint(user_id: str):
 
 
 @app.post("/update-notification")
-async def update_notification_endpoint(id: str):
+def update_notification_endpoint(id: str):
     try:
         update_query(id)
         return {"message": "Query updated successfully"}
@@ -779,7 +816,7 @@ async def update_notification_endpoint(id: str):
 
 # Endpoint for registration
 @app.post("/register")
-async def register(user: User):
+def register(user: User):
     print(user)
     user_data = get_user(user.email)
     
@@ -797,7 +834,7 @@ async def register(user: User):
 
 # Endpoint for login
 @app.post("/login")
-async def login(login: LoginModel):
+def login(login: LoginModel):
     result = verify_login(login.email, login.password)
     return result
 
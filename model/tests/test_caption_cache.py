@@ -0,0 +1,60 @@
+"""Near-duplicate lookups of the caption cache (see CaptionCache.py).
+
+Run from the model directory: python -m pytest tests
+"""
+import pytest
+
+PIL_ImageDraw = pytest.importorskip("PIL.ImageDraw")
+import PIL.Image
+
+from CaptionCache import CaptionCache, image_dhash, text_similarity, CAPTION_CACHE_MAX_DISTANCE
+
+MODEL = "gemini-1.5-flash"
+
+
+def template_slide(title, bullets):
+    # Same background, title bar and layout for every slide, only the text differs
+    img = PIL.Image.new("RGB", (1280, 720), "white")
+    draw = PIL_ImageDraw.Draw(img)
+    draw.rectangle((0, 0, 1280, 120), fill=(20, 60, 140))
+    draw.rectangle((0, 690, 1280, 720), fill=(20, 60, 140))
+    draw.text((60, 40), title, fill="white")
+    for i, bullet in enumerate(bullets):
+        draw.text((80, 180 + 60 * i), f"- {bullet}", fill="black")
+    return img
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return CaptionCache(str(tmp_path / "captions.db"), max_distance=CAPTION_CACHE_MAX_DISTANCE, min_text_similarity=0.8)
+
+
+def test_template_slides_with_different_text_are_not_near_duplicates(cache):
+    loops = template_slide("Loops in Python", ["for iterates over a sequence", "while repeats until false"])
+    recursion = template_slide("Recursion", ["a function calling itself", "needs a base case"])
+    loops_ocr = "Loops in Python\n- for iterates over a sequence\n- while repeats until false"
+    recursion_ocr = "Recursion\n- a function calling itself\n- needs a base case"
+
+    # The perceptual hash alone can't tell them apart
+    assert bin(image_dhash(loops) ^ image_dhash(recursion)).count("1") <= CAPTION_CACHE_MAX_DISTANCE
+
+    cache.store("loops", image_dhash(loops), loops_ocr, "5.3.0", "A slide about loops in Python.", "gemini", MODEL)
+    assert cache.similar(image_dhash(recursion), recursion_ocr, {MODEL}) is None
+
+
+def test_near_duplicate_with_same_text_reuses_caption(cache):
+    slide = template_slide("Loops in Python", ["for iterates over a sequence", "while repeats until false"])
+    reexported = slide.resize((1024, 576)).convert("L").convert("RGB")
+    ocr_text = "Loops in Python\n- for iterates over a sequence\n- while repeats until false"
+
+    cache.store("loops", image_dhash(slide), ocr_text, "5.3.0", "A slide about loops in Python.", "gemini", MODEL)
+    # OCR of the re-exported slide reads one word differently
+    entry = cache.similar(image_dhash(reexported), ocr_text.replace("sequence", "sequenoe"), {MODEL})
+    assert entry is not None
+    assert entry["caption"] == "A slide about loops in Python."
+
+
+def test_text_similarity():
+    assert text_similarity("", "") == 1.0
+    assert text_similarity("Loops in Python", "loops in python") == 1.0
+    assert text_similarity("Loops in Python", "Recursion") == 0.0
@@ -0,0 +1,28 @@
+"""Answer caching of chat turns (see ResponseCache.py and app.lookup_cached_response).
+
+Run from the model directory: python -m pytest tests
+"""
+from ResponseCache import ResponseCache, is_cacheable, NO_ATTACHMENTS
+
+KEY = ("type1", "Visual", "Textbook", "Formal", "Deductive", "digest")
+EMBEDDING = [0.1, 0.7, 0.2, 0.4]
+
+
+def test_turns_without_attachments_are_cacheable():
+    assert is_cacheable("What is a for loop in Python?", NO_ATTACHMENTS)
+    assert is_cacheable("What is a for loop in Python?", "")
+    assert not is_cacheable("What is a for loop in Python?", {"format": "text/plain", "documents": []})
+    assert not is_cacheable("Can you explain that again?", NO_ATTACHMENTS)
+
+
+def test_repeated_question_without_attachments_is_a_hit():
+    cache = ResponseCache(threshold=0.95, max_entries=10, ttl=60)
+    question = "What is a for loop in Python?"
+    assert is_cacheable(question, NO_ATTACHMENTS)
+    assert cache.lookup(KEY, EMBEDDING) is None
+
+    cache.store(KEY, EMBEDDING, question, "A for loop repeats a block for each item.", [], cache.generation)
+    cached = cache.lookup(KEY, EMBEDDING)
+    assert cached is not None
+    assert cached["response"] == "A for loop repeats a block for each item."
+    assert cache.stats()["hits"] == 1
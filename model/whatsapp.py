@@ -3,6 +3,7 @@ from twilio.rest import Client
 from groq import Groq
 import os
 from fastapi.responses import JSONResponse
+from fastapi.concurrency import run_in_threadpool
 import urllib.parse
 import random
 import string
@@ -10,17 +11,21 @@ import requests
 from requests.auth import HTTPBasicAuth
 
 from app import run_model
+from ChatTaskQueue import chat_tasks
+from ResponseCache import NO_ATTACHMENTS
+from SessionCache import session_cache, CHAT, get_chat_session, get_user_session, preload_chat_data, preload_user_data
 from FileProcess import process_file
 from ChatStoreSQL import (update_personalization_params, get_personalization_params, get_past_chats, delete_chat,
-                        get_chat_ids, load_chat_history, get_existing_feedback, get_mentor_notes)
+                        get_chat_ids)
 
 account_sid = os.getenv('TWILIO_ACCOUNT_SID')
 auth_token = os.getenv('TWILIO_AUTH_TOKEN')
 twilio = Client(account_sid, auth_token)
 client = Groq(api_key=os.getenv('GROQ_API_KEY'))
 
-# Cache for preloading variables
-preloaded_data = {}
+# The Twilio client is blocking, so messages are sent from the threadpool
+async def send_message(**kwargs):
+    return await run_in_threadpool(twilio.messages.create, **kwargs)
 
 # Function to generate random ChatID
 def generate_random_string(length, past_chats):
@@ -30,53 +35,16 @@ def generate_random_string(length, past_chats):
         if not any(chat == random_string for chat in past_chats):
             return random_string
 
-# Helper function to preload chat-specific data
-async def preload_chat_data(ChatID):
-    global preloaded_data
-    if ChatID not in preloaded_data:
-        preloaded_data[ChatID] = {}
-        
-    # Preload chat history and summary
-    chat_history, chat_summary = load_chat_history(ChatID)
-    preloaded_data[ChatID]["chat_history"] = chat_history if chat_history else []
-    preloaded_data[ChatID]["chat_summary"] = chat_summary if chat_summary else ""
-
-    # Preload personalization data
-    preloaded_data[ChatID]["personalization"] = get_personalization_params(ChatID)
-
-    print(f"Preloaded data for ChatID {ChatID}")
-
-async def preload_user_data(UserID):
-    global preloaded_data
-    if UserID not in preloaded_data:
-        preloaded_data[UserID] = {}
-        
-    # Preload mentor notes and feedback using UserID
-    preloaded_data[UserID]["notes"] = get_mentor_notes(UserID)
-    preloaded_data[UserID]["feedback"] = get_existing_feedback(UserID)
-
-    print(f"Preloaded data for UserID {UserID}")
-
-async def update_preload_data(ChatID):
-    global preloaded_data
-    if ChatID not in preloaded_data:
-        preloaded_data[ChatID] = {}
-        
-    # Preload chat history and summary
-    chat_history, chat_summary = load_chat_history(ChatID)
-    preloaded_data[ChatID]["chat_history"] = chat_history if chat_history else []
-    preloaded_data[ChatID]["chat_summary"] = chat_summary if chat_summary else ""
-
-    print(f"Updated chat history and chat summary for ChatID {ChatID}")
-
 async def remove_file(file):
     try:
         os.remove(file)
     except OSError as e:
         return JSONResponse(content={"error": f"Error removing file: {e}"}, status_code=500)
 
-async def fetch_resources(preloaded_data, ChatID, sender_number):
-    chat_history = preloaded_data[ChatID]["chat_history"]
+# Submitted with chat_tasks.submit_once: a retry after a failure that happened once the message was
+# sent would send it twice
+async def fetch_resources(chat_data, sender_number):
+    chat_history = chat_data["chat_history"]
     msg = chat_history[-1]
     context = msg.response_metadata["context"]
 
@@ -93,7 +61,7 @@ async def fetch_resources(preloaded_data, ChatID, sender_number):
             i =+1
 
         # Sending the message
-        twilio.messages.create(
+        await send_message(
             body=message_body.strip(),
             from_='whatsapp:+14155238886',
             to=sender_number,
@@ -123,27 +91,25 @@ async def whatsapp(request: Request, background_tasks: BackgroundTasks):
     print("Sender Number:", sender_number)
     
     parameters = {"student_type": "type1", "learning_style": "Visual", "communication_format": "Textbook", "tone_style": "Neutral", "reasoning_framework": "Deductive"}
-    past_chats = get_past_chats(sender_number)
+    past_chats = await run_in_threadpool(get_past_chats, sender_number)
     if not past_chats:
         # Fetch past chats
-        all_chatid = get_chat_ids()
+        all_chatid = await run_in_threadpool(get_chat_ids)
         chat_id = generate_random_string(10, all_chatid)
-        update_personalization_params(chat_id, sender_number, "", parameters["learning_style"], parameters["communication_format"], parameters["tone_style"], parameters["reasoning_framework"])
+        await run_in_threadpool(update_personalization_params, chat_id, sender_number, "", parameters["learning_style"], parameters["communication_format"], parameters["tone_style"], parameters["reasoning_framework"])
     else:
         # Otherwise, pick the first chat's ChatID and Chat_title
         chat_id = past_chats[0]['ChatID']
     
-    if chat_id not in preloaded_data:
-            await preload_chat_data(chat_id)
-    if sender_number not in preloaded_data:
-            await preload_user_data(sender_number)
+    chat_data = await get_chat_session(chat_id)
+    user_data = await get_user_session(sender_number)
             
     
     # Handling voice messages. Normal audio files are sent with the 'document' type which is handled seperately.
     if msg_type == 'audio':
         media_url = parsed_data.get('MediaUrl0', [''])[0]
         try:
-            audio_response = requests.get(media_url, auth=HTTPBasicAuth(account_sid, auth_token))
+            audio_response = await run_in_threadpool(requests.get, media_url, auth=HTTPBasicAuth(account_sid, auth_token))
                     
             if audio_response.status_code == 200:
                 # Process the audio file as needed
@@ -155,7 +121,8 @@ async def whatsapp(request: Request, background_tasks: BackgroundTasks):
                 response_message = f"Received audio message from {parsed_data.get('From', [''])[0]}. Audio file downloaded."
 
                 with open(audio_file_path, 'rb') as audio_file:
-                    transcription = client.audio.transcriptions.create(
+                    transcription = await run_in_threadpool(
+                        client.audio.transcriptions.create,
                         file=audio_file,  # Use the file object directly
                         model="distil-whisper-large-v3-en",  # The required transcription model
                         prompt="Specify context or spelling",  # Optional prompt to guide transcription
@@ -167,15 +134,15 @@ async def whatsapp(request: Request, background_tasks: BackgroundTasks):
                 message = transcription.text
                 print(message)
 
-                extract = "No file attachments provided"
-                response = run_model(chat_id, sender_number, message, extract, "text", "text", preloaded_data, background_tasks)
+                extract = NO_ATTACHMENTS
+                response = await run_model(chat_id, sender_number, message, extract, "text", "text", chat_data, user_data, background_tasks)
                 context_lines = "\n".join(response["context"])
                 if response["context"] == []:
                     formatted_string = f"{response["response"]} 😇"
                 else:
                     formatted_string = f"*🎤 Voice Message Transcribed:*\n{message}\n\n*Response:*\n{response["response"]}"
 
-                twilio.messages.create(
+                await send_message(
                         body=formatted_string,
                         from_='whatsapp:+14155238886',
                         to=sender_number, 
@@ -184,8 +151,8 @@ async def whatsapp(request: Request, background_tasks: BackgroundTasks):
                 remove_response = await remove_file(audio_file_path)
                 if remove_response:
                     return remove_response
-                background_tasks.add_task(update_preload_data, chat_id)
-                background_tasks.add_task(fetch_resources, chat_id, sender_number)
+                # Queued behind the turn's post-response tasks so the resources are ready
+                chat_tasks.submit_once(chat_id, fetch_resources, chat_data, sender_number)
             else:
                 print(f"Failed to download audio file: {audio_response.status_code}")
                 response_message = f"Failed to download audio file from {media_url}. Status code: {audio_response.status_code}"
@@ -211,7 +178,7 @@ async def whatsapp(request: Request, background_tasks: BackgroundTasks):
                     "🆕 `/new-chat`: Start a new chat\n"
                     "🗑️ `/delete-chat`: Delete a chat"
                 )
-                twilio.messages.create(
+                await send_message(
                     body=help_message,
                     from_='whatsapp:+14155238886',
                     to=sender_number
@@ -243,7 +210,7 @@ async def whatsapp(request: Request, background_tasks: BackgroundTasks):
                         "`/personalize 1 Visual`\n"
                         
                     )
-                    twilio.messages.create(
+                    await send_message(
                         body=help_message,
                         from_='whatsapp:+14155238886',
                         to=sender_number
@@ -276,7 +243,7 @@ async def whatsapp(request: Request, background_tasks: BackgroundTasks):
                         update_personalization_params(chat_id, sender_number, parameters["chat_title"], parameters["learning_style"], parameters["communication_format"], parameters["tone_style"], parameters["reasoning_framework"])
 
                         success_message = f"Personalization updated: *{parameter}* set to *{value}* 💫"
-                        twilio.messages.create(
+                        await send_message(
                             body=success_message,
                             from_='whatsapp:+14155238886',
                             to=sender_number
@@ -288,7 +255,7 @@ async def whatsapp(request: Request, background_tasks: BackgroundTasks):
                     
                     except ValueError:
                         error_message = "❌ Invalid format or parameter ID. Please use: `/personalize <parameter[ID]> <value>`"
-                        twilio.messages.create(
+                        await send_message(
                             body=error_message,
                             from_='whatsapp:+14155238886',
                             to=sender_number
@@ -313,7 +280,7 @@ async def whatsapp(request: Request, background_tasks: BackgroundTasks):
                         available_chats_message = "You have no past chats.\n"
 
                     # Send available chats or no chats message
-                    twilio.messages.create(
+                    await send_message(
                         body=available_chats_message,
                         from_='whatsapp:+14155238886',
                         to=sender_number
@@ -333,7 +300,7 @@ async def whatsapp(request: Request, background_tasks: BackgroundTasks):
                             update_personalization_params(chat_id, sender_number, parameters["chat_title"], parameters["learning_style"], parameters["communication_format"], parameters["tone_style"], parameters["reasoning_framework"])
                             
                             # Confirmation message
-                            twilio.messages.create(
+                            await send_message(
                                 body=f"Switched to chat: {selected_chat['Chat_title']} 💫",
                                 from_='whatsapp:+14155238886',
                                 to=sender_number
@@ -346,7 +313,7 @@ async def whatsapp(request: Request, background_tasks: BackgroundTasks):
                             raise IndexError("Invalid chat index")
                     except (ValueError, IndexError):
                         # Handle invalid chat index or non-numeric ID
-                        twilio.messages.create(
+                        await send_message(
                             body="❌ Invalid chat ID. Please use a valid number corresponding to a chat.",
                             from_='whatsapp:+14155238886',
                             to=sender_number
@@ -363,7 +330,7 @@ async def whatsapp(request: Request, background_tasks: BackgroundTasks):
                         "To start a new chat, use the following format:\n"
                         "`/new-chat confirm`"
                     )
-                    twilio.messages.create(
+                    await send_message(
                         body=help_message,
                         from_='whatsapp:+14155238886',
                         to=sender_number
@@ -386,7 +353,7 @@ async def whatsapp(request: Request, background_tasks: BackgroundTasks):
                     )
                     
                     # Send a message confirming the new chat creation
-                    twilio.messages.create(
+                    await send_message(
                         body=f"New chat created with Chat ID: {chat_id} 💫",
                         from_='whatsapp:+14155238886',
                         to=sender_number
@@ -398,7 +365,7 @@ async def whatsapp(request: Request, background_tasks: BackgroundTasks):
 
                 else:
                     # Invalid format, return error message
-                    twilio.messages.create(
+                    await send_message(
                         body="❌ Invalid command format. To start a new chat, use:\n`/new-chat confirm`",
                         from_='whatsapp:+14155238886',
                         to=sender_number
@@ -423,7 +390,7 @@ async def whatsapp(request: Request, background_tasks: BackgroundTasks):
                         available_chats_message = "You have no past chats.\n"
 
                     # Send available chats or no chats message
-                    twilio.messages.create(
+                    await send_message(
                         body=available_chats_message,
                         from_='whatsapp:+14155238886',
                         to=sender_number
@@ -440,9 +407,10 @@ async def whatsapp(request: Request, background_tasks: BackgroundTasks):
                             # Update the chat ID in your system (assuming you have a function to do this)
                             chatID = selected_chat['ChatID']
                             delete_chat(chatID)
+                            session_cache.delete(CHAT, chatID)
                             
                             # Confirmation message
-                            twilio.messages.create(
+                            await send_message(
                                 body=f"Deleted chat: {selected_chat['Chat_title']} 💫",
                                 from_='whatsapp:+14155238886',
                                 to=sender_number
@@ -455,7 +423,7 @@ async def whatsapp(request: Request, background_tasks: BackgroundTasks):
                             raise IndexError("Invalid chat index")
                     except (ValueError, IndexError):
                         # Handle invalid chat index or non-numeric ID
-                        twilio.messages.create(
+                        await send_message(
                             body="❌ Invalid chat ID. Please use a valid number corresponding to a chat.",
                             from_='whatsapp:+14155238886',
                             to=sender_number
@@ -465,7 +433,7 @@ async def whatsapp(request: Request, background_tasks: BackgroundTasks):
             # Handle unknown commands
             else:
                 unknown_command_message = f"🤓 The command '{command}' is not recognized. Type `/help` for available commands."
-                twilio.messages.create(
+                await send_message(
                     body=unknown_command_message,
                     from_='whatsapp:+14155238886',
                     to=sender_number
@@ -479,23 +447,23 @@ async def whatsapp(request: Request, background_tasks: BackgroundTasks):
                 "https://cdn.mos.cms.futurecdn.net/emJzqH4JermveVrtNC4BsZ.png"  # Replace with your document URL
             ]
 
-            extract = "No file attachments provided"
-            response = run_model(chat_id, sender_number, message, extract, "text", "text", preloaded_data, background_tasks)
+            extract = NO_ATTACHMENTS
+            response = await run_model(chat_id, sender_number, message, extract, "text", "text", chat_data, user_data, background_tasks)
             context_lines = "\n".join(response["context"])
             if response["context"] == []:
                 formatted_string = f"{response["response"]} 😇"
             else:
                 formatted_string = f"{response["response"]}"
 
-            twilio.messages.create(
+            await send_message(
                     body=formatted_string,
                     from_='whatsapp:+14155238886',
                     to=sender_number,
                     # media_url=media_urls  
             )
             
-            background_tasks.add_task(update_preload_data, chat_id)
-            background_tasks.add_task(fetch_resources, preloaded_data, chat_id, sender_number)
+            # Queued behind the turn's post-response tasks so the resources are ready
+            chat_tasks.submit_once(chat_id, fetch_resources, chat_data, sender_number)
 
             return JSONResponse("chatbot response sent")
         
@@ -507,7 +475,7 @@ async def whatsapp(request: Request, background_tasks: BackgroundTasks):
         media_type_category = media_type.split('/')[0]
 
         try:
-            file_response = requests.get(media_url, auth=HTTPBasicAuth(account_sid, auth_token))
+            file_response = await run_in_threadpool(requests.get, media_url, auth=HTTPBasicAuth(account_sid, auth_token))
                     
             if file_response.status_code == 200:
                 # Process the file as needed
@@ -517,7 +485,7 @@ async def whatsapp(request: Request, background_tasks: BackgroundTasks):
                             
                 print(f"{media_type_category} file downloaded successfully")
 
-                extract = process_file(file_path, message, background_tasks)
+                extract = await run_in_threadpool(process_file, file_path, message)
                 print(extract)
 
                 # If the message is empty, set a default message
@@ -525,7 +493,7 @@ async def whatsapp(request: Request, background_tasks: BackgroundTasks):
                     message = "Explain the contents of the attached file."
                 
                 filename = f'{media_type_category}.{file_extension}'
-                response = run_model(chat_id, sender_number, message, extract, media_type_category, filename, preloaded_data, background_tasks)
+                response = await run_model(chat_id, sender_number, message, extract, media_type_category, filename, chat_data, user_data, background_tasks)
                 context_lines = "\n".join(response["context"])
                 if response["context"] == []:
                     formatted_string = f"{response["response"]} 😇"
@@ -534,7 +502,7 @@ async def whatsapp(request: Request, background_tasks: BackgroundTasks):
                 else:
                     formatted_string = f"{response["response"]}"
 
-                twilio.messages.create(
+                await send_message(
                         body=formatted_string,
                         from_='whatsapp:+14155238886',
                         to=sender_number, 
@@ -547,7 +515,7 @@ async def whatsapp(request: Request, background_tasks: BackgroundTasks):
                     print(f"Error downloading file: {str(e)}")
                     response_message = f"Error downloading file: {str(e)}"
         
-        background_tasks.add_task(update_preload_data, chat_id)
-        background_tasks.add_task(fetch_resources, preloaded_data, chat_id, sender_number)
+        # Queued behind the turn's post-response tasks so the resources are ready
+        chat_tasks.submit_once(chat_id, fetch_resources, chat_data, sender_number)
         
         return JSONResponse({'message': response_message})
\ No newline at end of file